@@ -0,0 +1,106 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import os
+import sqlite3
+import threading
+import time
+
+import hashing
+
+# files modified this recently may still change within the same mtime tick
+RACY_INTERVAL = 2
+
+
+class ChecksumCache(object):
+    ''' Persistent cache of file checksums.
+
+        Digests are stored per algorithm and keyed by the file's absolute
+        path together with its device, inode, size, mtime and ctime, so a
+        file is only hashed again once it has changed.  The ctime catches
+        rewrites that keep the size and restore the mtime (rsync -t,
+        touch -r), which no one can set back.
+    '''
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS file_checksums ('
+                         'path TEXT, device INTEGER, inode INTEGER, '
+                         'size INTEGER, mtime REAL, ctime REAL, '
+                         'algorithm TEXT, checksum TEXT, '
+                         'PRIMARY KEY (path, algorithm))')
+            # keyed without the ctime by earlier versions
+            conn.execute('DROP TABLE IF EXISTS checksums')
+
+    def get_checksums(self, path, algorithms):
+        ''' Return (size, {algorithm: hexdigest}) like
+            hashing.get_file_checksums, hashing only for the algorithms that
+            are not cached for the current version of the file.
+        '''
+        if isinstance(algorithms, basestring):
+            algorithms = [algorithms]
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = _get_stat_key(stat)
+        checksums = self._lookup(path, key, algorithms)
+        missing = [a for a in algorithms if a not in checksums]
+        if not missing:
+            return (stat.st_size, checksums)
+
+        (size, computed) = hashing.get_file_checksums(path, missing)
+        checksums.update(computed)
+        if _get_stat_key(os.stat(path)) == key and \
+                time.time() - max(stat.st_mtime, stat.st_ctime) > \
+                RACY_INTERVAL:
+            self._store(path, key, computed)
+        return (size, checksums)
+
+    def invalidate(self, path):
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM file_checksums WHERE path = ?',
+                             (os.path.abspath(path),))
+
+    def clear(self):
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM file_checksums')
+
+    def _lookup(self, path, key, algorithms):
+        with self._connect() as conn:
+            rows = conn.execute('SELECT algorithm, checksum FROM '
+                                'file_checksums WHERE path = ? AND '
+                                'device = ? AND inode = ? AND size = ? AND '
+                                'mtime = ? AND ctime = ?',
+                                (path,) + key).fetchall()
+        return dict((algorithm, checksum)
+                    for (algorithm, checksum) in rows
+                    if algorithm in algorithms)
+
+    def _store(self, path, key, checksums):
+        with self._lock:
+            with self._connect() as conn:
+                # drop digests of an older version of the file
+                conn.execute('DELETE FROM file_checksums WHERE path = ? AND '
+                             'NOT (device = ? AND inode = ? AND size = ? AND '
+                             'mtime = ? AND ctime = ?)', (path,) + key)
+                conn.executemany('INSERT OR REPLACE INTO file_checksums '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                 [(path,) + key + (algorithm, checksum)
+                                  for (algorithm, checksum)
+                                  in checksums.iteritems()])
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+
+def _get_stat_key(stat):
+    # the float times keep all the precision Python 2's os.stat gives
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime,
+            stat.st_ctime)
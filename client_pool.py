@@ -0,0 +1,163 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import httplib
+import socket
+import thread
+import threading
+from collections import OrderedDict
+
+
+class ClientPool(object):
+    ''' Process-wide registry of MN/CN clients.
+
+        Clients are keyed by the arguments used to create them (base URL,
+        cert, key) plus the calling thread so that a client, and the
+        keep-alive connection it holds, is never used by two threads at
+        once.  A client becomes idle when its thread exits; idle clients
+        are handed to new threads asking for the same node, and beyond
+        max_idle of them the least recently used ones are closed.  A
+        client whose thread is alive is never closed by the pool.
+    '''
+
+    def __init__(self, factory, max_idle=16):
+        self.factory = factory
+        self.max_idle = max_idle
+        # (args, thread id) -> (client, thread)
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, *args):
+        current = threading.current_thread()
+        key = args + (thread.get_ident(),)
+        with self._lock:
+            entry = self._clients.pop(key, None)
+            if entry is not None and entry[1] is current:
+                self._clients[key] = entry
+                return entry[0]
+            if entry is None:
+                entry = self._pop_idle(args)
+            if entry is not None:
+                # a thread id of an exited thread may be reused
+                self._clients[key] = (entry[0], current)
+                return entry[0]
+        client = self.factory(*args)
+        with self._lock:
+            self._clients[key] = (client, current)
+            evicted = self._evict()
+        for old_client in evicted:
+            _close_client(old_client)
+        return client
+
+    def discard(self, *args):
+        ''' Drop the calling thread's client for args (e.g. after a
+            connection error) so that the next get creates a new one.
+        '''
+        key = args + (thread.get_ident(),)
+        with self._lock:
+            entry = self._clients.pop(key, None)
+        if entry is not None:
+            _close_client(entry[0])
+
+    def clear(self):
+        with self._lock:
+            entries = self._clients.values()
+            self._clients.clear()
+        for (client, _) in entries:
+            _close_client(client)
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _pop_idle(self, args):
+        for (key, entry) in self._clients.iteritems():
+            if key[:-1] == args and not entry[1].is_alive():
+                del self._clients[key]
+                return entry
+        return None
+
+    def _evict(self):
+        if self.max_idle is None:
+            return []
+        idle = [key for (key, entry) in self._clients.iteritems()
+                if not entry[1].is_alive()]
+        evicted = []
+        for key in idle[:max(len(idle) - self.max_idle, 0)]:
+            evicted.append(self._clients.pop(key)[0])
+        return evicted
+
+
+class ConnectionPool(object):
+    ''' Keep-alive HTTP(S) connections for the requests made without a
+        d1_client client (replica downloads, Range requests, probes and
+        searches), so each one does not start with a new TLS handshake.
+
+        Connections are keyed by scheme, host, port and credentials.  A
+        connection is used by one request at a time: get hands it out
+        and put takes it back once its response was read to the end.
+        Up to max_idle connections are kept per key.
+    '''
+
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        # key -> idle connections
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, timeout=None):
+        ''' Return (connection, reused) for key, a (scheme, host, port,
+            cert_file, key_file) tuple; a reused connection may have
+            been closed by the server since.
+        '''
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+        if conn is None:
+            (scheme, host, port, cert_file, key_file) = key
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(host, port, key_file,
+                                               cert_file, timeout=timeout)
+            else:
+                conn = httplib.HTTPConnection(host, port, timeout=timeout)
+            return (conn, False)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            try:
+                conn.sock.settimeout(timeout)
+            except socket.error:
+                # reconnects on the next request
+                conn.close()
+        return (conn, True)
+
+    def put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle = [conn for conns in self._idle.itervalues()
+                    for conn in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+    def __len__(self):
+        return sum(len(conns) for conns in self._idle.values())
+
+
+def _close_client(client):
+    ''' Close the HTTP connection of a d1_client client. '''
+    try:
+        client.connection.close()
+    except Exception:
+        pass
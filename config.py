@@ -21,6 +21,39 @@ try:
                                         orig_mn=(None, str),
                                         auth_mn=(None, str),
                                         checksum_alg="SHA-1",
+                                        client_pool_size=16,
+                                        cache_dir=(None, str),
+                                        node_list_ttl=86400,
+                                        sysmeta_cache_size=1000,
+                                        sysmeta_cache_ttl=300,
+                                        sysmeta_negative_ttl=30,
+                                        object_store_size=10 * 1024 ** 3,
+                                        use_checksum_cache=True,
+                                        hash_workers=0,
+                                        hash_pool="thread",
+                                        transfer_workers=8,
+                                        transfer_per_node=4,
+                                        resmap_stream_threshold=(None, int),
+                                        dedup_mode="skip",
+                                        use_save_journal=True,
+                                        segmented_download_threshold=256 * 1024 ** 2,
+                                        segment_size=32 * 1024 ** 2,
+                                        segment_workers=8,
+                                        replica_timeout=10,
+                                        download_timeout=60,
+                                        probe_replicas=True,
+                                        resume_downloads=True,
+                                        checksum_retries=2,
+                                        stream_uploads=False,
+                                        search_page_size=1000,
+                                        search_concurrency=4,
+                                        use_search_cache=True,
+                                        search_cache_size=1000,
+                                        search_cache_ttl=3600,
+                                        local_search=False,
+                                        harvest_page_size=1000,
+                                        harvest_concurrency=4,
+                                        harvest_overlap=300,
                                         )
 except ImportError:
     class D1ConfigurationObject(object):
@@ -36,6 +69,39 @@ except ImportError:
             self.orig_mn = None
             self.auth_mn = None
             self.checksum_alg = "SHA-1"
+            self.client_pool_size = 16
+            self.cache_dir = None
+            self.node_list_ttl = 86400
+            self.sysmeta_cache_size = 1000
+            self.sysmeta_cache_ttl = 300
+            self.sysmeta_negative_ttl = 30
+            self.object_store_size = 10 * 1024 ** 3
+            self.use_checksum_cache = True
+            self.hash_workers = 0
+            self.hash_pool = "thread"
+            self.transfer_workers = 8
+            self.transfer_per_node = 4
+            self.resmap_stream_threshold = None
+            self.dedup_mode = "skip"
+            self.use_save_journal = True
+            self.segmented_download_threshold = 256 * 1024 ** 2
+            self.segment_size = 32 * 1024 ** 2
+            self.segment_workers = 8
+            self.replica_timeout = 10
+            self.download_timeout = 60
+            self.probe_replicas = True
+            self.resume_downloads = True
+            self.checksum_retries = 2
+            self.stream_uploads = False
+            self.search_page_size = 1000
+            self.search_concurrency = 4
+            self.use_search_cache = True
+            self.search_cache_size = 1000
+            self.search_cache_ttl = 3600
+            self.local_search = False
+            self.harvest_page_size = 1000
+            self.harvest_concurrency = 4
+            self.harvest_overlap = 300
 
         def check(self, attr):
             if hasattr(self, attr) and getattr(self, attr) is not None:
@@ -39,7 +39,9 @@
 import os
 import sys
 import StringIO
-from xml.dom.minidom import parse, parseString #@UnusedImport
+import tempfile
+import threading
+from xml.etree.cElementTree import iterparse
 
 
 # 3rd party
@@ -66,6 +68,8 @@ except ImportError as e:
 # vistrails package
 import utils
 from config import configuration
+from resource_map import ResourceMapWriter
+from transfer import TransferScheduler
 
 ALLOWABLE_PACKAGE_SERIALIZATIONS = ('xml', 'pretty-xml', 'n3', 'rdfa', 'json',
                                     'pretty-json', 'turtle', 'nt', 'trix')
@@ -75,15 +79,28 @@ RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
 CITO_NS = 'http://purl.org/spar/cito/'
 DCTERMS_NS = 'http://purl.org/dc/terms/'
 
+RDF_DESCRIPTION = '{%s}Description' % RDF_NS
+RDF_ABOUT = '{%s}about' % RDF_NS
+RDF_RESOURCE = '{%s}resource' % RDF_NS
+CITO_DOCUMENTS = '{%s}documents' % CITO_NS
+CITO_IS_DOCUMENTED_BY = '{%s}isDocumentedBy' % CITO_NS
+DCTERMS_IDENTIFIER = '{%s}identifier' % DCTERMS_NS
+
 
 #** DataPackage ***************************************************************
 
 class DataPackage(object):
 
-    def __init__(self, pid=None):
-        ''' Create a package
+    def __init__(self, pid=None, deferred=False):
+        ''' Create a package.  In deferred mode, members are added right
+            away and their checksums are computed in the hash pool; save
+            waits for them.
         '''
         self.pid = pid
+        self.deferred = deferred
+        self._pending_sysmeta = []
+        # maps a pid saved by save_revision to the pid it obsoletes
+        self._obsoletes = {}
         #
         # Objects in here a dicts with keywords pid, dirty, obj, meta; which are
         # string, boolean, blob, and pyxb objects respectively.
@@ -128,9 +145,13 @@ class DataPackage(object):
         #   self.pid = pid
 
 
-    def load(self):
+    def load(self, lazy=False):
         ''' Get the object referred to by pid and make sure it is a
             package.
+
+            Members are downloaded concurrently.  With lazy set, nothing is
+            downloaded here: each member's system metadata and file are
+            fetched the first time they are used.
         '''
         if self.pid is None:
             raise Exception('Missing pid')
@@ -141,52 +162,106 @@ class DataPackage(object):
             raise Exception('Package must be in RDF/XML format (not "%s").' % \
                               sysmeta.formatId)
 
-        rdf_xml_file = utils.get_object_by_pid(self.pid)
-        if not self._parse_rdf_xml(rdf_xml_file):
-            raise Exception('Unable to load package "%s".' % self.pid)
+        rdf_xml = utils.open_object_by_pid(self.pid)
+        if rdf_xml is None:
+            raise Exception('Couldn\'t download "%s".' % self.pid)
+        try:
+            if not self._parse_rdf_xml(rdf_xml):
+                raise Exception('Unable to load package "%s".' % self.pid)
+        finally:
+            if hasattr(rdf_xml, 'close'):
+                rdf_xml.close()
         self.original_pid = self.pid
         self.sysmeta = sysmeta
 
-        self.scimeta = self._download_object(self.scimeta)
+        if lazy:
+            if self.scimeta:
+                self.scimeta = LazyDataObject(self.scimeta, self._get_by_pid)
+            for pid, scidata in self.scidata_dict.items():
+                self.scidata_dict[pid] = LazyDataObject(scidata,
+                                                        self._get_by_pid)
+            return self
+
+        pool = utils.get_transfer_pool()
+        if self.scimeta:
+            scimeta_task = pool.submit(self._download_object, self.scimeta)
+        scidata_tasks = [(pid, pool.submit(self._download_object, scidata))
+                         for pid, scidata in self.scidata_dict.iteritems()]
+        if self.scimeta:
+            self.scimeta = scimeta_task.get()
         loaded_scidata = {}
-        for pid, scidata in self.scidata_dict.iteritems():
-            loaded_scidata[pid] = self._download_object(scidata)
+        for pid, task in scidata_tasks:
+            loaded_scidata[pid] = task.get()
         self.scidata_dict = loaded_scidata
         return self
 
 
     def _parse_rdf_xml(self, xml_file):
-        doc = parse(xml_file)
-#    print 'doc:\n', doc.toxml()
+        ''' Read the package members from a resource map in one pass.
+            xml_file may be a file name or a file-like object such as the
+            response of a get; elements are discarded once read.
+        '''
         self.scimeta = None
         self.scidata_dict = {}
-        for desc in doc.getElementsByTagNameNS(RDF_NS, 'Description'):
-            documentedBy = desc.getElementsByTagNameNS(CITO_NS, 'isDocumentedBy')
-            if documentedBy and len(documentedBy) > 0:
-                scidata = DataObject(dirty=False)
-                pid_element = desc.getElementsByTagNameNS(DCTERMS_NS, 'identifier')
-                if pid_element and pid_element.item(0) and pid_element.item(0).hasChildNodes():
-                    scidata.pid = pid_element.item(0).firstChild.nodeValue
-                    if len(documentedBy) > 1:
-                        print 'Using the first Science Metadata Object for %s' % scidata.pid
-                    about_url = documentedBy.item(0).getAttributeNS(RDF_NS, 'resource')
-                    scidata.documented_by = about_url
-                    self.scidata_dict[scidata.pid] = scidata
-            # scimeta?
-            elif desc.getElementsByTagNameNS(CITO_NS, 'documents'):
-                if self.scimeta:
-                    print 'Already have a science metadata object (%s).  Skipping...' % \
-                        self.scimeta.pid
-                else:
-                    self.scimeta = DataObject(dirty=False)
-                    pid_element = desc.getElementsByTagNameNS(DCTERMS_NS, 'identifier')
-                    if pid_element and pid_element.item(0) and pid_element.item(0).hasChildNodes():
-                        self.scimeta.pid = pid_element.item(0).firstChild.nodeValue
+        depth = 0
+        root = None
+        for (event, elem) in iterparse(xml_file, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            # rdf:Description or a typed node (as in pretty-xml)
+            if elem.tag != RDF_DESCRIPTION and elem.get(RDF_ABOUT) is None:
+                continue
+            self._parse_rdf_description(elem)
+            if depth == 1:
+                root.clear()
         return True
 
 
-    def save(self, mn_client=None, cn_client=None, **kwargs):
+    def _parse_rdf_description(self, desc):
+        pid = None
+        documented_by = []
+        documents = False
+        for child in desc:
+            if child.tag == DCTERMS_IDENTIFIER:
+                if pid is None and child.text:
+                    pid = child.text
+            elif child.tag == CITO_IS_DOCUMENTED_BY:
+                resource = child.get(RDF_RESOURCE)
+                if resource is None and len(child) > 0:
+                    resource = child[0].get(RDF_ABOUT)
+                documented_by.append(resource)
+            elif child.tag == CITO_DOCUMENTS:
+                documents = True
+        if documented_by:
+            if pid is not None:
+                scidata = DataObject(dirty=False)
+                scidata.pid = pid
+                if len(documented_by) > 1:
+                    print 'Using the first Science Metadata Object for %s' % scidata.pid
+                scidata.documented_by = documented_by[0]
+                scidata.url = desc.get(RDF_ABOUT)
+                self.scidata_dict[scidata.pid] = scidata
+        # scimeta?
+        elif documents:
+            if self.scimeta:
+                print 'Already have a science metadata object (%s).  Skipping...' % \
+                    self.scimeta.pid
+            else:
+                self.scimeta = DataObject(dirty=False)
+                self.scimeta.pid = pid
+                self.scimeta.url = desc.get(RDF_ABOUT)
+
+
+    def save(self, mn_client=None, cn_client=None, progress=None, **kwargs):
         ''' Save this object referred to by this pid.
+
+            Members are uploaded concurrently (see _save_members) and the
+            resource map is only serialized and created once all of them
+            are saved, so it lists the pids they were saved under.
         '''
         if self.pid is None:
             raise Exception('Missing pid')
@@ -195,30 +270,47 @@ class DataPackage(object):
             mn_client = utils.get_d1_mn_client()
         if cn_client is None:
             cn_client = utils.get_d1_cn_client()
+        self.wait_for_sysmeta()
 
-        pkg_xml = self._serialize('xml', mn_client)
-        if not pkg_xml:
-            raise Exception("Couldn't serialize object.")
+        # Save all the objects, continuing an earlier save that failed.
+        # Saving may give members new pids, so serialize afterwards.
+        journal = utils.get_save_journal(mn_client.base_url,
+                                         self._obsoletes.get(self.pid,
+                                                             self.pid))
+        self._save_members(mn_client, cn_client, progress, journal)
 
         algorithm = configuration.checksum_alg
-        hash_fcn = util.get_checksum_calculator_by_dataone_designator(algorithm)
-        hash_fcn.update(pkg_xml)
-        checksum = hash_fcn.hexdigest()
-
-        sysmeta = utils.create_system_metadata(self.pid, len(pkg_xml),
+        # the streaming writer is off unless a threshold is configured:
+        # its output has not been checked against foresite's yet
+        if configuration.check("resmap_stream_threshold") and \
+                len(self.scidata_dict) >= \
+                configuration.resmap_stream_threshold:
+            (flo, size, checksum) = self._write_resmap(mn_client, algorithm)
+        else:
+            pkg_xml = self._serialize('xml', mn_client)
+            if not pkg_xml:
+                raise Exception("Couldn't serialize object.")
+            hash_fcn = \
+                util.get_checksum_calculator_by_dataone_designator(algorithm)
+            hash_fcn.update(pkg_xml)
+            (flo, size, checksum) = (StringIO.StringIO(pkg_xml),
+                                     len(pkg_xml), hash_fcn.hexdigest())
+
+        sysmeta = utils.create_system_metadata(self.pid, size,
                                                checksum, algorithm, RDFXML_FORMATID,
                                                **kwargs)
-        flo = StringIO.StringIO(pkg_xml)
-
-        # Save all the objects.
-        if self.scimeta and self.scimeta.dirty:
-            self._create_or_update(mn_client, cn_client, self.scimeta)
-        for scidata_pid in self.scidata_dict.keys():
-            scidata = self.scidata_dict.get(scidata_pid)
-            if scidata and scidata.dirty:
-                self._create_or_update(mn_client, cn_client, scidata)
 
-        response = mn_client.create(pid=self.pid, obj=flo, sysmeta=sysmeta)
+        previous_pid = self._obsoletes.get(self.pid)
+        if previous_pid is not None:
+            sysmeta.obsoletes = previous_pid
+            response = utils.update_object(mn_client, previous_pid, flo,
+                                           self.pid, sysmeta)
+            utils.record_obsoletes(previous_pid, self.pid)
+        else:
+            response = utils.create_object(mn_client, self.pid, flo, sysmeta)
+            utils.sysmeta_cache.invalidate(self.pid)
+        if journal is not None:
+            journal.finish()
         if response is None:
             return None
         else:
@@ -231,8 +323,163 @@ class DataPackage(object):
             return response.value()
 
 
-    def _create_or_update(self, mn_client, cn_client, data_object):
+    def save_revision(self, previous, mn_client=None, cn_client=None,
+                      progress=None, **kwargs):
+        ''' Save this package as the next version of previous, a package
+            loaded from DataONE (lazily is enough).
+
+            Members are matched by the newest version of their pid.
+            Unchanged members are not sent again, changed ones are saved
+            under a new pid that obsoletes the newest version, and the
+            resource map saved under this package's pid obsoletes the
+            previous one.  Without a pid, the package gets one from the
+            member node once something changed.  Returns None if nothing
+            changed.
+        '''
+        if self.pid == previous.pid:
+            raise Exception('A new revision needs a new pid')
+        if mn_client is None:
+            mn_client = utils.get_d1_mn_client()
+        if cn_client is None:
+            cn_client = utils.get_d1_cn_client()
+        self.wait_for_sysmeta()
+
+        # compare newest versions: a member saved by an earlier revision
+        # may still carry the pid it had before
+        remote_members = dict(previous.scidata_dict)
+        if previous.scimeta:
+            remote_members[previous.scimeta.pid] = previous.scimeta
+        remote_heads = {}
+        for (pid, remote_object) in remote_members.iteritems():
+            sysmeta = utils.get_sysmeta_by_pid(pid, True, cn_client,
+                                               mn_client)
+            head = sysmeta.identifier.value() if sysmeta else pid
+            remote_heads[head] = remote_object
+        members = self.scidata_dict.values()
+        if self.scimeta:
+            members.append(self.scimeta)
+
+        changed = []
+        for data_object in members:
+            curr_sysmeta = utils.get_sysmeta_by_pid(data_object.pid, True,
+                                                    cn_client, mn_client)
+            if not curr_sysmeta:
+                continue
+            self._set_member_pid(data_object,
+                                 curr_sysmeta.identifier.value())
+            if configuration.dedup_mode != 'off' and \
+                    self._has_same_content(data_object, curr_sysmeta):
+                data_object.dirty = False
+                if data_object.url is None and \
+                        data_object.pid in remote_heads:
+                    data_object.url = remote_heads[data_object.pid].url
+            else:
+                changed.append(data_object)
+        if not changed and \
+                set(m.pid for m in members) == set(remote_heads):
+            return None
+
+        if self.pid is None:
+            self.pid = utils.generate_identifier(mn_client)
+        # reuse the pids of an earlier attempt that failed partway
+        journal = utils.get_save_journal(mn_client.base_url, previous.pid)
+        for data_object in changed:
+            old_pid = data_object.pid
+            new_pid = None
+            if journal is not None:
+                new_pid = journal.get_successor(old_pid, data_object.meta)
+            if new_pid is None:
+                new_pid = utils.generate_identifier(mn_client)
+            self._set_member_pid(data_object, new_pid)
+            self._obsoletes[new_pid] = old_pid
+        self._obsoletes[self.pid] = previous.pid
+        return self.save(mn_client, cn_client, progress, **kwargs)
+
+
+    def _set_member_pid(self, data_object, pid):
+        ''' Give a member a new pid (and so a new url). '''
+        old_pid = data_object.pid
+        if pid == old_pid:
+            return
+        data_object.pid = pid
+        data_object.url = None
+        if data_object.meta is not None:
+            data_object.meta.identifier = pid
+        if self.scidata_dict.get(old_pid) is data_object:
+            del self.scidata_dict[old_pid]
+            self.scidata_dict[pid] = data_object
+
+
+    def _has_same_content(self, data_object, curr_sysmeta):
+        ''' Like utils.has_same_content, but a lazily loaded member is only
+            downloaded if its checksum uses another algorithm.
+        '''
+        meta = data_object.meta
+        fname = data_object.get_local_fname()
+        if fname is None and not (meta is not None and
+                                  curr_sysmeta.checksum is not None and
+                                  str(meta.checksum.algorithm) ==
+                                  str(curr_sysmeta.checksum.algorithm)):
+            fname = data_object.fname
+        return utils.has_same_content(fname, meta, curr_sysmeta)
+
+
+    def _save_members(self, mn_client, cn_client, progress=None,
+                      journal=None):
+        ''' Create or update all dirty members, a few at a time per node.
+            Members that were saved are marked clean even if others failed,
+            so a retry only sends the rest.  Members the journal records
+            as saved with the same content are skipped.
+        '''
+        members = []
+        if self.scimeta and self.scimeta.dirty:
+            members.append(self.scimeta)
+        for scidata in self.scidata_dict.values():
+            if scidata and scidata.dirty:
+                members.append(scidata)
+        if journal is not None:
+            for data_object in members:
+                if journal.is_done(data_object.pid, data_object.meta):
+                    data_object.dirty = False
+            members = [m for m in members if m.dirty]
+        if not members:
+            return {}
+
+        scheduler = TransferScheduler(utils.get_transfer_pool(),
+                                      configuration.transfer_per_node,
+                                      progress)
+        if not utils.can_share_clients(mn_client, cn_client):
+            scheduler.per_node_limit = 1
+        # saving may change a member's pid (see _create_or_update)
+        submitted = [(data_object.pid, data_object)
+                     for data_object in members]
+        for (pid, data_object) in submitted:
+            scheduler.submit(mn_client.base_url, pid,
+                             self._save_member, mn_client, cn_client,
+                             data_object, journal)
+        try:
+            return scheduler.wait()
+        finally:
+            for (pid, data_object) in submitted:
+                if pid in scheduler.results:
+                    data_object.dirty = False
+                if data_object.pid != pid and \
+                        self.scidata_dict.get(pid) is data_object:
+                    del self.scidata_dict[pid]
+                    self.scidata_dict[data_object.pid] = data_object
+
+
+    def _save_member(self, mn_client, cn_client, data_object, journal=None):
+        ''' Runs in a transfer thread with that thread's own clients. '''
+        return self._create_or_update(utils.get_thread_client(mn_client),
+                                      utils.get_thread_client(cn_client),
+                                      data_object, journal)
+
+
+    def _create_or_update(self, mn_client, cn_client, data_object,
+                          journal=None):
         ''' Either update the specified pid if it already exists or create a new one.
+            What was done is recorded in journal, if given.
         '''
         if not data_object:
             raise Exception('data object cannot be null')
@@ -242,27 +489,83 @@ class DataPackage(object):
             raise Exception('data object must have a file to write')
         if not data_object.meta:
             raise Exception('data object must have system metadata')
+        previous_pid = self._obsoletes.get(data_object.pid)
+        # New version of a changed member
+        if previous_pid is not None:
+            data_object.meta.obsoletes = previous_pid
+            try:
+                response = utils.update_object(mn_client, previous_pid,
+                                               data_object.fname,
+                                               data_object.pid,
+                                               data_object.meta)
+            except DataONEException as e:
+                raise Exception('Unable to update Science Object on Member Node\n{0}'
+                              .format(e.friendly_format()))
+            utils.record_obsoletes(previous_pid, data_object.pid)
+            if journal is not None:
+                journal.record(data_object.pid, 'obsoleted', data_object.meta,
+                               response, previous_pid)
+            return response
         curr_sysmeta = utils.get_sysmeta_by_pid(data_object.pid, True,
                                                 cn_client, mn_client)
         # Create
         if not curr_sysmeta:
-            with open(utils.expand_path(data_object.fname), 'r') as f:
-                try:
-                    return mn_client.create(data_object.pid, f, data_object.meta)
-                except DataONEException as e:
-                    raise Exception('Unable to create Science Object on Member Node\n{0}'
-                                  .format(e.friendly_format()))
-        # Update
-        else:
-            data_object.meta.serialVersion = (curr_sysmeta.serialVersion + 1)
-            with open(utils.expand_path(data_object.fname), 'r') as f:
-                try:
-                    return mn_client.update(data_object.pid, f, data_object.pid, data_object.meta)
-                except DataONEException as e:
-                    raise Exception('Unable to update Science Object on Member Node\n{0}'
-                                  .format(e.friendly_format()))
-        # Nothing good happened.
-        return None
+            action = 'created'
+            try:
+                response = utils.create_object(mn_client, data_object.pid,
+                                               data_object.fname,
+                                               data_object.meta)
+            except DataONEException as e:
+                raise Exception('Unable to create Science Object on Member Node\n{0}'
+                              .format(e.friendly_format()))
+            utils.sysmeta_cache.invalidate(data_object.pid)
+            if journal is not None:
+                journal.record(data_object.pid, action, data_object.meta,
+                               response)
+            return response
+        # the pid may have been obsoleted since the member was loaded
+        head = curr_sysmeta.identifier.value()
+        # Unchanged: don't send the same bytes again (see dedup_mode)
+        if configuration.dedup_mode != 'off' and \
+                utils.has_same_content(data_object.fname, data_object.meta,
+                                       curr_sysmeta):
+            if head != data_object.pid:
+                data_object.pid = head
+                data_object.meta.identifier = head
+                data_object.url = None
+            action = 'unchanged'
+            if configuration.dedup_mode == 'sysmeta' and \
+                    not utils.update_sysmeta_only(mn_client, head,
+                                                  data_object.meta,
+                                                  curr_sysmeta):
+                action = 'unchanged-sysmeta-skipped'
+                sys.stderr.write('Cannot update the system metadata of '
+                                 '"%s": the client does not support '
+                                 'it\n' % head)
+            utils.sysmeta_cache.invalidate(head)
+            if journal is not None:
+                journal.record(head, action, data_object.meta,
+                               curr_sysmeta.identifier)
+            return curr_sysmeta.identifier
+        # Update the pid asked for; save_revision gives changed members
+        # new pids that obsolete the old ones instead
+        if head != data_object.pid:
+            raise Exception('"%s" was obsoleted by "%s"; save a revision '
+                            'to change it' % (data_object.pid, head))
+        data_object.meta.serialVersion = curr_sysmeta.serialVersion + 1
+        try:
+            response = utils.update_object(mn_client, data_object.pid,
+                                           data_object.fname,
+                                           data_object.pid,
+                                           data_object.meta)
+        except DataONEException as e:
+            raise Exception('Unable to update Science Object on Member Node\n{0}'
+                          .format(e.friendly_format()))
+        utils.sysmeta_cache.invalidate(data_object.pid)
+        if journal is not None:
+            journal.record(data_object.pid, 'updated', data_object.meta,
+                           response)
+        return response
 
 
     def scimeta_add(self, pid, file_name=None, format_id=None, **kwargs):
@@ -307,10 +610,10 @@ class DataPackage(object):
                 raise Exception('"%s" is not an allowable science metadata type.' % new_meta.formatId)
                 return
             #
-            sysmeta = utils.create_sysmeta_from_path(pid, complex_path.path,
-                                                     format_id=format_id, **kwargs)
-            self.scimeta = DataObject(pid, True, complex_path.path, None, sysmeta,
-                                      format_id)
+            scimeta = DataObject(pid, True, complex_path.path, None, None,
+                                 format_id)
+            self._add_sysmeta(scimeta, **kwargs)
+            self.scimeta = scimeta
         scidata_list = self._find_scidata(self.scimeta)
         if scidata_list:
             for scidata in scidata_list:
@@ -345,10 +648,10 @@ class DataPackage(object):
                 format_id = configuration.format
             if not format_id:
                 raise Exception('The object format could not be determined and was not defined.')
-            meta = utils.create_sysmeta_from_path(pid, complex_path.path,
-                                                  format_id=format_id, **kwargs)
-            self.scidata_dict[pid] = DataObject(pid, True, complex_path.path, 
-                                                None, meta, format_id)
+            scidata = DataObject(pid, True, complex_path.path, None, None,
+                                 format_id)
+            self._add_sysmeta(scidata, **kwargs)
+            self.scidata_dict[pid] = scidata
 
         else:
             sysmeta = utils.get_sysmeta_by_pid(pid, True)
@@ -400,11 +703,47 @@ class DataPackage(object):
 
     #== Helpers ===============================================================
 
+    def _add_sysmeta(self, data_object, **kwargs):
+        ''' Create the system metadata for a local file, or schedule its
+            checksum in the hash pool when deferred.
+        '''
+        if not self.deferred:
+            data_object.meta = \
+                utils.create_sysmeta_from_path(data_object.pid,
+                                               data_object.fname,
+                                               format_id=data_object.format_id,
+                                               **kwargs)
+            return
+        algorithm = kwargs.pop('algorithm', None)
+        if algorithm is None:
+            algorithm = configuration.checksum_alg
+        task = utils.get_hash_pool().submit(utils.get_file_checksums,
+                                            utils.expand_path(data_object.fname),
+                                            [algorithm])
+        self._pending_sysmeta.append((data_object, task, algorithm, kwargs))
+
+
+    def wait_for_sysmeta(self):
+        ''' Wait for the checksums scheduled in deferred mode and fill in the
+            members' system metadata.
+        '''
+        pending = self._pending_sysmeta
+        self._pending_sysmeta = []
+        for (data_object, task, algorithm, kwargs) in pending:
+            (size, checksums) = task.get()
+            data_object.meta = \
+                utils.create_system_metadata(data_object.pid, size,
+                                             checksums[algorithm], algorithm,
+                                             data_object.format_id, **kwargs)
+
+
     def _get_by_pid(self, pid, sysmeta=None, mn_client=None, cn_client=None):
         ''' Return DataObject
         '''
         if pid is None:
             raise Exception('Missing pid')
+        if mn_client is None:
+            mn_client = utils.get_d1_mn_client()
 
         fname = utils.get_object_by_pid(pid, resolve=True, mn_client=mn_client,
                                         cn_client=cn_client)
@@ -485,6 +824,25 @@ class DataPackage(object):
         return doc.data
 
 
+    def _write_resmap(self, mn_client, algorithm):
+        ''' Write the RDF/XML resource map with ResourceMapWriter instead of
+            foresite, which builds the whole graph in memory.  Returns
+            (flo, size, checksum) with flo rewound.
+        '''
+        if not self._prepare_urls(mn_client):
+            raise Exception("Couldn't serialize object.")
+        resmap_url = utils.create_get_url_for_pid(mn_client.base_url,
+                                                  format(self.pid))
+        flo = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        writer = ResourceMapWriter(flo, algorithm)
+        writer.write(self.pid, resmap_url,
+                     (self.scimeta.pid, self.scimeta.url),
+                     [(scidata.pid, scidata.url)
+                      for scidata in self.scidata_dict.itervalues()])
+        flo.seek(0)
+        return (flo, writer.size, writer.checksum)
+
+
     def _prepare_urls(self, mn_client=None):
         ''' Walk through the objects make sure that everything can be
             serialized.
@@ -510,11 +868,12 @@ class DataPackage(object):
 
     def _check_item(self, item):
         errors = []
-        if not self.scimeta.pid:
+        if not item.pid:
             errors.append('missing pid')
-        if not self.scimeta.fname:
+        # a member loaded from DataONE need not be downloaded to be saved
+        if not item.get_local_fname() and item.meta is None:
             errors.append('missing fname')
-        if not self.scimeta.format_id:
+        if not item.format_id:
             errors.append('missing format-id')
         if len(errors) == 0:
             return True
@@ -536,14 +895,14 @@ class DataPackage(object):
                                                  **kwargs)
         if mn_client is None:
             mn_client = utils.get_d1_mn_client()
-        with open(path, 'r') as f:
-            try:
-                result = mn_client.create(item.pid, f, sysmeta)
-                print 'Created object "%s"' % item.pid
-                return result
-            except DataONEException as e:
-                raise Exception('Unable to create Science Object on Member Node\n{0}'
-                              .format(e.friendly_format()))
+        try:
+            result = utils.create_object(mn_client, item.pid, path, sysmeta)
+        except DataONEException as e:
+            raise Exception('Unable to create Science Object on Member Node\n{0}'
+                          .format(e.friendly_format()))
+        utils.sysmeta_cache.invalidate(item.pid)
+        print 'Created object "%s"' % item.pid
+        return result
 
 
     def _download_object(self, data_object):
@@ -578,6 +937,12 @@ class DataObject(object):
     def is_dirty(self):
         return (self.dirty is not None) and self.dirty
 
+    def get_local_fname(self):
+        ''' Return the local file of the object, without downloading it,
+            or None.
+        '''
+        return self.fname
+
     def str(self): #@ReservedAssignment
         m = 'None'
         if self.meta is not None:
@@ -608,10 +973,11 @@ class DataObject(object):
                 flags += pre + 'needs saving'
                 pre = ', '
                 post = ')'
-            if self.fname is not None:
+            fname = self.get_local_fname()
+            if fname is not None:
                 flags += pre + 'has an object file'
                 if verbose:
-                    flags += ' (%s)' % self.fname
+                    flags += ' (%s)' % fname
                 pre = ', '
                 post = ')'
             if self.meta is not None:
@@ -623,6 +989,86 @@ class DataObject(object):
             print '%s%s%s' % (p, self.pid, flags)
 
 
+class LazyDataObject(DataObject):
+    ''' Member of a loaded package that is only fetched when used.  The
+        system metadata (meta, format_id) is looked up on first access, the
+        object itself (fname) is downloaded on first access.
+    '''
+
+    def __init__(self, data_object, loader):
+        self._lock = threading.RLock()
+        self._loader = loader
+        self._sysmeta_loaded = False
+        self._loaded = False
+        DataObject.__init__(self, data_object.pid, data_object.dirty,
+                            data_object.fname, data_object.url,
+                            data_object.meta, data_object.format_id,
+                            data_object.documented_by)
+
+    def is_loaded(self):
+        return self._loaded
+
+    def get_local_fname(self):
+        return self._fname
+
+    def _get_fname(self):
+        self._load()
+        return self._fname
+
+    def _set_fname(self, fname):
+        self._fname = fname
+
+    fname = property(_get_fname, _set_fname)
+
+    def _get_meta(self):
+        self._load_sysmeta()
+        return self._meta
+
+    def _set_meta(self, meta):
+        self._meta = meta
+
+    meta = property(_get_meta, _set_meta)
+
+    def _get_format_id(self):
+        self._load_sysmeta()
+        return self._format_id
+
+    def _set_format_id(self, format_id):
+        self._format_id = format_id
+
+    format_id = property(_get_format_id, _set_format_id)
+
+    def _load_sysmeta(self):
+        with self._lock:
+            if self._sysmeta_loaded or self._loaded:
+                return
+            if self._meta is None and self.pid:
+                self._meta = utils.get_sysmeta_by_pid(self.pid, True)
+            if self._meta is not None and self._format_id is None:
+                self._format_id = self._meta.formatId
+            # only after the lookup, so a failed one is tried again
+            self._sysmeta_loaded = True
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            if self._fname is None and self.pid:
+                data_object = self._loader(self.pid, self._meta)
+                if data_object is not None:
+                    self._fname = data_object.fname
+                    self._meta = data_object.meta
+                    self._format_id = data_object.format_id
+                    if self.url is None:
+                        self.url = data_object.url
+            self._loaded = True
+
+    def str(self): #@ReservedAssignment
+        if not self._loaded:
+            return 'LazyDataObject[pid=%s,not loaded]' % self.pid
+        return DataObject.str(self)
+
+
 def run_pkg_test():
     configuration.mn_url = "https://mn-demo-9.test.dataone.org/knb/d1/mn"
     configuration.cn_url = "https://cn-stage-2.test.dataone.org/cn"
@@ -0,0 +1,408 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import errno
+import hashlib
+import httplib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import urlparse
+
+import d1_common.util
+
+from client_pool import ConnectionPool
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# connections of open_url, shared by all threads
+connection_pool = ConnectionPool()
+
+
+class RangeNotSupported(Exception):
+    ''' Raised when a node answers a Range request with the whole
+        object.
+    '''
+    pass
+
+
+class ChecksumError(Exception):
+    ''' Raised when downloaded bytes do not match the sysmeta checksum. '''
+
+    def __init__(self, pid, algorithm, expected, actual):
+        self.pid = pid
+        self.algorithm = algorithm
+        self.expected = expected
+        self.actual = actual
+        Exception.__init__(self, '%s checksum mismatch for "%s": expected '
+                           '%s, got %s' % (algorithm, pid, expected, actual))
+
+
+class VerifyingReader(object):
+    ''' Wraps a response and hashes the bytes as they are read.  At the
+        end of the object, ChecksumError is raised if they do not match
+        the checksum.  hasher may already contain the first offset bytes.
+    '''
+
+    def __init__(self, response, pid, size, algorithm, checksum,
+                 hasher=None, offset=0):
+        self.pid = pid
+        self.size = size
+        self.algorithm = algorithm
+        self.checksum = checksum.lower()
+        if hasher is None:
+            hasher = d1_common.util.\
+                get_checksum_calculator_by_dataone_designator(algorithm)
+        self._response = response
+        self._hasher = hasher
+        self._nbytes = offset
+        self._verified = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(size)
+        self._hasher.update(data)
+        self._nbytes += len(data)
+        if not data or size is None or size < 0:
+            self._verify()
+        return data
+
+    def close(self):
+        self._response.close()
+
+    def __iter__(self):
+        return iter_lines(self)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _verify(self):
+        if self._verified:
+            return
+        self._verified = True
+        if self._nbytes != self.size:
+            # a short read is an interrupted download, not a corrupt one
+            raise Exception('Download of "%s" ended after %d of %d bytes' %
+                            (self.pid, self._nbytes, self.size))
+        actual = self._hasher.hexdigest()
+        if actual.lower() != self.checksum:
+            raise ChecksumError(self.pid, self.algorithm, self.checksum,
+                                actual)
+
+
+def iter_lines(reader):
+    ''' Iterate over the lines of a response with only a read method. '''
+    pending = ''
+    while True:
+        data = reader.read(COPY_BUFFER_SIZE)
+        if not data:
+            break
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+def open_url(url, headers=None, cert_file=None, key_file=None,
+             timeout=None):
+    ''' GET url and return the httplib response, which the caller reads
+        and closes.  The connection comes from connection_pool and goes
+        back to it once the response was read to the end.
+    '''
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.hostname, parts.port, cert_file, key_file)
+    path = parts.path
+    if parts.query:
+        path += '?' + parts.query
+    while True:
+        (conn, reused) = connection_pool.get(key, timeout)
+        try:
+            conn.request('GET', path, headers=headers or {})
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            # the server may have closed an idle connection
+            if reused:
+                continue
+            raise
+        return PooledResponse(response, conn, key)
+
+
+class PooledResponse(object):
+    ''' A response of open_url that gives its connection back to
+        connection_pool once it was read to the end, or closes it.
+    '''
+
+    def __init__(self, response, conn, key):
+        self._response = response
+        self._conn = conn
+        self._key = key
+
+    def read(self, size=None):
+        if size is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(size)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._conn is None:
+            return
+        if not self._response.isclosed():
+            # the rest of the body would be read by the next request
+            self._response.close()
+            self._conn.close()
+            self._conn = None
+            return
+        self._release()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _release(self):
+        if self._conn is not None:
+            connection_pool.put(self._key, self._conn)
+            self._conn = None
+
+def open_range(url, start, end=None, cert_file=None, key_file=None,
+               timeout=None):
+    ''' GET bytes start to end (inclusive, or to the end of the object
+        if end is None) of url.  Raises RangeNotSupported if the node
+        sends the whole object instead.
+    '''
+    if end is None:
+        byte_range = 'bytes=%d-' % start
+    else:
+        byte_range = 'bytes=%d-%d' % (start, end)
+    response = open_url(url, {'Range': byte_range}, cert_file, key_file,
+                        timeout)
+    if response.status == httplib.PARTIAL_CONTENT:
+        content_range = response.getheader('Content-Range', '')
+        if content_range.startswith('bytes %d-' % start):
+            return response
+        response.close()
+        raise Exception('Unable to get %s: asked for bytes %d-, got %s' %
+                        (url, start, content_range))
+    response.close()
+    if response.status == httplib.OK:
+        raise RangeNotSupported(url)
+    raise Exception('Unable to get %s: %d %s' % (url, response.status,
+                                                  response.reason))
+
+
+class SegmentedDownload(object):
+    ''' Downloads an object of known size as segments fetched in
+        parallel with Range requests, spread over all replicas that
+        support them.
+
+        Each segment is written at its offset of a preallocated file
+        through its own file handle.  A segment whose replica fails is
+        retried from the next replica.  sources holds the urls that
+        served segments.
+    '''
+
+    def __init__(self, urls, size, pool, segment_size, cert_file=None,
+                 key_file=None, timeout=None):
+        self.urls = list(urls)
+        self.size = size
+        self.pool = pool
+        self.segment_size = max(segment_size, COPY_BUFFER_SIZE)
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.timeout = timeout
+        self.sources = set()
+
+    def run(self, path):
+        ''' Download into path.  Raises RangeNotSupported if no replica
+            supports Range requests, before anything is written.
+        '''
+        urls = self._probe()
+        if not urls:
+            raise RangeNotSupported(', '.join(self.urls))
+        with open(path, 'wb') as f:
+            f.truncate(self.size)
+        tasks = []
+        for (i, start) in enumerate(xrange(0, self.size, self.segment_size)):
+            end = min(start + self.segment_size, self.size) - 1
+            # start each segment on a different replica
+            k = i % len(urls)
+            tasks.append(self.pool.submit(self._fetch, path,
+                                          urls[k:] + urls[:k], start, end))
+        exc_info = None
+        for task in tasks:
+            try:
+                task.get()
+            except Exception:
+                if exc_info is None:
+                    exc_info = sys.exc_info()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _probe(self):
+        ''' Return the urls that answer a one byte Range request. '''
+        urls = []
+        for url in self.urls:
+            try:
+                response = open_range(url, 0, 0, self.cert_file,
+                                      self.key_file, self.timeout)
+                # reading the byte lets the connection be reused
+                response.read()
+                response.close()
+            except Exception:
+                continue
+            urls.append(url)
+        return urls
+
+    def _fetch(self, path, urls, start, end):
+        exc_info = None
+        for url in urls:
+            try:
+                self._fetch_from(url, path, start, end)
+                self.sources.add(url)
+                return
+            except Exception:
+                exc_info = sys.exc_info()
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _fetch_from(self, url, path, start, end):
+        response = open_range(url, start, end, self.cert_file,
+                              self.key_file, self.timeout)
+        try:
+            # Python 2 has no os.pwrite; a handle per segment does the same
+            with open(path, 'r+b') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    data = response.read(min(COPY_BUFFER_SIZE, remaining))
+                    if not data:
+                        raise Exception('Connection to %s closed %d bytes '
+                                        'early' % (url, remaining))
+                    f.write(data)
+                    remaining -= len(data)
+        finally:
+            response.close()
+
+
+class PartialDownload(object):
+    ''' Download of an object kept in a staging directory so that an
+        interrupted one can be continued.
+
+        The bytes go to <key>.part, and <key>.json records the pid,
+        size and checksum they must add up to; key is derived from the
+        checksum, so another pid with the same content continues it too.
+    '''
+
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, staging_dir, pid, size, algorithm, checksum):
+        self.pid = pid
+        self.info = {'size': size,
+                     'algorithm': algorithm,
+                     'checksum': checksum.lower()}
+        key = hashlib.sha1('%s %s' % (algorithm, checksum.lower())).hexdigest()
+        self.path = os.path.join(staging_dir, key + '.part')
+        self.info_path = os.path.join(staging_dir, key + '.json')
+        with PartialDownload._locks_lock:
+            self.lock = PartialDownload._locks.setdefault(self.path,
+                                                          threading.Lock())
+
+    def get_offset(self):
+        ''' Return the number of bytes kept from an earlier attempt. '''
+        if not os.path.exists(self.path) or \
+                not os.path.exists(self.info_path):
+            return 0
+        try:
+            with open(self.info_path, 'r') as f:
+                info = json.load(f)
+        except ValueError:
+            return 0
+        if dict((k, info.get(k)) for k in self.info) != self.info:
+            return 0
+        offset = os.path.getsize(self.path)
+        if offset > self.info['size']:
+            return 0
+        return offset
+
+    def write(self, response, offset=0):
+        ''' Write response to the part file from offset on, checking the
+            checksum as the bytes stream in.  Whatever was written is kept
+            if the download is interrupted; the file is dropped if the
+            bytes turn out to be wrong.
+        '''
+        if offset == 0:
+            info = dict(self.info, pid=self.pid)
+            with open(self.info_path, 'w') as f:
+                json.dump(info, f)
+        hasher = d1_common.util.\
+            get_checksum_calculator_by_dataone_designator(
+                self.info['algorithm'])
+        try:
+            with open(self.path, 'r+b' if offset else 'wb') as f:
+                # only the part kept from before is read back
+                remaining = offset
+                while remaining > 0:
+                    data = f.read(min(COPY_BUFFER_SIZE, remaining))
+                    if not data:
+                        break
+                    hasher.update(data)
+                    remaining -= len(data)
+                f.seek(offset)
+                f.truncate()
+                shutil.copyfileobj(VerifyingReader(response, self.pid,
+                                                   self.info['size'],
+                                                   self.info['algorithm'],
+                                                   self.info['checksum'],
+                                                   hasher, offset),
+                                   f, COPY_BUFFER_SIZE)
+        except ChecksumError:
+            self.discard()
+            raise
+
+    def finish(self, path):
+        ''' Move the download, which write verified, to path in one
+            rename, so path never holds a partial object.
+        '''
+        size = os.path.getsize(self.path)
+        if size != self.info['size']:
+            raise Exception('Download of "%s" is incomplete: %d of %d '
+                            'bytes' % (self.pid, size, self.info['size']))
+        try:
+            os.rename(self.path, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # another file system: copy next to path, then rename there
+            # so path never holds a partial file
+            (fd, tmp_path) = tempfile.mkstemp(prefix='d1obj-',
+                                              suffix='.part',
+                                              dir=os.path.dirname(
+                                                  os.path.abspath(path)))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    with open(self.path, 'rb') as part:
+                        shutil.copyfileobj(part, f, COPY_BUFFER_SIZE)
+                os.rename(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+            os.remove(self.path)
+        os.remove(self.info_path)
+
+    def discard(self):
+        for path in (self.path, self.info_path):
+            if os.path.exists(path):
+                os.remove(path)
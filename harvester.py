@@ -0,0 +1,261 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import datetime
+import json
+import sqlite3
+import threading
+
+from workers import iter_ordered
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class Inventory(object):
+    ''' Local store of the objects listed by nodes: pid, format,
+        checksum, size and dateSysMetadataModified per node, with the
+        state of the last harvest of each node.
+    '''
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS objects ('
+                         'base_url TEXT, pid TEXT, format_id TEXT, '
+                         'algorithm TEXT, checksum TEXT, size INTEGER, '
+                         'modified TEXT, PRIMARY KEY (base_url, pid))')
+            conn.execute('CREATE INDEX IF NOT EXISTS objects_modified '
+                         'ON objects (base_url, modified)')
+            conn.execute('CREATE TABLE IF NOT EXISTS harvests ('
+                         'key TEXT PRIMARY KEY, checkpoint TEXT, '
+                         'window TEXT)')
+
+    def add_records(self, base_url, records):
+        ''' Add or replace records, dicts with the keys of get. '''
+        with self._lock:
+            with self._connect() as conn:
+                conn.executemany('INSERT OR REPLACE INTO objects VALUES '
+                                 '(?, ?, ?, ?, ?, ?, ?)',
+                                 [(base_url, r['pid'], r['format_id'],
+                                   r['algorithm'], r['checksum'], r['size'],
+                                   r['modified']) for r in records])
+
+    def get(self, base_url, pid):
+        ''' Return the record of pid on the node at base_url or None. '''
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM objects WHERE base_url = ? '
+                               'AND pid = ?', (base_url, pid)).fetchone()
+        return _to_record(row) if row is not None else None
+
+    def iter_records(self, base_url, since=None):
+        ''' Iterate over the records of a node, modified after since if
+            it is given, in order of modification.
+        '''
+        sql = 'SELECT * FROM objects WHERE base_url = ?'
+        params = [base_url]
+        if since is not None:
+            sql += ' AND modified > ?'
+            params.append(_format_date(since))
+        conn = self._connect()
+        try:
+            for row in conn.execute(sql + ' ORDER BY modified', params):
+                yield _to_record(row)
+        finally:
+            conn.close()
+
+    def count(self, base_url):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM objects WHERE '
+                                'base_url = ?', (base_url,)).fetchone()[0]
+
+    def get_checkpoint(self, key):
+        ''' Return the date the last complete harvest under key (see
+            Harvester) reached, or None.
+        '''
+        with self._connect() as conn:
+            row = conn.execute('SELECT checkpoint FROM harvests WHERE '
+                               'key = ?', (key,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return datetime.datetime.strptime(row[0], DATE_FORMAT)
+
+    def get_window(self, key):
+        ''' Return the unfinished run of the harvest key or None. '''
+        with self._connect() as conn:
+            row = conn.execute('SELECT window FROM harvests WHERE '
+                               'key = ?', (key,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def set_window(self, key, window):
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute('INSERT OR IGNORE INTO harvests VALUES '
+                             '(?, NULL, NULL)', (key,))
+                conn.execute('UPDATE harvests SET window = ? WHERE '
+                             'key = ?', (json.dumps(window), key))
+
+    def finish_window(self, key, checkpoint):
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute('UPDATE harvests SET checkpoint = ?, window = '
+                             'NULL WHERE key = ?',
+                             (_format_date(checkpoint), key))
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+
+class Harvester(object):
+    ''' Incremental copy of a node's object list to an Inventory.
+
+        Each run lists the objects modified between the checkpoint of
+        the previous run (less overlap seconds, for clock skew) and the
+        time it starts, fetching up to concurrency pages at once with
+        get_client giving each thread its own client.  Pages are stored
+        as they arrive and the window and finished pages are saved, so
+        an interrupted run is resumed by the next one; the checkpoint
+        only moves once the whole window is stored.  An object modified
+        during a run leaves its window and is listed by the next run;
+        as this shifts the offsets of the objects after it, pages are
+        listed again until the window holds as many objects at the end
+        of a pass as at its start.  After max_passes passes the window is
+        kept and an exception raised, so a later run lists it again.
+    '''
+
+    def __init__(self, client, inventory, pool=None, page_size=1000,
+                 concurrency=4, overlap=300, format_id=None,
+                 get_client=None, callback=None, max_passes=3):
+        self.client = client
+        self.base_url = client.base_url
+        self.inventory = inventory
+        self.pool = pool
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.overlap = overlap
+        self.format_id = format_id
+        # harvests of one format have their own checkpoint
+        self.key = self.base_url if format_id is None else \
+            '%s %s' % (self.base_url, format_id)
+        self.get_client = get_client
+        self.callback = callback
+        self.max_passes = max_passes
+
+    def run(self, now=None):
+        ''' Harvest the node and return the number of objects stored. '''
+        window = self.inventory.get_window(self.key)
+        if window is None:
+            if now is None:
+                now = datetime.datetime.utcnow()
+            from_date = self.inventory.get_checkpoint(self.key)
+            if from_date is not None:
+                from_date -= datetime.timedelta(seconds=self.overlap)
+            window = {'from_date': _format_date(from_date),
+                      'to_date': _format_date(now),
+                      'page_size': None,
+                      'done': []}
+        from_date = _parse_date(window['from_date'])
+        to_date = _parse_date(window['to_date'])
+
+        if window['page_size'] is None:
+            object_list = self._list(self.client, from_date, to_date, 0,
+                                     self.page_size)
+            # nodes may return fewer objects per page than asked for
+            window['page_size'] = max(int(object_list.count), 1) \
+                if int(object_list.total) > int(object_list.count) \
+                else self.page_size
+            window['total'] = int(object_list.total)
+            # pids stored by this run, as passes list objects again
+            stored = set(self._store(object_list))
+            window['done'].append(0)
+            self.inventory.set_window(self.key, window)
+        else:
+            stored = set()
+
+        passes = 0
+        while True:
+            passes += 1
+            done = set(window['done'])
+            starts = [start for start in xrange(0, window['total'],
+                                                window['page_size'])
+                      if start not in done]
+            list_page = lambda start: self._list_page(
+                from_date, to_date, start, window['page_size'])
+            for (start, object_list) in iter_ordered(self.pool, list_page,
+                                                     starts,
+                                                     self.concurrency):
+                stored.update(self._store(object_list))
+                window['done'].append(start)
+                self.inventory.set_window(self.key, window)
+            # objects only leave the window, so an unchanged total means
+            # no page was shifted past an object
+            total = int(self._list(self.client, from_date, to_date, 0,
+                                   0).total)
+            if total == window['total']:
+                break
+            window['total'] = total
+            window['done'] = []
+            self.inventory.set_window(self.key, window)
+            if passes >= self.max_passes:
+                raise Exception('The objects of %s kept changing during '
+                                'the harvest; harvest again later' %
+                                self.base_url)
+        self.inventory.finish_window(self.key, to_date)
+        return len(stored)
+
+    def _list_page(self, from_date, to_date, start, page_size):
+        client = self.client
+        if self.get_client is not None:
+            client = self.get_client(client)
+        return self._list(client, from_date, to_date, start, page_size)
+
+    def _list(self, client, from_date, to_date, start, count):
+        return client.listObjects(fromDate=from_date, toDate=to_date,
+                                  formatId=self.format_id, start=start,
+                                  count=count)
+
+    def _store(self, object_list):
+        ''' Store the records of object_list and return their pids. '''
+        records = [get_record(info) for info in
+                   (object_list.objectInfo or [])]
+        self.inventory.add_records(self.base_url, records)
+        if self.callback is not None:
+            self.callback(records)
+        return [r['pid'] for r in records]
+
+
+def get_record(object_info):
+    ''' Return the inventory record of a pyxb ObjectInfo. '''
+    return {'pid': object_info.identifier.value(),
+            'format_id': str(object_info.formatId),
+            'algorithm': str(object_info.checksum.algorithm),
+            'checksum': str(object_info.checksum.value()).lower(),
+            'size': int(object_info.size),
+            'modified': _format_date(object_info.dateSysMetadataModified)}
+
+
+def _to_record(row):
+    return {'pid': row[1],
+            'format_id': row[2],
+            'algorithm': row[3],
+            'checksum': row[4],
+            'size': row[5],
+            'modified': row[6]}
+
+def _format_date(date):
+    if date is None or isinstance(date, basestring):
+        return date
+    if date.tzinfo is not None:
+        date = (date - date.utcoffset()).replace(tzinfo=None)
+    return date.strftime(DATE_FORMAT)
+
+def _parse_date(value):
+    if value is None:
+        return None
+    return datetime.datetime.strptime(value, DATE_FORMAT)
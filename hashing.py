@@ -0,0 +1,120 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import mmap
+import os
+import sys
+import tempfile
+import time
+
+import d1_common.util
+
+# DataONE checksum algorithms that can be computed in one pass
+DATAONE_ALGORITHMS = ('MD5', 'SHA-1', 'SHA-256')
+BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def get_file_checksums(path, algorithms, buffer_size=BUFFER_SIZE,
+                       use_mmap=True):
+    ''' Read path once and return (size, {algorithm: hexdigest}) for each
+        of the given DataONE checksum algorithms.
+
+        The size comes from fstat.  The data is hashed through a read-only
+        memory map or, if that is not possible, through one reusable
+        buffer of buffer_size bytes.
+    '''
+    if isinstance(algorithms, basestring):
+        algorithms = [algorithms]
+    hashers = [(algorithm,
+                d1_common.util.get_checksum_calculator_by_dataone_designator(
+                    algorithm))
+               for algorithm in algorithms]
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        for chunk in _iter_chunks(f, size, buffer_size, use_mmap):
+            for (_, h) in hashers:
+                h.update(chunk)
+    return (size, dict((algorithm, h.hexdigest())
+                       for (algorithm, h) in hashers))
+
+def get_file_checksum(path, algorithm, buffer_size=BUFFER_SIZE):
+    return get_file_checksums(path, [algorithm], buffer_size)[1][algorithm]
+
+def _iter_chunks(f, size, buffer_size, use_mmap):
+    if use_mmap and size > 0:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError, OverflowError):
+            # e.g. special files or a 32-bit address space
+            mapped = None
+        if mapped is not None:
+            try:
+                for offset in xrange(0, size, buffer_size):
+                    yield buffer(mapped, offset, buffer_size)
+            finally:
+                mapped.close()
+            return
+    data = bytearray(buffer_size)
+    view = memoryview(data)
+    while True:
+        n = f.readinto(data)
+        if not n:
+            break
+        yield view[:n]
+
+
+def run_checksum_benchmark(path=None, size=256 * 1024 * 1024,
+                           algorithms=DATAONE_ALGORITHMS):
+    ''' Compare the old two-pass checksum + size code with the single-pass
+        engine, on path or on a temporary file of size bytes.
+    '''
+    created = False
+    if path is None:
+        (fd, path) = tempfile.mkstemp(prefix='d1bench-', suffix='.dat')
+        with os.fdopen(fd, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in xrange(size // len(block)):
+                f.write(block)
+        created = True
+    try:
+        def old_path():
+            # what create_sysmeta_from_path used to do, once per algorithm
+            for algorithm in algorithms:
+                h = d1_common.util.\
+                    get_checksum_calculator_by_dataone_designator(algorithm)
+                with open(path, 'r') as f:
+                    while True:
+                        data = f.read(1024 * 1024)
+                        if not data:
+                            break
+                        h.update(data)
+                h.hexdigest()
+                with open(path, 'r') as f:
+                    f.seek(0, os.SEEK_END)
+                    f.tell()
+
+        runs = [('old (read 1 MiB, per algorithm)', old_path),
+                ('mmap, one pass',
+                 lambda: get_file_checksums(path, algorithms)),
+                ('readinto buffer, one pass',
+                 lambda: get_file_checksums(path, algorithms,
+                                            use_mmap=False))]
+        file_size = os.path.getsize(path)
+        print 'File: %s (%d bytes), algorithms: %s' % \
+            (path, file_size, ', '.join(algorithms))
+        for (name, fn) in runs:
+            start = time.time()
+            fn()
+            elapsed = time.time() - start
+            print '  %-35s %8.3fs %10.1f MiB/s' % \
+                (name, elapsed, file_size / (1024.0 * 1024) / max(elapsed, 1e-9))
+    finally:
+        if created:
+            os.remove(path)
+
+if __name__ == '__main__':
+    run_checksum_benchmark(*sys.argv[1:2])
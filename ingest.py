@@ -0,0 +1,466 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import argparse
+import fnmatch
+import mimetypes
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+import time
+
+from config import configuration
+from transfer import TransferError
+import utils
+from workers import wait_until
+
+# pids start with the name of the ingested directory so that two
+# directories with the same layout don't map to the same objects
+DEFAULT_PID_TEMPLATE = '{root}/{path}'
+# DataONE format ids that are not the file's MIME type
+FORMAT_IDS = {'.nc': 'netCDF-3',
+              '.csv': 'text/csv',
+              '.xml': 'text/xml'}
+# stage names, in pipeline order
+STAGES = ['hash', 'sysmeta', 'check', 'upload']
+
+
+class IngestRule(object):
+    ''' Maps the files whose path, relative to the ingested directory,
+        or name matches the glob pattern to a format id and a pid.
+
+        pid_template is formatted with root (the name of the ingested
+        directory), path (the relative path with / separators), dir,
+        name, stem and ext (without the dot).  A rule
+        with exclude set leaves the matching files out.
+    '''
+
+    def __init__(self, pattern, format_id=None, pid_template=None,
+                 exclude=False):
+        self.pattern = pattern
+        self.format_id = format_id
+        self.pid_template = pid_template
+        self.exclude = exclude
+
+    def matches(self, rel_path):
+        return fnmatch.fnmatch(rel_path, self.pattern) or \
+            ('/' not in self.pattern and
+             fnmatch.fnmatch(rel_path.rsplit('/', 1)[-1], self.pattern))
+
+
+def map_file(root, rel_path, rules, pid_template=DEFAULT_PID_TEMPLATE,
+             format_id=None):
+    ''' Return (pid, format id) for the file at rel_path under the
+        directory named root from the first rules that give them, or
+        None if the file is excluded.  Without a rule, the format is
+        format_id or guessed from the extension.
+    '''
+    (rule_format, rule_template) = (None, None)
+    for rule in rules:
+        if not rule.matches(rel_path):
+            continue
+        if rule.exclude:
+            return None
+        if rule_format is None:
+            rule_format = rule.format_id
+        if rule_template is None:
+            rule_template = rule.pid_template
+    (dir_name, name) = os.path.split(rel_path.replace('/', os.sep))
+    (stem, ext) = os.path.splitext(name)
+    pid = (rule_template or pid_template).format(
+        root=root, path=rel_path, dir=dir_name.replace(os.sep, '/'), name=name,
+        stem=stem, ext=ext[1:])
+    # identifiers may not contain whitespace
+    pid = '_'.join(pid.split())
+    return (pid, rule_format or format_id or guess_format_id(name))
+
+def guess_format_id(name):
+    ext = os.path.splitext(name)[1].lower()
+    if ext in FORMAT_IDS:
+        return FORMAT_IDS[ext]
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+class IngestItem(object):
+    def __init__(self, path, rel_path, pid, format_id):
+        self.path = path
+        self.rel_path = rel_path
+        self.pid = pid
+        self.format_id = format_id
+        self.size = None
+        self.checksum = None
+        self.sysmeta = None
+        self.curr_sysmeta = None
+        self.action = None
+
+
+class IngestStats(object):
+    ''' Counts of the files through each stage of an ingest, with the
+        bytes and time spent, for progress reports.
+    '''
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.found = 0
+        self.walk_done = False
+        self.completed = dict((stage, 0) for stage in STAGES)
+        self.bytes = dict((stage, 0) for stage in STAGES)
+        self.busy_time = dict((stage, 0.0) for stage in STAGES)
+        self.actions = {}
+        self.failures = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, item, seconds):
+        with self._lock:
+            self.completed[stage] += 1
+            self.bytes[stage] += item.size or 0
+            self.busy_time[stage] += seconds
+            if stage == 'upload':
+                self.actions[item.action] = \
+                    self.actions.get(item.action, 0) + 1
+
+    def add_failure(self, item, e):
+        with self._lock:
+            self.failures[item.rel_path] = e
+
+    def get_finished(self):
+        return self.completed['upload'] + len(self.failures)
+
+    def get_rate(self, stage):
+        ''' Return (files, bytes) per second through stage. '''
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return (self.completed[stage] / elapsed,
+                self.bytes[stage] / elapsed)
+
+    def format(self):
+        ''' Return a one-line report; busy is the time the threads of
+            each stage spent on files, which shows the slowest stage.
+        '''
+        total = str(self.found) if self.walk_done else '%d+' % self.found
+        (files_rate, bytes_rate) = self.get_rate('upload')
+        (_, hash_rate) = self.get_rate('hash')
+        return '%d/%s files (%s), %d failed, %.1f files/s, ' \
+            'upload %.1f MB/s, hash %.1f MB/s, busy %s' % \
+            (self.get_finished(), total,
+             ', '.join('%d %s' % (n, action) for (action, n)
+                       in sorted(self.actions.iteritems())) or 'none saved',
+             len(self.failures), files_rate, bytes_rate / 1024.0 ** 2,
+             hash_rate / 1024.0 ** 2,
+             ' '.join('%s %.1fs' % (stage, self.busy_time[stage])
+                      for stage in STAGES))
+
+
+class DirectoryIngest(object):
+    ''' Saves every file under a directory as an object on a member
+        node.
+
+        Files go through a pipeline of stages, each with its own
+        threads, connected by queues of at most queue_size files, so
+        hashing, checking and uploading overlap with a bounded number of
+        files in flight, however many the directory holds: hash
+        (size and checksum, from the checksum cache when possible),
+        sysmeta, check (whether the pid exists, with the same content)
+        and upload (create, or with update a new version that obsoletes
+        a changed object).  Files that exist with the same content are
+        skipped.  A file whose pid can't be formatted or was given to an
+        earlier file, or a directory that can't be read, fails without
+        entering the pipeline; a file that fails leaves the pipeline.
+        Failures are reported at the end, and
+        progress(name, status, info, completed, total) is called like
+        TransferScheduler's as each file finishes, with total None while
+        the directory is still being walked.
+    '''
+
+    def __init__(self, root, mn_client, cn_client, rules=(),
+                 pid_template=DEFAULT_PID_TEMPLATE, sysmeta_kwargs=None,
+                 update=False, dry_run=False, queue_size=100, workers=None,
+                 progress=None):
+        self.root = os.path.abspath(utils.expand_path(root))
+        self.mn_client = mn_client
+        self.cn_client = cn_client
+        self.rules = list(rules)
+        self.pid_template = pid_template
+        self.sysmeta_kwargs = dict(sysmeta_kwargs or {})
+        self.format_id = self.sysmeta_kwargs.pop('format_id', None)
+        self.algorithm = self.sysmeta_kwargs.pop('algorithm', None) or \
+            configuration.checksum_alg
+        self.update = update
+        self.dry_run = dry_run
+        self.queue_size = queue_size
+        self.workers = {'hash': configuration.hash_workers or
+                        multiprocessing.cpu_count(),
+                        'sysmeta': 1,
+                        'check': configuration.transfer_workers,
+                        'upload': configuration.transfer_per_node}
+        if workers:
+            self.workers.update(workers)
+        self._client_lock = None
+        if not utils.can_share_clients(mn_client, cn_client):
+            self.workers['check'] = self.workers['upload'] = 1
+            self._client_lock = threading.Lock()
+        self.progress = progress
+        self.stats = IngestStats()
+        self.results = {}
+        # threads of the walk and of each stage that have exited
+        self._exited = [0] * (len(STAGES) + 1)
+        self._lock = threading.Lock()
+
+    def run(self):
+        ''' Ingest the directory and return the pids by relative path.
+            Raises TransferError if any file failed.
+        '''
+        queues = [Queue.Queue(self.queue_size) for _ in STAGES] + [None]
+        threads = []
+        for (i, stage) in enumerate(STAGES):
+            fn = getattr(self, '_' + stage)
+            if stage in ('check', 'upload') and \
+                    self._client_lock is not None:
+                fn = self._with_client_lock(fn)
+            for _ in xrange(self.workers[stage]):
+                threads.append(self._start_thread(self._work, stage, fn,
+                                                  queues[i], queues[i + 1]))
+        self._walk(queues[0])
+        for thread in threads:
+            wait_until(lambda: not thread.is_alive(), thread.join)
+        if self.stats.failures:
+            raise TransferError(dict(self.stats.failures),
+                                dict(self.results))
+        return dict(self.results)
+
+    def _with_client_lock(self, fn):
+        def locked(item):
+            with self._client_lock:
+                return fn(item)
+        return locked
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _walk(self, out_queue):
+        root = os.path.basename(self.root)
+        # pid -> relative path of the file it was given to
+        pids = {}
+        try:
+            for (dir_path, dir_names, file_names) in os.walk(
+                    self.root, onerror=self._walk_error):
+                dir_names.sort()
+                for name in sorted(file_names):
+                    path = os.path.join(dir_path, name)
+                    rel_path = self._get_rel_path(path)
+                    try:
+                        mapped = map_file(root, rel_path, self.rules,
+                                          self.pid_template, self.format_id)
+                    except Exception as e:
+                        self._fail(IngestItem(path, rel_path, None, None),
+                                   Exception('Cannot format the pid of '
+                                             '"%s": %s' % (rel_path, e)))
+                        continue
+                    if mapped is None:
+                        continue
+                    item = IngestItem(path, rel_path, *mapped)
+                    if item.pid in pids:
+                        self._fail(item, Exception(
+                                'pid "%s" of "%s" is also the pid of "%s"' %
+                                (item.pid, rel_path, pids[item.pid])))
+                        continue
+                    pids[item.pid] = rel_path
+                    self.stats.found += 1
+                    out_queue.put(item)
+        finally:
+            self.stats.walk_done = True
+            self._finish_stage(0, out_queue)
+
+    def _walk_error(self, e):
+        path = e.filename or self.root
+        self._fail(IngestItem(path, self._get_rel_path(path), None, None), e)
+
+    def _get_rel_path(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def _fail(self, item, e):
+        ''' Record a file (or directory) that fails before the pipeline. '''
+        self.stats.found += 1
+        self.stats.add_failure(item, e)
+        self._report(item, 'failed', e)
+
+    def _work(self, stage, fn, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            start = time.time()
+            try:
+                fn(item)
+            except Exception as e:
+                self.stats.add_failure(item, e)
+                self._report(item, 'failed', e)
+                continue
+            self.stats.add(stage, item, time.time() - start)
+            if out_queue is not None:
+                out_queue.put(item)
+            else:
+                self.results[item.rel_path] = item.pid
+                self._report(item, 'done', item.action)
+        self._finish_stage(STAGES.index(stage) + 1, out_queue)
+
+    def _finish_stage(self, next_index, out_queue):
+        ''' Called as each thread of a stage (or the walk) exits; the
+            last one tells the threads of the next stage to stop.
+        '''
+        with self._lock:
+            self._exited[next_index] += 1
+            exited = self._exited[next_index]
+        workers = 1 if next_index == 0 else \
+            self.workers[STAGES[next_index - 1]]
+        if exited == workers and out_queue is not None:
+            for _ in xrange(self.workers[STAGES[next_index]]):
+                out_queue.put(None)
+
+    def _report(self, item, status, info):
+        if self.progress is None:
+            return
+        try:
+            self.progress(item.pid or item.rel_path, status, info,
+                          self.stats.get_finished(),
+                          self.stats.found if self.stats.walk_done else None)
+        except Exception:
+            pass
+
+    def _hash(self, item):
+        (item.size, checksums) = utils.get_file_checksums(item.path,
+                                                          [self.algorithm])
+        item.checksum = checksums[self.algorithm]
+
+    def _sysmeta(self, item):
+        item.sysmeta = utils.create_system_metadata(item.pid, item.size,
+                                                    item.checksum,
+                                                    self.algorithm,
+                                                    item.format_id,
+                                                    **self.sysmeta_kwargs)
+
+    def _check(self, item):
+        item.curr_sysmeta = utils.get_sysmeta_by_pid(
+            item.pid, True, utils.get_thread_client(self.cn_client),
+            utils.get_thread_client(self.mn_client))
+        if item.curr_sysmeta is None:
+            item.action = 'created'
+        elif configuration.dedup_mode != 'off' and \
+                utils.has_same_content(item.path, item.sysmeta,
+                                       item.curr_sysmeta):
+            item.action = 'unchanged'
+        elif self.update:
+            item.action = 'updated'
+        else:
+            raise Exception('"%s" exists with other content' % item.pid)
+
+    def _upload(self, item):
+        if self.dry_run or item.action == 'unchanged':
+            return
+        mn_client = utils.get_thread_client(self.mn_client)
+        if item.action == 'created':
+            utils.create_object(mn_client, item.pid, item.path, item.sysmeta)
+            utils.sysmeta_cache.invalidate(item.pid)
+            return
+        # the new version obsoletes the head of the existing chain
+        previous_pid = item.curr_sysmeta.identifier.value()
+        new_pid = utils.generate_identifier(mn_client)
+        item.sysmeta.identifier = new_pid
+        item.sysmeta.obsoletes = previous_pid
+        utils.update_object(mn_client, previous_pid, item.path, new_pid,
+                            item.sysmeta)
+        utils.record_obsoletes(previous_pid, new_pid)
+        item.pid = new_pid
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Save every file under a directory to a DataONE '
+        'member node.')
+    parser.add_argument('directory')
+    parser.add_argument('--mn-url', help='member node base URL')
+    parser.add_argument('--cn-url', help='coordinating node base URL')
+    parser.add_argument('--cert-file', help='client certificate')
+    parser.add_argument('--key-file', help='client certificate key')
+    parser.add_argument('--rule', nargs=2, action='append', default=[],
+                        metavar=('PATTERN', 'FORMAT_ID'),
+                        help='format id of the files matching a glob '
+                        'pattern; the first matching rule wins')
+    parser.add_argument('--pid-rule', nargs=2, action='append', default=[],
+                        metavar=('PATTERN', 'TEMPLATE'),
+                        help='pid template for the files matching a glob '
+                        'pattern')
+    parser.add_argument('--exclude', action='append', default=[],
+                        metavar='PATTERN', help='skip matching files')
+    parser.add_argument('--pid-template', default=DEFAULT_PID_TEMPLATE,
+                        help='pid of files without a pid rule, formatted '
+                        'with {root} (the name of the directory), {path}, '
+                        '{dir}, {name}, {stem} and {ext} '
+                        '(default: %(default)s)')
+    parser.add_argument('--format-id',
+                        help='format id of files without a rule (default: '
+                        'guessed from the extension)')
+    parser.add_argument('--submitter')
+    parser.add_argument('--owner')
+    parser.add_argument('--update', action='store_true',
+                        help='save changed files as new versions of '
+                        'existing objects')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='hash and check the files but upload nothing')
+    parser.add_argument('--queue-size', type=int, default=100)
+    for stage in STAGES:
+        parser.add_argument('--%s-workers' % stage, type=int)
+    parser.add_argument('--report-interval', type=float, default=10.0,
+                        help='seconds between progress reports')
+    args = parser.parse_args(argv)
+
+    if args.cn_url:
+        configuration.cn_url = args.cn_url
+    mn_client = utils.get_d1_mn_client(args.mn_url, args.cert_file,
+                                       args.key_file)
+    cn_client = utils.get_d1_cn_client(args.cn_url)
+    rules = [IngestRule(pattern, exclude=True) for pattern in args.exclude]
+    rules += [IngestRule(pattern, format_id)
+              for (pattern, format_id) in args.rule]
+    rules += [IngestRule(pattern, pid_template=template)
+              for (pattern, template) in args.pid_rule]
+    sysmeta_kwargs = {'format_id': args.format_id,
+                      'submitter': args.submitter,
+                      'owner': args.owner,
+                      'orig_mn': mn_client.base_url,
+                      'auth_mn': mn_client.base_url}
+    workers = dict((stage, getattr(args, '%s_workers' % stage))
+                   for stage in STAGES
+                   if getattr(args, '%s_workers' % stage))
+
+    last_report = [time.time()]
+    def progress(name, status, info, completed, total):
+        if status == 'failed':
+            sys.stderr.write('failed: %s: %s\n' %
+                             (name, str(info).split('\n')[0]))
+        if time.time() - last_report[0] >= args.report_interval:
+            last_report[0] = time.time()
+            sys.stderr.write(ingest.stats.format() + '\n')
+
+    ingest = DirectoryIngest(args.directory, mn_client, cn_client, rules,
+                             args.pid_template, sysmeta_kwargs, args.update,
+                             args.dry_run, args.queue_size, workers,
+                             progress)
+    try:
+        ingest.run()
+    except TransferError as e:
+        sys.stderr.write('%s\n%s\n' % (ingest.stats.format(), e))
+        return 1
+    sys.stderr.write(ingest.stats.format() + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,6 +9,8 @@ import datetime
 import os
 import shutil
 from StringIO import StringIO
+import threading
+import time
 import urllib
 
 from core.modules.basic_modules import String, new_constant
@@ -21,9 +23,12 @@ from d1_client.mnclient import MemberNodeClient
 from d1_client.cnclient import CoordinatingNodeClient
 
 from access_control import access_control
+from config import configuration
 from replication_policy import replication_policy
 from data_package import DataPackage
 import identifiers
+from ingest import DirectoryIngest, IngestRule, DEFAULT_PID_TEMPLATE
+from transfer import TransferError
 import utils
 
 
@@ -178,7 +183,7 @@ class D1SystemMetadata(Module):
                 "format_id": self.format,
                 "submitter": self.submitter,
                 "owner": self.owner,
-                "origin_mn": self.origin_mn,
+                "orig_mn": self.origin_mn,
                 "auth_mn": self.auth_mn,
                 "algorithm": self.checksum}
 
@@ -245,8 +250,14 @@ class D1PutObject(Module):
                     ("systemMetadata", "(%s:D1SystemMetadata)" % \
                          identifiers.identifier),
                     ("updateIfExists", 
-                     "(edu.utah.sci.vistrails.basic:Boolean)", True)
+                     "(edu.utah.sci.vistrails.basic:Boolean)", True),
+                    ("skipIfUnchanged",
+                     "(edu.utah.sci.vistrails.basic:Boolean)", True),
+                    ("newIdentifier", "(%s:D1Identifier)" % \
+                         identifiers.identifier, True)
                     ]
+    _output_ports = [("identifier", "(%s:D1Identifier)" % \
+                          identifiers.identifier)]
     
     def create_object(self, pid, mn_client, cn_client):
         raise ModuleError(self, "A subclass of D1PutObject must define " \
@@ -256,6 +267,21 @@ class D1PutObject(Module):
         raise ModuleError(self, "A subclass of D1PutObject must define " \
                               "the update_object method")
 
+    def skip_unchanged(self, pid, mn_client, curr_sysmeta):
+        """skip_unchanged returns True if the existing object already
+        has the local content, so update_object need not be called"""
+        return False
+
+    def get_new_identifier(self, mn_client):
+        if self.hasInputFromPort("newIdentifier"):
+            return self.getInputFromPort("newIdentifier")
+        return utils.generate_identifier(mn_client)
+
+    def get_sysmeta_kwargs(self):
+        if self.hasInputFromPort("systemMetadata"):
+            return self.getInputFromPort("systemMetadata").to_dict()
+        return {}
+
     def compute(self, pid):
         cert_file = None
         key_file = None
@@ -274,13 +300,22 @@ class D1PutObject(Module):
         cn_client = utils.get_d1_cn_client(cn_url=cn_url)
         
         # if it already exists
-        if utils.get_sysmeta_by_pid(pid, True, cn_client, mn_client):
+        curr_sysmeta = utils.get_sysmeta_by_pid(pid, True, cn_client, 
+                                                mn_client)
+        if curr_sysmeta:
             if not self.forceGetInputFromPort("updateIfExists", False):
                 raise ModuleError(self, 'Cannot add data: ' \
-                                      'identifer "%s" already exists.')
-            else:
-                self.update_object(pid, mn_client, cn_client)
-        self.create_object(pid, mn_client, cn_client)
+                                      'identifer "%s" already exists.' % pid)
+            skip = self.forceGetInputFromPort("skipIfUnchanged", 
+                                              configuration.dedup_mode != "off")
+            # updates obsolete the newest version of pid
+            pid = curr_sysmeta.identifier.value()
+            if not (skip and 
+                    self.skip_unchanged(pid, mn_client, curr_sysmeta)):
+                pid = self.update_object(pid, mn_client, cn_client) or pid
+        else:
+            self.create_object(pid, mn_client, cn_client)
+        self.setResult("identifier", pid)
 
 class D1PutData(D1PutObject):
     _input_ports = [("identifier", "(%s:D1Identifier)" % \
@@ -289,20 +324,38 @@ class D1PutData(D1PutObject):
 
     def create_object(self, pid, mn_client, cn_client):
         obj = self.getInputFromPort("inputFile")
-        if self.hasInputFromPort("systemMetadata"):
-            local_sysmeta = self.getInputFromPort("systemMetadata")
-            sysmeta_kwargs = local_sysmeta.to_dict()
-        else:
-            sysmeta_kwargs = {}
         sysmeta = utils.create_sysmeta_from_path(pid, obj.name, 
-                                                 **sysmeta_kwargs)
+                                                 **self.get_sysmeta_kwargs())
 
-        f = open(obj.name, 'r')
-        retval = mn_client.create(pid, f, sysmeta)
-        f.close()
+        utils.create_object(mn_client, pid, obj.name, sysmeta)
+        utils.sysmeta_cache.invalidate(pid)
 
     def update_object(self, pid, mn_client, cn_client):
-        raise ModuleError("Update is not implemented yet.")
+        """update_object saves the input file under a new identifier
+        that obsoletes pid and returns the new identifier"""
+        obj = self.getInputFromPort("inputFile")
+        new_pid = self.get_new_identifier(mn_client)
+        sysmeta = utils.create_sysmeta_from_path(new_pid, obj.name, 
+                                                 **self.get_sysmeta_kwargs())
+        sysmeta.obsoletes = pid
+
+        utils.update_object(mn_client, pid, obj.name, new_pid, sysmeta)
+        utils.record_obsoletes(pid, new_pid)
+        return new_pid
+
+    def skip_unchanged(self, pid, mn_client, curr_sysmeta):
+        obj = self.getInputFromPort("inputFile")
+        if not utils.has_same_content(obj.name, None, curr_sysmeta):
+            return False
+        if configuration.dedup_mode == "sysmeta" and \
+                self.hasInputFromPort("systemMetadata"):
+            sysmeta = utils.create_sysmeta_from_path(pid, obj.name, 
+                                                     **self.get_sysmeta_kwargs())
+            if not utils.update_sysmeta_only(mn_client, pid, sysmeta,
+                                             curr_sysmeta):
+                self.annotate({"sysmeta": "not updated: the client does "
+                               "not support updateSystemMetadata"})
+        return True
 
     def compute(self):
         pid = self.getInputFromPort("identifier")
@@ -351,15 +404,12 @@ class D1PutPackage(D1PutObject):
                          identifiers.identifier),
                     ]
 
-    def create_object(self, pid, mn_client, cn_client):
+    def build_package(self, pid):
+        """build_package returns the DataPackage for the input package
+        under pid and the keyword arguments for its system metadata"""
         local_pkg = self.getInputFromPort("package")
-        pkg = DataPackage(pid)
-
-        if self.hasInputFromPort("systemMetadata"):
-            local_sysmeta = self.getInputFromPort("systemMetadata")
-            sysmeta_kwargs = local_sysmeta.to_dict()
-        else:
-            sysmeta_kwargs = {}
+        pkg = DataPackage(pid, deferred=True)
+        sysmeta_kwargs = self.get_sysmeta_kwargs()
 
         sysmeta_kwargs["format_id"] = local_pkg.meta.format_id
         pkg.scimeta_add(local_pkg.meta.identifier, local_pkg.meta.filename,
@@ -368,15 +418,113 @@ class D1PutPackage(D1PutObject):
             sysmeta_kwargs["format_id"] = obj.format_id
             pkg.scidata_add(obj.identifier, obj.filename, **sysmeta_kwargs)
         del sysmeta_kwargs["format_id"]
+        return (pkg, sysmeta_kwargs)
+
+    def create_object(self, pid, mn_client, cn_client):
+        (pkg, sysmeta_kwargs) = self.build_package(pid)
         pkg.save(mn_client, cn_client, **sysmeta_kwargs)
         
     def update_object(self, pid, mn_client, cn_client):
-        raise ModuleError("Update is not implemented yet.")
+        """update_object compares the input package with the package pid
+        and saves a new revision with only the new or changed members;
+        returns the new identifier or pid if nothing changed"""
+        previous = DataPackage(pid)
+        previous.load(lazy=True)
+        # without newIdentifier, save_revision only reserves an identifier
+        # on the node once it knows something changed
+        (pkg, sysmeta_kwargs) = \
+            self.build_package(self.forceGetInputFromPort("newIdentifier"))
+        if pkg.save_revision(previous, mn_client, cn_client, 
+                             **sysmeta_kwargs) is None:
+            return pid
+        return pkg.pid
 
     def compute(self):
         local_pkg = self.getInputFromPort("package")
         D1PutObject.compute(self, local_pkg.identifier)
 
+class D1PutDirectory(Module):
+    _input_ports = [("directory", "(edu.utah.sci.vistrails.basic:Directory)"),
+                    ("memberNodeURL", "(edu.utah.sci.vistrails.basic:String)"),
+                    ("coordinatingNodeURL", 
+                     "(edu.utah.sci.vistrails.basic:String)"),
+                    ("authentication", "(%s:D1Authentication)" % \
+                         identifiers.identifier),
+                    ("systemMetadata", "(%s:D1SystemMetadata)" % \
+                         identifiers.identifier),
+                    ("formatRule", 
+                     "(edu.utah.sci.vistrails.basic:String,"
+                     "edu.utah.sci.vistrails.basic:String)", True),
+                    ("pidRule", 
+                     "(edu.utah.sci.vistrails.basic:String,"
+                     "edu.utah.sci.vistrails.basic:String)", True),
+                    ("exclude", "(edu.utah.sci.vistrails.basic:String)", True),
+                    ("pidTemplate", "(edu.utah.sci.vistrails.basic:String)",
+                     True),
+                    ("updateIfExists", 
+                     "(edu.utah.sci.vistrails.basic:Boolean)", True)]
+    _output_ports = [("identifierList", "(edu.utah.sci.vistrails.basic:List)")]
+
+    def get_rules(self):
+        """get_rules returns the IngestRules from the exclude, formatRule
+        and pidRule ports, exclusions first"""
+        rules = [IngestRule(pattern, exclude=True) for pattern in 
+                 self.forceGetInputListFromPort("exclude")]
+        rules.extend(IngestRule(pattern, format_id) for (pattern, format_id)
+                     in self.forceGetInputListFromPort("formatRule"))
+        rules.extend(IngestRule(pattern, pid_template=template)
+                     for (pattern, template) in
+                     self.forceGetInputListFromPort("pidRule"))
+        return rules
+
+    def compute(self):
+        cert_file = None
+        key_file = None
+        cn_url = get_cn_url(self)
+        mn_url = get_mn_url(self)
+        if self.hasInputFromPort("authentication"):
+            auth = self.getInputFromPort("authentication")
+            cert_file = auth.cert_file
+            key_file = auth.key_file
+        self.annotate({"cn_url": cn_url, "mn_url": mn_url})
+        mn_client = utils.get_d1_mn_client(mn_url=mn_url, cert_file=cert_file, 
+                                           key_file=key_file)
+        cn_client = utils.get_d1_cn_client(cn_url=cn_url)
+
+        sysmeta_kwargs = {}
+        if self.hasInputFromPort("systemMetadata"):
+            sysmeta_kwargs = self.getInputFromPort("systemMetadata").to_dict()
+        # the ingest's worker threads call progress, and annotate is not
+        # thread-safe; this thread is blocked in run meanwhile
+        progress_lock = threading.Lock()
+        last_report = [time.time()]
+        def progress(name, status, info, completed, total):
+            # annotate while the ingest runs, not only once it returns
+            with progress_lock:
+                if status == 'failed':
+                    self.annotate({"failed %s" % name:
+                                       str(info).split('\n')[0]})
+                if time.time() - last_report[0] >= 10.0:
+                    last_report[0] = time.time()
+                    self.annotate({"ingest": ingest.stats.format()})
+
+        ingest = DirectoryIngest(self.getInputFromPort("directory").name,
+                                 mn_client, cn_client, self.get_rules(),
+                                 self.forceGetInputFromPort(
+                                     "pidTemplate", DEFAULT_PID_TEMPLATE),
+                                 sysmeta_kwargs,
+                                 self.forceGetInputFromPort("updateIfExists",
+                                                            False),
+                                 progress=progress)
+        try:
+            results = ingest.run()
+        except TransferError as e:
+            raise ModuleError(self, str(e))
+        finally:
+            self.annotate({"ingest": ingest.stats.format()})
+        self.setResult("identifierList", 
+                       [results[rel_path] for rel_path in sorted(results)])
+
 class D1GetPackage(Module):
     _input_ports = [("identifier", "(%s:D1Identifier)" % \
                          identifiers.identifier),
@@ -394,7 +542,7 @@ class D1GetPackage(Module):
 # http://mule1.dataone.org/ArchitectureDocs-current/design/SearchMetadata.html
 
 class D1Search(Module):
-    _input_ports = [("LTERSite", "(edu.utah.sci.vistrails.basic:String)", True, {"docstring": "Data provider organization identifier, for sources within the LTER network."}),
+    _search_ports = [("LTERSite", "(edu.utah.sci.vistrails.basic:String)", True, {"docstring": "Data provider organization identifier, for sources within the LTER network."}),
 ("abstract", "(edu.utah.sci.vistrails.basic:String)", True, {"docstring": "The full text of the abstract as provided in the science metadata document."}),
 ("author", "(edu.utah.sci.vistrails.basic:String)", True, {"docstring": "Principle Investigator (PI) / Author as listed in the metadata document."}),
 ("authorLastName", "(edu.utah.sci.vistrails.basic:String)", True, {"docstring": "The LAST name(s) of the author(s)"}),
@@ -485,21 +633,69 @@ class D1Search(Module):
 ("webUrl", "(edu.utah.sci.vistrails.basic:String)", True, {"docstring": "Link to the investigator's web-site."}),
 ("westBoundCoord", "(edu.utah.sci.vistrails.basic:Float)", True, {"docstring": "Western most longitude of the spatial extent, in decimal degrees, WGS84"}),
 ("writePermission", "(edu.utah.sci.vistrails.basic:String)", True, {"docstring": "List of subjects (groups and individuals) that have write permission on PID."})]
-    _output_ports = [('dataIdentifierList', 
+    _input_ports = _search_ports + \
+        [("coordinatingNodeURL", "(edu.utah.sci.vistrails.basic:String)"),
+         ("authentication", "(%s:D1Authentication)" % identifiers.identifier),
+         ("pageSize", "(edu.utah.sci.vistrails.basic:Integer)", True),
+         ("maxResults", "(edu.utah.sci.vistrails.basic:Integer)", True),
+         ("returnField", "(edu.utah.sci.vistrails.basic:String)", True),
+         ("local", "(edu.utah.sci.vistrails.basic:Boolean)", True)]
+    _output_ports = [("self", "(%s:D1Search)" % identifiers.identifier),
+                     ('dataIdentifierList', 
                       "(edu.utah.sci.vistrails.basic:List)")]
+
+    def __init__(self):
+        Module.__init__(self)
+        self.results = None
+
+    def get_search_values(self):
+        """get_search_values returns a dict mapping each connected
+        search port to the list of its values"""
+        values = {}
+        for port in self._search_ports:
+            port_values = self.forceGetInputListFromPort(port[0])
+            if port_values:
+                values[port[0]] = port_values
+        return values
     
     def compute(self):
-        dataIdentifierList = []
-        setResult("dataIdentifierList", dataIdentifierList)
+        """compute sets results to the lazy SearchResults, which other
+        modules can iterate over, and, if that port is connected,
+        dataIdentifierList to the identifiers of all the matching
+        records; with local set, the local index is searched instead of
+        the coordinating node"""
+        fields = ['id'] + [f for f in 
+                           self.forceGetInputListFromPort("returnField")
+                           if f != 'id']
+        local = self.forceGetInputFromPort("local",
+                                           configuration.local_search)
+        cert_file = None
+        key_file = None
+        if self.hasInputFromPort("authentication"):
+            auth = self.getInputFromPort("authentication")
+            cert_file = auth.cert_file
+            key_file = auth.key_file
+        self.results = utils.search(self.get_search_values(),
+                                    get_cn_url(self, not local), fields,
+                                    self.forceGetInputFromPort("pageSize"),
+                                    self.forceGetInputFromPort("maxResults"),
+                                    local, cert_file, key_file)
+        self.annotate({'query': self.results.query})
+        # the interpreter enables the output ports that are connected;
+        # don't fetch every page just for the lazy self output
+        if "dataIdentifierList" in self.outputPorts:
+            self.setResult("dataIdentifierList",
+                           list(self.results.ids(concurrent=True)))
 
 _modules = [D1DateTime, D1Identifier, 
-            # D1Search, 
+            D1Search, 
             (D1GetObject, {"abstract": True}),
             (D1PutObject, {"abstract": True}),
             D1GetData, D1GetMetadata,
             D1Authentication, D1AccessPolicy, D1ReplicationPolicy, 
             D1SystemMetadata, 
-            D1PutData, D1DataObject, D1Package, D1PutPackage]
+            D1PutData, D1DataObject, D1Package, D1PutPackage,
+            D1PutDirectory]
 
 
 def initialize():
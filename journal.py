@@ -0,0 +1,102 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import json
+import os
+import threading
+import time
+
+
+class SaveJournal(object):
+    ''' Write-ahead journal of a package save.
+
+        Each member that reaches the node is appended as one JSON line
+        (pid, the pid it obsoletes, checksum and response) and synced to
+        disk, so a save that failed partway can be rerun without
+        checking or sending those members again.  The journal is removed
+        once the resource map is saved.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._successors = {}
+        if os.path.exists(path):
+            self._read()
+
+    def is_done(self, pid, sysmeta):
+        ''' Check whether pid was saved with the content sysmeta
+            describes.
+        '''
+        entry = self._entries.get(pid)
+        return entry is not None and \
+            entry['checksum'] == _get_checksum(sysmeta)
+
+    def get_successor(self, pid, sysmeta):
+        ''' Return the pid a journaled save used for the new version of
+            pid with the content sysmeta describes, or None.
+        '''
+        entry = self._successors.get(pid)
+        if entry is not None and entry['checksum'] == _get_checksum(sysmeta):
+            return entry['pid']
+        return None
+
+    def record(self, pid, action, sysmeta, response=None, obsoletes=None):
+        entry = {'pid': pid,
+                 'action': action,
+                 'obsoletes': obsoletes,
+                 'checksum': _get_checksum(sysmeta),
+                 'response': _get_response_value(response),
+                 'time': time.time()}
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._add(entry)
+
+    def finish(self):
+        ''' Remove the journal after the save completed. '''
+        with self._lock:
+            self._entries = {}
+            self._successors = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _read(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of an interrupted write
+                    continue
+                self._add(entry)
+
+    def _add(self, entry):
+        self._entries[entry['pid']] = entry
+        if entry.get('obsoletes'):
+            self._successors[entry['obsoletes']] = entry
+
+
+def _get_checksum(sysmeta):
+    if sysmeta is None or sysmeta.checksum is None:
+        return None
+    return [str(sysmeta.checksum.algorithm),
+            str(sysmeta.checksum.value()).lower()]
+
+def _get_response_value(response):
+    if hasattr(response, 'value'):
+        response = response.value()
+    if response is None:
+        return None
+    return unicode(response)
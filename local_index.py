@@ -0,0 +1,517 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import datetime
+import json
+import re
+import sqlite3
+import threading
+import xml.etree.cElementTree as ElementTree
+
+from search import DATE_FIELDS, OVERLAP_FIELDS, build_query, format_value, \
+    normalize_date
+
+# fields stored as columns of the records table, with a B-tree index
+COLUMN_FIELDS = ['formatId', 'authoritativeMN', 'datasource', 'size',
+                 'isPublic', 'beginDate', 'endDate', 'dateUploaded',
+                 'dateModified', 'northBoundCoord', 'southBoundCoord',
+                 'eastBoundCoord', 'westBoundCoord']
+NUMERIC_FIELDS = set(['size', 'northBoundCoord', 'southBoundCoord',
+                      'eastBoundCoord', 'westBoundCoord'])
+BOOLEAN_FIELDS = set(['isPublic', 'replicationAllowed'])
+BBOX_COLUMNS = {'westBoundCoord': 'west', 'eastBoundCoord': 'east',
+                'southBoundCoord': 'south', 'northBoundCoord': 'north'}
+# text fields searched through the full-text index, by its column
+TEXT_COLUMNS = {'title': 'title', 'titleText': 'title', 'titlestr': 'title',
+                'abstract': 'abstract',
+                'keywords': 'keywords', 'keywordsText': 'keywords',
+                'gcmdKeyword': 'keywords', 'keyConcept': 'keywords',
+                'author': 'author', 'authorLastName': 'author',
+                'investigator': 'author', 'investigatorText': 'author',
+                'origin': 'author', 'originText': 'author',
+                'originator': 'author', 'originatorText': 'author',
+                'fullText': 'text', 'text': 'text'}
+
+# science metadata elements (EML, FGDC and ISO 19139) by local name
+_TEXT_TAGS = {'title': 'title', 'abstract': 'abstract',
+              'keyword': 'keywords', 'themekey': 'keywords',
+              'placekey': 'keywords', 'surName': 'author',
+              'origin': 'author', 'organizationName': 'author'}
+_COORD_TAGS = {'westBoundingCoordinate': 'westBoundCoord',
+               'eastBoundingCoordinate': 'eastBoundCoord',
+               'northBoundingCoordinate': 'northBoundCoord',
+               'southBoundingCoordinate': 'southBoundCoord',
+               'westbc': 'westBoundCoord', 'eastbc': 'eastBoundCoord',
+               'northbc': 'northBoundCoord', 'southbc': 'southBoundCoord',
+               'westBoundLongitude': 'westBoundCoord',
+               'eastBoundLongitude': 'eastBoundCoord',
+               'northBoundLatitude': 'northBoundCoord',
+               'southBoundLatitude': 'southBoundCoord'}
+_DATE_TAGS = {'beginDate': 'beginDate', 'begdate': 'beginDate',
+              'beginPosition': 'beginDate', 'endDate': 'endDate',
+              'enddate': 'endDate', 'endPosition': 'endDate',
+              'singleDateTime': None, 'caldate': None}
+_RANGE = re.compile(r'^([\[{])\s*(.+?)\s+TO\s+(.+?)\s*([\]}])$')
+_FIELD_NAME = re.compile(r'^\w+$')
+
+
+def is_science_metadata_format(format_id):
+    return format_id is not None and \
+        (format_id.startswith('eml:') or format_id.startswith('FGDC-STD-'))
+
+
+class LocalIndex(object):
+    ''' SQLite index of search records for searching offline.
+
+        Records are dicts of DataONE search fields, as the coordinating
+        node's Solr index returns them, and can also be built from
+        system and science metadata.  Text fields go to a full-text
+        index, bounding boxes to an R-tree and dates, formats and nodes
+        to B-tree indexes; every other field value is indexed for exact
+        matches.  search takes the same values as search.build_query.
+        Without the FTS4 or R-tree SQLite modules, text and boxes are
+        matched on the plain tables instead.
+    '''
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS records ('
+                         'rowid INTEGER PRIMARY KEY, id TEXT UNIQUE, %s, '
+                         'doc TEXT)' % ', '.join(COLUMN_FIELDS))
+            for field in COLUMN_FIELDS:
+                conn.execute('CREATE INDEX IF NOT EXISTS records_%s ON '
+                             'records (%s)' % (field, field))
+            conn.execute('CREATE TABLE IF NOT EXISTS record_fields ('
+                         'record INTEGER, name TEXT, value)')
+            conn.execute('CREATE INDEX IF NOT EXISTS record_fields_value '
+                         'ON record_fields (name, value)')
+            conn.execute('CREATE INDEX IF NOT EXISTS record_fields_record '
+                         'ON record_fields (record)')
+            self.has_fts = _create_virtual_table(
+                conn, 'CREATE VIRTUAL TABLE IF NOT EXISTS record_text '
+                'USING fts4(title, abstract, keywords, author, text)')
+            # a record has up to two boxes, with ids 2 * rowid and
+            # 2 * rowid + 1 (see _get_boxes)
+            has_boxes = conn.execute("SELECT 1 FROM sqlite_master WHERE "
+                                     "name = 'record_boxes'").fetchone()
+            self.has_rtree = _create_virtual_table(
+                conn, 'CREATE VIRTUAL TABLE IF NOT EXISTS record_boxes '
+                'USING rtree(id, west, east, south, north)')
+            if self.has_rtree and has_boxes is None:
+                # boxes indexed one per record by earlier versions
+                conn.execute('DROP TABLE IF EXISTS record_bbox')
+                for row in conn.execute('SELECT rowid, westBoundCoord, '
+                                        'eastBoundCoord, southBoundCoord, '
+                                        'northBoundCoord FROM '
+                                        'records').fetchall():
+                    self._add_boxes(conn, row[0], row[1:])
+
+    def add(self, doc):
+        self.add_all([doc])
+
+    def add_all(self, docs):
+        ''' Add or replace the records docs, in one transaction. '''
+        with self._lock:
+            with self._connect() as conn:
+                for doc in docs:
+                    self._add(conn, _normalize_doc(doc))
+
+    def update(self, pid, fields):
+        ''' Merge fields into the record of pid, creating it if needed. '''
+        self.update_all([dict(fields, id=pid)])
+
+    def update_all(self, docs):
+        ''' Merge each of docs into the record with its id, in one
+            transaction.
+        '''
+        with self._lock:
+            with self._connect() as conn:
+                for fields in docs:
+                    row = conn.execute('SELECT doc FROM records WHERE '
+                                       'id = ?', (fields['id'],)).fetchone()
+                    doc = json.loads(row[0]) if row is not None else {}
+                    doc.update(_normalize_doc(fields))
+                    self._add(conn, doc)
+
+    def add_sysmeta(self, sysmeta):
+        ''' Index the fields of pyxb system metadata. '''
+        self.update(sysmeta.identifier.value(), get_sysmeta_fields(sysmeta))
+
+    def add_science_metadata(self, pid, f):
+        ''' Index the title, abstract, keywords, authors, bounding box and
+            temporal coverage of an EML, FGDC or ISO 19139 document read
+            from f as the record of pid.
+        '''
+        self.update(pid, get_science_metadata_fields(f))
+
+    def remove(self, pid):
+        with self._lock:
+            with self._connect() as conn:
+                self._remove(conn, pid)
+
+    def search(self, values, fields=('id',), max_results=None):
+        ''' Return the LocalSearchResults for values. '''
+        (where, params) = self._build_where(values)
+        return LocalSearchResults(self, where, params, fields, max_results,
+                                  build_query(values))
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def _add(self, conn, doc):
+        self._remove(conn, doc['id'])
+        cursor = conn.execute('INSERT INTO records (id, %s, doc) VALUES '
+                              '(?, %s, ?)' %
+                              (', '.join(COLUMN_FIELDS),
+                               ', '.join('?' * len(COLUMN_FIELDS))),
+                              [doc['id']] + [_get_first(doc.get(field))
+                                             for field in COLUMN_FIELDS] +
+                              [json.dumps(doc)])
+        rowid = cursor.lastrowid
+        conn.executemany('INSERT INTO record_fields VALUES (?, ?, ?)',
+                         [(rowid, name, value)
+                          for (name, values) in doc.iteritems()
+                          if name not in COLUMN_FIELDS
+                          for value in _as_list(values)])
+        if self.has_fts:
+            text = dict((column, []) for column in TEXT_COLUMNS.values())
+            for (name, values) in doc.iteritems():
+                values = [v for v in _as_list(values)
+                          if isinstance(v, basestring)]
+                if name in TEXT_COLUMNS:
+                    text[TEXT_COLUMNS[name]].extend(values)
+                if TEXT_COLUMNS.get(name) != 'text':
+                    text['text'].extend(values)
+            conn.execute('INSERT INTO record_text (docid, title, abstract, '
+                         'keywords, author, text) VALUES (?, ?, ?, ?, ?, ?)',
+                         [rowid] + ['\n'.join(text[c]) for c in
+                                    ('title', 'abstract', 'keywords',
+                                     'author', 'text')])
+        if self.has_rtree:
+            self._add_boxes(conn, rowid,
+                            [_get_first(doc.get(field)) for field in
+                             ('westBoundCoord', 'eastBoundCoord',
+                              'southBoundCoord', 'northBoundCoord')])
+
+    def _add_boxes(self, conn, rowid, bbox):
+        conn.executemany('INSERT INTO record_boxes VALUES (?, ?, ?, ?, ?)',
+                         [[2 * rowid + i] + box
+                          for (i, box) in enumerate(_get_boxes(bbox))])
+
+    def _remove(self, conn, pid):
+        row = conn.execute('SELECT rowid FROM records WHERE id = ?',
+                           (pid,)).fetchone()
+        if row is None:
+            return
+        conn.execute('DELETE FROM records WHERE rowid = ?', row)
+        conn.execute('DELETE FROM record_fields WHERE record = ?', row)
+        if self.has_fts:
+            conn.execute('DELETE FROM record_text WHERE docid = ?', row)
+        if self.has_rtree:
+            conn.execute('DELETE FROM record_boxes WHERE id IN (?, ?)',
+                         (2 * row[0], 2 * row[0] + 1))
+
+    def _build_where(self, values):
+        conditions = []
+        params = []
+        terms = {}
+        bbox = []
+        for name in sorted(values):
+            if not _FIELD_NAME.match(name):
+                raise Exception('Invalid search field "%s"' % name)
+            field_values = values[name]
+            if not isinstance(field_values, (list, tuple)):
+                field_values = [field_values]
+            for value in field_values:
+                if value is None:
+                    continue
+                match = _parse_range(value)
+                if match is None and name in OVERLAP_FIELDS:
+                    # the bound is compared with the opposite field
+                    (field, is_lower) = OVERLAP_FIELDS[name]
+                    value = _to_sql(field, value)
+                    if self.has_rtree and field in BBOX_COLUMNS:
+                        bbox.append(('%s %s ?' % (BBOX_COLUMNS[field],
+                                                  '>=' if is_lower else '<='),
+                                     value))
+                    else:
+                        conditions.append('r.%s %s ?' %
+                                          (field, '>=' if is_lower else '<='))
+                        params.append(value)
+                elif match is not None:
+                    (low, high, low_op, high_op) = match
+                    column = self._get_column(name)
+                    for (bound, op) in ((low, low_op), (high, high_op)):
+                        if bound is not None:
+                            (sql, param) = column(op, _to_sql(name, bound))
+                            conditions.append(sql)
+                            params.append(param)
+                elif self.has_fts and name in TEXT_COLUMNS:
+                    terms.setdefault(TEXT_COLUMNS[name], []).append(
+                        _to_fts_term(value))
+                else:
+                    value = _to_sql(name, value)
+                    if isinstance(value, basestring) and \
+                            ('*' in value or '?' in value):
+                        op = 'GLOB'
+                    elif name in TEXT_COLUMNS:
+                        # without FTS, match words anywhere in the text
+                        (op, value) = ('LIKE', '%%%s%%' % value)
+                    else:
+                        op = '='
+                    (sql, param) = self._get_column(name)(op, value)
+                    conditions.append(sql)
+                    params.append(param)
+        # FTS4 column filters don't apply to phrases, so each column is
+        # matched on its own
+        for column in sorted(terms):
+            conditions.append('r.rowid IN (SELECT docid FROM record_text '
+                              'WHERE %s MATCH ?)' % column)
+            params.append(' '.join(terms[column]))
+        if bbox:
+            conditions.append('r.rowid IN (SELECT id / 2 FROM record_boxes '
+                              'WHERE %s)' % ' AND '.join(c for (c, _) in bbox))
+            params.extend(v for (_, v) in bbox)
+        if not conditions:
+            return ('1', [])
+        return (' AND '.join(conditions), params)
+
+    def _get_column(self, name):
+        if name in COLUMN_FIELDS:
+            return lambda op, value: ('r.%s %s ?' % (name, op), value)
+        if name in TEXT_COLUMNS and TEXT_COLUMNS[name] == 'text':
+            return lambda op, value: ('r.rowid IN (SELECT record FROM '
+                                      'record_fields WHERE value %s ?)' % op,
+                                      value)
+        if name in TEXT_COLUMNS:
+            names = [n for (n, c) in TEXT_COLUMNS.iteritems()
+                     if c == TEXT_COLUMNS[name]]
+            return lambda op, value: ('r.rowid IN (SELECT record FROM '
+                                      'record_fields WHERE name IN (%s) AND '
+                                      'value %s ?)' %
+                                      (', '.join("'%s'" % n for n in names),
+                                       op), value)
+        return lambda op, value: ("r.rowid IN (SELECT record FROM "
+                                  "record_fields WHERE name = '%s' AND "
+                                  "value %s ?)" % (name, op), value)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+
+class LocalSearchResults(object):
+    ''' The records of a LocalIndex matching a query, read as they are
+        iterated, with the interface of search.SearchResults.
+    '''
+
+    def __init__(self, index, where, params, fields=('id',),
+                 max_results=None, query=None):
+        self.index = index
+        self.where = where
+        self.params = params
+        self.fields = list(fields)
+        self.max_results = max_results
+        self.query = query
+
+    def __len__(self):
+        with self.index._connect() as conn:
+            count = conn.execute('SELECT COUNT(*) FROM records r WHERE %s' %
+                                 self.where, self.params).fetchone()[0]
+        if self.max_results is not None:
+            return min(count, self.max_results)
+        return count
+
+    def __iter__(self):
+        sql = 'SELECT r.doc FROM records r WHERE %s ORDER BY r.id' % self.where
+        params = list(self.params)
+        if self.max_results is not None:
+            sql += ' LIMIT ?'
+            params.append(self.max_results)
+        conn = self.index._connect()
+        try:
+            for (doc,) in conn.execute(sql, params):
+                doc = json.loads(doc)
+                if '*' not in self.fields:
+                    doc = dict((k, doc[k]) for k in self.fields if k in doc)
+                yield doc
+        finally:
+            conn.close()
+
+    def iter_all(self):
+        return iter(self)
+
+    def ids(self, concurrent=False):
+        return (doc['id'] for doc in self)
+
+
+def get_sysmeta_fields(sysmeta):
+    ''' Return the search fields of pyxb system metadata. '''
+    fields = {'id': sysmeta.identifier.value(),
+              'formatId': sysmeta.formatId,
+              'size': int(sysmeta.size),
+              'dateUploaded': sysmeta.dateUploaded,
+              'dateModified': sysmeta.dateSysMetadataModified}
+    if sysmeta.checksum is not None:
+        fields['checksum'] = sysmeta.checksum.value()
+        fields['checksumAlgorithm'] = sysmeta.checksum.algorithm
+    for (name, attr) in (('submitter', 'submitter'),
+                         ('rightsHolder', 'rightsHolder'),
+                         ('authoritativeMN', 'authoritativeMemberNode'),
+                         ('datasource', 'originMemberNode'),
+                         ('obsoletes', 'obsoletes'),
+                         ('obsoletedBy', 'obsoletedBy')):
+        value = getattr(sysmeta, attr, None)
+        if value is not None:
+            fields[name] = value.value() if hasattr(value, 'value') \
+                else value
+    access_policy = getattr(sysmeta, 'accessPolicy', None)
+    if access_policy is not None:
+        permissions = {'read': [], 'write': [], 'changePermission': []}
+        for rule in access_policy.allow:
+            subjects = [s.value() for s in rule.subject]
+            for permission in rule.permission:
+                permissions.setdefault(str(permission), []).extend(subjects)
+        fields['readPermission'] = permissions['read'] + \
+            permissions['write'] + permissions['changePermission']
+        fields['writePermission'] = permissions['write']
+        fields['changePermission'] = permissions['changePermission']
+        fields['isPublic'] = 'public' in fields['readPermission']
+    return fields
+
+def get_science_metadata_fields(f):
+    ''' Return the search fields of a science metadata document. '''
+    fields = {}
+    text = []
+    for (_, element) in ElementTree.iterparse(f):
+        tag = element.tag.rsplit('}', 1)[-1]
+        if element.text and element.text.strip():
+            text.append(element.text.strip())
+        if tag not in _TEXT_TAGS and tag not in _COORD_TAGS and \
+                tag not in _DATE_TAGS:
+            continue
+        value = ' '.join(' '.join(element.itertext()).split())
+        if not value:
+            continue
+        if tag in _TEXT_TAGS:
+            field = _TEXT_TAGS[tag]
+            if field == 'title' and 'title' in fields:
+                continue
+            fields.setdefault(field, []).append(value)
+        elif tag in _COORD_TAGS:
+            try:
+                _extend(fields, _COORD_TAGS[tag], float(value))
+            except ValueError:
+                pass
+        elif tag in _DATE_TAGS:
+            date = _parse_date(value.split()[0])
+            if date is not None:
+                for field in ([_DATE_TAGS[tag]] if _DATE_TAGS[tag]
+                              else ['beginDate', 'endDate']):
+                    _extend(fields, field, date)
+    if 'title' in fields:
+        fields['title'] = fields['title'][0]
+    if 'abstract' in fields:
+        fields['abstract'] = '\n'.join(fields['abstract'])
+    fields['fullText'] = '\n'.join(text)
+    return fields
+
+
+def _create_virtual_table(conn, sql):
+    try:
+        conn.execute(sql)
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+def _normalize_doc(doc):
+    normalized = {}
+    for (name, value) in doc.iteritems():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = [_to_sql(name, v) for v in value]
+        else:
+            value = _to_sql(name, value)
+        normalized[name] = value
+    return normalized
+
+def _to_sql(name, value):
+    if name in DATE_FIELDS or isinstance(value, (datetime.date,
+                                                 datetime.datetime)):
+        return format_value(normalize_date(value))
+    if name in BOOLEAN_FIELDS:
+        if isinstance(value, basestring):
+            return 1 if value.lower() in ('true', 'y', '1') else 0
+        return 1 if value else 0
+    if name in NUMERIC_FIELDS:
+        return float(value)
+    if hasattr(value, 'value'):
+        value = value.value()
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    return value
+
+def _to_fts_term(value):
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    words = re.sub(r'[^\w\s*]', ' ', value, flags=re.UNICODE).split()
+    if len(words) > 1:
+        return '"%s"' % ' '.join(w.rstrip('*') for w in words)
+    return ''.join(words) or '""'
+
+def _parse_range(value):
+    if not isinstance(value, basestring):
+        return None
+    match = _RANGE.match(value.strip())
+    if match is None:
+        return None
+    (low_bracket, low, high, high_bracket) = match.groups()
+    return (None if low == '*' else low, None if high == '*' else high,
+            '>=' if low_bracket == '[' else '>',
+            '<=' if high_bracket == ']' else '<')
+
+def _parse_date(value):
+    if re.match(r'^\d{8}$', value):
+        value = '%s-%s-%s' % (value[:4], value[4:6], value[6:])
+    date = normalize_date(value)
+    if isinstance(date, datetime.datetime):
+        return date
+    return None
+
+def _extend(fields, field, value):
+    ''' Widen the extent in fields to include value. '''
+    if field not in fields:
+        fields[field] = value
+    elif field in ('westBoundCoord', 'southBoundCoord', 'beginDate'):
+        fields[field] = min(fields[field], value)
+    else:
+        fields[field] = max(fields[field], value)
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+def _get_boxes(bbox):
+    ''' Return the R-tree boxes of the [west, east, south, north] bbox:
+        none if it is incomplete or empty, two if it crosses the
+        antimeridian (west > east).
+    '''
+    if None in bbox or bbox[2] > bbox[3]:
+        return []
+    (west, east, south, north) = bbox
+    if west <= east:
+        return [[west, east, south, north]]
+    return [[west, 180.0, south, north], [-180.0, east, south, north]]
+
+def _get_first(value):
+    if isinstance(value, (list, tuple)):
+        return value[0] if value else None
+    return value
@@ -0,0 +1,112 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class NodeRegistry(object):
+    ''' Cached copy of a CN's node list indexed by nodeId and by baseURL.
+
+        The list is fetched once with listNodes and refreshed when it is
+        older than ttl seconds or when a lookup misses (at most once every
+        miss_interval seconds).  If path is given the list is also kept on
+        disk so a new session can start without fetching it again.
+    '''
+
+    def __init__(self, ttl=24 * 60 * 60, path=None, miss_interval=60):
+        self.ttl = ttl
+        self.path = path
+        self.miss_interval = miss_interval
+        self._by_id = {}
+        self._by_url = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        if self.path is not None:
+            self._read()
+
+    def get_base_url(self, node_id, cn_client):
+        ''' Return the baseURL for node_id or None if the CN does not know
+            about that node.
+        '''
+        return self._lookup('_by_id', node_id, cn_client)
+
+    def get_node_id(self, base_url, cn_client):
+        ''' Return the nodeId for base_url or None if the CN does not know
+            about that node.
+        '''
+        return self._lookup('_by_url', _normalize_url(base_url),
+                            cn_client)
+
+    def refresh(self, cn_client):
+        nodes = cn_client.listNodes()
+        entries = []
+        for node in list(nodes.node):
+            entries.append((node.identifier.value(), node.baseURL))
+        with self._lock:
+            self._set(entries, time.time())
+            self._write()
+
+    def clear(self):
+        with self._lock:
+            self._set([], None)
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _lookup(self, index_name, key, cn_client):
+        now = time.time()
+        if self._loaded_at is None or now - self._loaded_at > self.ttl:
+            self._try_refresh(cn_client)
+        elif key not in getattr(self, index_name) and \
+                now - self._loaded_at > self.miss_interval:
+            self._try_refresh(cn_client)
+        return getattr(self, index_name).get(key)
+
+    def _try_refresh(self, cn_client):
+        try:
+            self.refresh(cn_client)
+        except Exception:
+            # a stale list is better than none
+            if self._loaded_at is None:
+                raise
+
+    def _set(self, entries, loaded_at):
+        self._by_id = {}
+        self._by_url = {}
+        for (node_id, base_url) in entries:
+            self._by_id[node_id] = base_url
+            self._by_url[_normalize_url(base_url)] = node_id
+        self._loaded_at = loaded_at
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self._set(data['nodes'], data['loaded_at'])
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            self._set([], None)
+
+    def _write(self):
+        if self.path is None:
+            return
+        data = {'loaded_at': self._loaded_at,
+                'nodes': sorted(self._by_id.items())}
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+
+
+def _normalize_url(url):
+    if url is None:
+        return None
+    return url.rstrip('/')
@@ -0,0 +1,179 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+# length of the hex digests of the algorithms objects are stored by
+CHECKSUM_LENGTHS = {'MD5': 32,
+                    'SHA-1': 40,
+                    'SHA-256': 64,
+                    'SHA-384': 96,
+                    'SHA-512': 128}
+HEX_RE = re.compile(r'[0-9a-f]+\Z')
+
+
+class ObjectStore(object):
+    ''' On-disk store of downloaded objects addressed by (checksum
+        algorithm, checksum) with an index from pid to checksum.
+
+        The total size of the stored objects is kept under max_size bytes
+        by removing the least recently used objects.  Checksums come from
+        remote system metadata and name files, so only hex digests of
+        the CHECKSUM_LENGTHS algorithms are accepted (see
+        is_valid_checksum).
+    '''
+
+    def __init__(self, root, max_size=10 * 1024 ** 3):
+        self.root = root
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        for dirname in (self.root, os.path.join(self.root, 'tmp')):
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS objects ('
+                         'algorithm TEXT, checksum TEXT, size INTEGER, '
+                         'last_access REAL, '
+                         'PRIMARY KEY (algorithm, checksum))')
+            conn.execute('CREATE INDEX IF NOT EXISTS objects_last_access '
+                         'ON objects (last_access)')
+            conn.execute('CREATE TABLE IF NOT EXISTS pids ('
+                         'pid TEXT PRIMARY KEY, algorithm TEXT, '
+                         'checksum TEXT)')
+
+    def get_path(self, algorithm, checksum):
+        ''' Return the path of the stored object or None. '''
+        (algorithm, checksum) = _normalize(algorithm, checksum)
+        path = self._object_path(algorithm, checksum)
+        with self._lock:
+            with self._connect() as conn:
+                row = conn.execute('SELECT size FROM objects WHERE '
+                                   'algorithm = ? AND checksum = ?',
+                                   (algorithm, checksum)).fetchone()
+                if row is None:
+                    return None
+                if not os.path.exists(path):
+                    conn.execute('DELETE FROM objects WHERE algorithm = ? '
+                                 'AND checksum = ?', (algorithm, checksum))
+                    return None
+                conn.execute('UPDATE objects SET last_access = ? WHERE '
+                             'algorithm = ? AND checksum = ?',
+                             (time.time(), algorithm, checksum))
+        return path
+
+    def lookup_pid(self, pid):
+        ''' Return the (algorithm, checksum) last stored for pid or None. '''
+        with self._connect() as conn:
+            row = conn.execute('SELECT algorithm, checksum FROM pids '
+                               'WHERE pid = ?', (pid,)).fetchone()
+        if row is None:
+            return None
+        return (row[0], row[1])
+
+    def create_temp_file(self):
+        ''' Return a path, on the store's file system, to download into. '''
+        (fd, path) = tempfile.mkstemp(prefix='d1obj-', suffix='.part',
+                                      dir=os.path.join(self.root, 'tmp'))
+        os.close(fd)
+        return path
+
+    def add_file(self, tmp_path, algorithm, checksum, pid=None):
+        ''' Move tmp_path into the store and return its new path. '''
+        (algorithm, checksum) = _normalize(algorithm, checksum)
+        path = self._object_path(algorithm, checksum)
+        dirname = os.path.dirname(path)
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            os.rename(tmp_path, path)
+            with self._connect() as conn:
+                conn.execute('INSERT OR REPLACE INTO objects VALUES '
+                             '(?, ?, ?, ?)',
+                             (algorithm, checksum, size, time.time()))
+                if pid is not None:
+                    conn.execute('INSERT OR REPLACE INTO pids VALUES '
+                                 '(?, ?, ?)', (pid, algorithm, checksum))
+                self._evict(conn, (algorithm, checksum))
+        return path
+
+    def add_pid(self, pid, algorithm, checksum):
+        (algorithm, checksum) = _normalize(algorithm, checksum)
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO pids VALUES (?, ?, ?)',
+                         (pid, algorithm, checksum))
+
+    def get_size(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COALESCE(SUM(size), 0) '
+                                'FROM objects').fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            with self._connect() as conn:
+                for (algorithm, checksum) in \
+                        conn.execute('SELECT algorithm, checksum '
+                                     'FROM objects').fetchall():
+                    self._remove_file(algorithm, checksum)
+                conn.execute('DELETE FROM objects')
+                conn.execute('DELETE FROM pids')
+
+    def _evict(self, conn, keep):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) '
+                             'FROM objects').fetchone()[0]
+        if total <= self.max_size:
+            return
+        for (algorithm, checksum, size) in \
+                conn.execute('SELECT algorithm, checksum, size FROM objects '
+                             'ORDER BY last_access').fetchall():
+            if total <= self.max_size:
+                break
+            if (algorithm, checksum) == keep:
+                continue
+            self._remove_file(algorithm, checksum)
+            conn.execute('DELETE FROM objects WHERE algorithm = ? AND '
+                         'checksum = ?', (algorithm, checksum))
+            conn.execute('DELETE FROM pids WHERE algorithm = ? AND '
+                         'checksum = ?', (algorithm, checksum))
+            total -= size
+
+    def _remove_file(self, algorithm, checksum):
+        if not is_valid_checksum(algorithm, checksum):
+            return
+        try:
+            os.remove(self._object_path(algorithm, checksum))
+        except OSError:
+            pass
+
+    def _object_path(self, algorithm, checksum):
+        _check_checksum(algorithm, checksum)
+        algorithm_dir = algorithm.replace('-', '').lower()
+        return os.path.join(self.root, algorithm_dir, checksum[:2], checksum)
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.root, 'index.db'),
+                               timeout=30)
+
+
+def is_valid_checksum(algorithm, checksum):
+    ''' Check whether an object can be stored under checksum. '''
+    (algorithm, checksum) = (algorithm.upper(), checksum.lower())
+    return len(checksum) == CHECKSUM_LENGTHS.get(algorithm) and \
+        HEX_RE.match(checksum) is not None
+
+def _check_checksum(algorithm, checksum):
+    if not is_valid_checksum(algorithm, checksum):
+        raise Exception('Invalid %s checksum "%s"' % (algorithm, checksum))
+
+def _normalize(algorithm, checksum):
+    _check_checksum(algorithm, checksum)
+    return (algorithm.upper(), checksum.lower())
@@ -0,0 +1,202 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import httplib
+import threading
+import time
+
+from downloads import iter_lines, open_url
+
+# weight of the newest sample in the moving averages
+ALPHA = 0.3
+# seconds a failed node is ranked last, doubled per consecutive failure
+FAILURE_BACKOFF = 30
+MAX_FAILURE_BACKOFF = 3600
+
+
+class NodeStats(object):
+    def __init__(self):
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.last_failure = 0
+
+    def add_latency(self, latency):
+        self.latency = _average(self.latency, latency)
+        self.failures = 0
+
+    def add_throughput(self, throughput):
+        self.throughput = _average(self.throughput, throughput)
+
+    def add_failure(self):
+        self.failures += 1
+        self.last_failure = time.time()
+
+    def is_failing(self):
+        backoff = min(FAILURE_BACKOFF * 2 ** (self.failures - 1),
+                      MAX_FAILURE_BACKOFF)
+        return self.failures > 0 and time.time() - self.last_failure < backoff
+
+
+class ReplicaSelector(object):
+    ''' Ranks the nodes holding replicas of an object by their recent
+        performance.
+
+        Moving averages of the time to first byte and of the throughput
+        of each node are updated by every download and can be seeded by
+        pinging the nodes.  Nodes that failed recently are tried last.
+    '''
+
+    def __init__(self, default_latency=1.0, timeout=10):
+        self.default_latency = default_latency
+        self.timeout = timeout
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def rank(self, base_urls, size=None, probe=False):
+        ''' Return base_urls ordered by the expected time to download size
+            bytes (or just the first byte) from them.  Nodes without stats
+            keep their relative order; with probe set, they are pinged
+            first.
+        '''
+        base_urls = list(base_urls)
+        if probe and len(base_urls) > 1:
+            with self._lock:
+                unknown = [u for u in base_urls if u not in self._stats]
+            self.probe(unknown)
+        with self._lock:
+            keys = dict((u, self._get_sort_key(u, size)) for u in base_urls)
+        return sorted(base_urls, key=lambda u: keys[u])
+
+    def probe(self, base_urls):
+        ''' Ping base_urls concurrently and record their latency. '''
+        threads = [threading.Thread(target=self._ping, args=(base_url,))
+                   for base_url in base_urls]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(self.timeout)
+
+    def open(self, base_url, url, cert_file=None, key_file=None):
+        ''' GET url from the node at base_url, recording how long the first
+            byte took and, once read, the throughput.  Returns None if the
+            node does not have the object or fails or is too slow to
+            answer, so the caller can move on to the next replica.
+        '''
+        start = time.time()
+        try:
+            response = open_url(url, None, cert_file, key_file, self.timeout)
+        except Exception:
+            self.record_failure(base_url)
+            return None
+        if response.status != httplib.OK:
+            response.close()
+            if response.status == httplib.NOT_FOUND:
+                self.record_latency(base_url, time.time() - start)
+            else:
+                self.record_failure(base_url)
+            return None
+        self.record_latency(base_url, time.time() - start)
+        return MeteredResponse(response, self, base_url)
+
+    def record_latency(self, base_url, latency):
+        with self._lock:
+            self._get_stats(base_url).add_latency(latency)
+
+    def record_throughput(self, base_url, nbytes, seconds):
+        if seconds <= 0 or nbytes <= 0:
+            return
+        with self._lock:
+            self._get_stats(base_url).add_throughput(nbytes / seconds)
+
+    def record_failure(self, base_url):
+        with self._lock:
+            self._get_stats(base_url).add_failure()
+
+    def get_stats(self, base_url):
+        with self._lock:
+            return self._stats.get(base_url)
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+    def _get_stats(self, base_url):
+        if base_url not in self._stats:
+            self._stats[base_url] = NodeStats()
+        return self._stats[base_url]
+
+    def _get_sort_key(self, base_url, size):
+        stats = self._stats.get(base_url)
+        if stats is None:
+            return (0, self.default_latency)
+        latency = stats.latency
+        if latency is None:
+            latency = self.default_latency
+        if size and stats.throughput:
+            latency += size / stats.throughput
+        return (1 if stats.is_failing() else 0, latency)
+
+    def _ping(self, base_url):
+        start = time.time()
+        try:
+            response = open_url('%s/v1/monitor/ping' % base_url,
+                                timeout=self.timeout)
+            response.read()
+            response.close()
+        except Exception:
+            self.record_failure(base_url)
+            return
+        if response.status == httplib.OK:
+            self.record_latency(base_url, time.time() - start)
+        else:
+            self.record_failure(base_url)
+
+
+class MeteredResponse(object):
+    ''' Wraps a response to report its throughput once it was read. '''
+
+    def __init__(self, response, selector, base_url):
+        self._response = response
+        self._selector = selector
+        self._base_url = base_url
+        self._start = time.time()
+        self._nbytes = 0
+        self._reported = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(size)
+        self._nbytes += len(data)
+        if not data or size is None or size < 0:
+            self._report()
+        return data
+
+    def close(self):
+        self._report()
+        self._response.close()
+
+    def __iter__(self):
+        return iter_lines(self)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _report(self):
+        if not self._reported:
+            self._reported = True
+            self._selector.record_throughput(self._base_url, self._nbytes,
+                                             time.time() - self._start)
+
+
+def _average(current, sample):
+    if current is None:
+        return float(sample)
+    return ALPHA * sample + (1 - ALPHA) * current
@@ -0,0 +1,223 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import datetime
+import sys
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+import d1_common.util
+
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+ORE_NS = 'http://www.openarchives.org/ore/terms/'
+CITO_NS = 'http://purl.org/spar/cito/'
+DC_NS = 'http://purl.org/dc/elements/1.1/'
+DCTERMS_NS = 'http://purl.org/dc/terms/'
+FOAF_NS = 'http://xmlns.com/foaf/0.1/'
+
+AGGREGATION_TITLE = 'Simple aggregation of science metadata and data.'
+SCIMETA_DESCRIPTION = 'Science metadata object.'
+SCIDATA_DESCRIPTION = 'Science data object'
+# the creator agent recorded in the resource map; modelled on foresite's
+# library agent but not checked against its output
+LIBRARY_AGENT = 'http://foresite-toolkit.googlecode.com/#pythonAgent'
+LIBRARY_NAME = 'Foresite Toolkit (Python)'
+LIBRARY_MBOX = 'mailto:foresite@googlegroups.com'
+
+# triples that differ between any two serializations of the same package
+VOLATILE_PREDICATES = (DCTERMS_NS + 'created', DCTERMS_NS + 'modified')
+
+
+class ResourceMapWriter(object):
+    ''' Writes the ORE RDF/XML resource map of a package (one science
+        metadata object documenting N science data objects) straight to a
+        file-like object.
+
+        It writes the ORE aggregation, CITO documents/isDocumentedBy and
+        dcterms triples that DataPackage._serialize builds with foresite,
+        without building a graph in memory first.  DataPackage only uses
+        it when resmap_stream_threshold is set: the parity test in
+        tests/test_resource_map.py, which needs foresite, must pass
+        first.  The size and checksum of the output are computed while
+        writing.
+    '''
+
+    def __init__(self, out, algorithm):
+        self.out = out
+        self.algorithm = algorithm
+        self.size = 0
+        self._hash = d1_common.util.\
+            get_checksum_calculator_by_dataone_designator(algorithm)
+
+    @property
+    def checksum(self):
+        return self._hash.hexdigest()
+
+    def write(self, pid, resmap_url, scimeta, scidata_list, now=None):
+        ''' Write the resource map for package pid.  scimeta is a
+            (pid, url) pair and scidata_list an iterable of (pid, url) pairs;
+            it is iterated twice.
+        '''
+        if now is None:
+            now = datetime.datetime.utcnow()
+        timestamp = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+        # foresite uses the package pid itself as the aggregation URI
+        aggregation = pid
+        (scimeta_pid, scimeta_url) = scimeta
+
+        self._write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<rdf:RDF\n'
+                    '   xmlns:cito="%s"\n'
+                    '   xmlns:dc="%s"\n'
+                    '   xmlns:dcterms="%s"\n'
+                    '   xmlns:foaf="%s"\n'
+                    '   xmlns:ore="%s"\n'
+                    '   xmlns:rdf="%s"\n'
+                    '>\n' % (CITO_NS, DC_NS, DCTERMS_NS, FOAF_NS, ORE_NS,
+                             RDF_NS))
+
+        self._start(resmap_url)
+        self._resource('rdf:type', ORE_NS + 'ResourceMap')
+        self._literal('dcterms:identifier', pid)
+        self._literal('dcterms:created', timestamp)
+        self._literal('dcterms:modified', timestamp)
+        self._resource('dcterms:creator', LIBRARY_AGENT)
+        self._resource('ore:describes', aggregation)
+        self._end()
+
+        self._start(aggregation)
+        self._resource('rdf:type', ORE_NS + 'Aggregation')
+        self._literal('dcterms:title', AGGREGATION_TITLE)
+        self._resource('ore:isDescribedBy', resmap_url)
+        self._resource('ore:aggregates', scimeta_url)
+        for (_, url) in scidata_list:
+            self._resource('ore:aggregates', url)
+        self._end()
+
+        self._start(scimeta_url)
+        self._literal('dcterms:identifier', scimeta_pid)
+        self._literal('dcterms:description', SCIMETA_DESCRIPTION)
+        self._resource('ore:isAggregatedBy', aggregation)
+        for (_, url) in scidata_list:
+            self._resource('cito:documents', url)
+        self._end()
+
+        for (scidata_pid, url) in scidata_list:
+            self._start(url)
+            self._literal('dcterms:identifier', scidata_pid)
+            self._literal('dcterms:description', SCIDATA_DESCRIPTION)
+            self._resource('ore:isAggregatedBy', aggregation)
+            self._resource('cito:isDocumentedBy', scimeta_url)
+            self._end()
+
+        self._start(LIBRARY_AGENT)
+        self._literal('foaf:name', LIBRARY_NAME)
+        self._resource('foaf:mbox', LIBRARY_MBOX)
+        self._end()
+        self._write('</rdf:RDF>\n')
+
+    def _start(self, about):
+        self._write('  <rdf:Description rdf:about=%s>\n' % quoteattr(about))
+
+    def _end(self):
+        self._write('  </rdf:Description>\n')
+
+    def _literal(self, tag, value):
+        self._write('    <%s>%s</%s>\n' % (tag, escape(value), tag))
+
+    def _resource(self, tag, uri):
+        self._write('    <%s rdf:resource=%s/>\n' % (tag, quoteattr(uri)))
+
+    def _write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self._hash.update(text)
+        self.size += len(text)
+        self.out.write(text)
+
+
+#== Parity check and benchmark ================================================
+
+def _create_test_package(num_scidata):
+    from data_package import DataPackage, DataObject
+    base_url = 'https://mn.example.org/mn/v1/resolve/'
+    pkg = DataPackage('test_pkg')
+    pkg.scimeta = DataObject('test_meta', True, 'meta.xml',
+                             base_url + 'test_meta', None, 'eml://test')
+    for i in xrange(num_scidata):
+        pid = 'test_data_%d' % i
+        pkg.scidata_dict[pid] = DataObject(pid, True, 'data.csv',
+                                           base_url + pid, None, 'text/csv')
+    return pkg
+
+def _write_test_package(pkg, resmap_url, algorithm='SHA-1'):
+    import StringIO
+    out = StringIO.StringIO()
+    writer = ResourceMapWriter(out, algorithm)
+    writer.write(pkg.pid, resmap_url, (pkg.scimeta.pid, pkg.scimeta.url),
+                 [(o.pid, o.url) for o in pkg.scidata_dict.values()])
+    return out.getvalue()
+
+def _serialize_test_package(pkg, mn_base_url):
+    import foresite
+    pkg._generate_resmap(mn_base_url)
+    serializer = foresite.RdfLibSerializer('xml')
+    pkg.resmap.register_serialization(serializer)
+    return pkg.resmap.get_serialization().data
+
+def run_resmap_parity_check(num_scidata=5):
+    ''' Compare the graph written by ResourceMapWriter with the one
+        foresite serializes for the same package.  Returns True if they
+        only differ in the creation and modification dates.
+    '''
+    import rdflib
+    from rdflib.compare import graph_diff, to_isomorphic
+    import utils
+    mn_base_url = 'https://mn.example.org/mn'
+    pkg = _create_test_package(num_scidata)
+    resmap_url = utils.create_get_url_for_pid(mn_base_url, pkg.pid)
+    graphs = []
+    for data in (_serialize_test_package(pkg, mn_base_url),
+                 _write_test_package(pkg, resmap_url)):
+        g = rdflib.Graph()
+        g.parse(data=data, format='xml', publicID=resmap_url)
+        for predicate in VOLATILE_PREDICATES:
+            g.remove((None, rdflib.URIRef(predicate), None))
+        graphs.append(g)
+    (_, only_foresite, only_writer) = graph_diff(to_isomorphic(graphs[0]),
+                                                 to_isomorphic(graphs[1]))
+    for (label, g) in (('only in foresite output', only_foresite),
+                       ('only in writer output', only_writer)):
+        for triple in sorted(g):
+            print '%s: %s' % (label, ' '.join(t.n3() for t in triple))
+    same = len(only_foresite) == 0 and len(only_writer) == 0
+    print 'Parity with %d members: %s' % (num_scidata,
+                                          'OK' if same else 'DIFFERENT')
+    return same
+
+def run_resmap_benchmark(sizes=(10, 100, 1000, 10000)):
+    ''' Time the foresite serialization against ResourceMapWriter. '''
+    import utils
+    mn_base_url = 'https://mn.example.org/mn'
+    print '%10s %14s %14s' % ('members', 'foresite (s)', 'writer (s)')
+    for size in sizes:
+        pkg = _create_test_package(size)
+        resmap_url = utils.create_get_url_for_pid(mn_base_url, pkg.pid)
+        start = time.time()
+        _serialize_test_package(pkg, mn_base_url)
+        foresite_time = time.time() - start
+        start = time.time()
+        _write_test_package(pkg, resmap_url)
+        writer_time = time.time() - start
+        print '%10d %14.3f %14.3f' % (size, foresite_time, writer_time)
+
+if __name__ == '__main__':
+    run_resmap_parity_check()
+    if len(sys.argv) > 1:
+        run_resmap_benchmark([int(a) for a in sys.argv[1:]])
+    else:
+        run_resmap_benchmark()
@@ -0,0 +1,225 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import datetime
+import httplib
+import json
+import re
+import urllib
+
+from downloads import open_url
+from workers import iter_ordered
+
+# A bound on a temporal or spatial extent matches the records whose
+# extent overlaps it: asking for beginDate X matches the records that
+# end on or after X.  Each entry maps the bound to the record field it
+# is compared with and whether the bound is that field's lower limit.
+OVERLAP_FIELDS = {'beginDate': ('endDate', True),
+                  'endDate': ('beginDate', False),
+                  'northBoundCoord': ('southBoundCoord', False),
+                  'southBoundCoord': ('northBoundCoord', True),
+                  'eastBoundCoord': ('westBoundCoord', False),
+                  'westBoundCoord': ('eastBoundCoord', True)}
+
+# fields holding D1DateTime values
+DATE_FIELDS = set(['beginDate', 'endDate', 'dateModified', 'dateUploaded',
+                   'pubDate', 'updateDate'])
+
+_SPECIAL_CHARS = re.compile(r'([+\-&|!(){}\[\]^"~:\\/])')
+_RANGE = re.compile(r'^[\[{].+ TO .+[\]}]$')
+_DATE_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S',
+                 '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M',
+                 '%Y-%m-%d', '%Y-%m', '%Y']
+
+
+def build_query(values):
+    ''' Build a Solr query matching all of values, a dict that maps
+        search fields to a value or a list of values.  Values may be
+        strings, with * and ? as wildcards, booleans, numbers, dates or
+        Solr ranges like "[2010-01-01T00:00:00Z TO *]".
+
+        The query is canonical: the same values in any order, or dates
+        written differently, give the same query.
+    '''
+    clauses = set()
+    for name in sorted(values):
+        field_values = values[name]
+        if not isinstance(field_values, (list, tuple)):
+            field_values = [field_values]
+        for value in field_values:
+            if value is None:
+                continue
+            if name in DATE_FIELDS:
+                value = normalize_date(value)
+            if name in OVERLAP_FIELDS and not _is_range(value):
+                (field, is_lower) = OVERLAP_FIELDS[name]
+                value = format_value(value)
+                if is_lower:
+                    clauses.add('%s:[%s TO *]' % (field, value))
+                else:
+                    clauses.add('%s:[* TO %s]' % (field, value))
+            else:
+                clauses.add('%s:%s' % (name, format_value(value)))
+    if not clauses:
+        return '*:*'
+    return ' AND '.join(sorted(clauses))
+
+def normalize_date(value):
+    ''' Return a D1DateTime string as a datetime, or unchanged if it is
+        a range or not a date.
+    '''
+    if not isinstance(value, basestring) or _is_range(value):
+        return value
+    value = value.strip()
+    # drop fractional seconds; Solr dates in the index have none
+    value = re.sub(r'(:\d{2})\.\d+', r'\1', value)
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    return value
+
+def format_value(value):
+    ''' Format value as a Solr term. '''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if isinstance(value, datetime.date):
+        return value.strftime('%Y-%m-%dT00:00:00Z')
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = value.strip()
+    if _is_range(value):
+        return value
+    if len(value.split()) > 1:
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    return _SPECIAL_CHARS.sub(r'\\\1', value)
+
+def _is_range(value):
+    return isinstance(value, basestring) and \
+        _RANGE.match(value.strip()) is not None
+
+
+class SearchResults(object):
+    ''' The records matching a Solr query on a coordinating node.
+
+        Pages of page_size records are fetched as the results are
+        iterated, so only the current page is held in memory.
+        iter_all fetches up to concurrency pages at once for callers
+        that want every record.  The results are sorted by id so that
+        pages fetched concurrently do not overlap.  Pages found in cache
+        (a SearchCache) are not fetched again, but only pages of the
+        snapshot the first page came from are used; a page fetched from
+        the index with another number of records raises an exception.
+    '''
+
+    def __init__(self, url, query, fields=('id',), page_size=1000,
+                 max_results=None, pool=None, concurrency=1,
+                 cert_file=None, key_file=None, timeout=None, cache=None):
+        self.url = url
+        self.query = query
+        self.fields = list(fields)
+        self.page_size = page_size
+        self.max_results = max_results
+        self.pool = pool
+        self.concurrency = concurrency
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.timeout = timeout
+        self.cache = cache
+        self._num_found = None
+        self._snapshot = None
+        self._first_page = None
+
+    def __len__(self):
+        if self._num_found is None:
+            self._first_page = self._fetch_page(0)
+        if self.max_results is not None:
+            return min(self._num_found, self.max_results)
+        return self._num_found
+
+    def __iter__(self):
+        return self._iter_docs(1)
+
+    def iter_all(self):
+        ''' Iterate over every record, fetching pages concurrently. '''
+        return self._iter_docs(self.concurrency)
+
+    def ids(self, concurrent=False):
+        ''' Iterate over the identifiers of the records. '''
+        docs = self.iter_all() if concurrent else iter(self)
+        return (doc['id'] for doc in docs)
+
+    def _iter_docs(self, concurrency):
+        for page in self._iter_pages(concurrency):
+            for doc in page:
+                yield doc
+
+    def _iter_pages(self, concurrency):
+        first_page = self._first_page
+        self._first_page = None
+        if first_page is None:
+            first_page = self._fetch_page(0)
+        total = len(self)
+        yield first_page[:total]
+        starts = xrange(self.page_size, total, self.page_size)
+        for (start, docs) in iter_ordered(self.pool, self._fetch_page,
+                                          starts, concurrency):
+            yield docs[:total - start]
+
+    def _fetch_page(self, start):
+        # results depend on what the certificate may read
+        key = [self.url, self.query, sorted(self.fields), self.page_size,
+               self.cert_file]
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(key, start)
+            # pages of another snapshot may overlap the ones already used
+            if cached is not None and self._snapshot is not None and \
+                    cached[0] != self._snapshot:
+                cached = None
+        if cached is not None:
+            (snapshot, num_found, docs) = cached
+        else:
+            (num_found, docs) = self._request_page(start)
+            snapshot = None
+            if self.cache is not None:
+                snapshot = self.cache.put(key, start, num_found, docs)
+        if self._num_found is None:
+            self._num_found = num_found
+            self._snapshot = snapshot
+        elif num_found != self._num_found:
+            # its offsets no longer line up with the pages already used
+            raise Exception('The search results changed while they were '
+                            'read (%d records, now %d); search again' %
+                            (self._num_found, num_found))
+        return docs
+
+    def _request_page(self, start):
+        params = [('q', self.query),
+                  ('fl', ','.join(self.fields)),
+                  ('sort', 'id asc'),
+                  ('start', start),
+                  ('rows', self.page_size),
+                  ('wt', 'json')]
+        url = '%s?%s' % (self.url, urllib.urlencode(params))
+        response = open_url(url, None, self.cert_file, self.key_file,
+                            self.timeout)
+        try:
+            if response.status != httplib.OK:
+                raise Exception('Search failed: %d %s' %
+                                (response.status, response.reason))
+            result = json.load(response)
+        finally:
+            response.close()
+        return (result['response']['numFound'], result['response']['docs'])
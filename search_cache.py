@@ -0,0 +1,134 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import json
+import sqlite3
+import threading
+import time
+
+
+class SearchCache(object):
+    ''' Persistent cache of search result pages.
+
+        Pages are grouped by query: the search url, the canonical query
+        (see search.build_query), the returned fields and the page size.
+        All the pages of a query belong to one snapshot of the index,
+        with one numFound and one expiry: they expire together ttl
+        seconds after the first of them was fetched, and a page that
+        reports another numFound starts a new snapshot, dropping the
+        others.  Beyond max_entries pages, the least recently used
+        queries are dropped whole.
+    '''
+
+    def __init__(self, db_path, max_entries=1000, ttl=3600):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                         'key TEXT PRIMARY KEY, num_found INTEGER, '
+                         'fetched_at REAL, last_access REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS snapshots_last_access '
+                         'ON snapshots (last_access)')
+            conn.execute('CREATE TABLE IF NOT EXISTS snapshot_pages ('
+                         'key TEXT, start INTEGER, docs TEXT, '
+                         'PRIMARY KEY (key, start))')
+            # pages cached one by one by earlier versions
+            conn.execute('DROP TABLE IF EXISTS pages')
+
+    def get(self, key, start):
+        ''' Return (snapshot, num_found, docs) for the page of query key
+            at start, or None if it is not cached or expired.  Pages with
+            the same snapshot come from the same state of the index.
+        '''
+        key = _serialize_key(key)
+        now = time.time()
+        with self._lock:
+            with self._connect() as conn:
+                row = conn.execute('SELECT s.fetched_at, s.num_found, '
+                                   'p.docs FROM snapshots s JOIN '
+                                   'snapshot_pages p ON p.key = s.key '
+                                   'WHERE s.key = ? AND p.start = ? AND '
+                                   's.fetched_at >= ?',
+                                   (key, start, now - self.ttl)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute('UPDATE snapshots SET last_access = ? '
+                             'WHERE key = ?', (now, key))
+            self.hits += 1
+        return (row[0], row[1], json.loads(row[2]))
+
+    def put(self, key, start, num_found, docs):
+        ''' Add a page fetched from the index and return the snapshot it
+            was added to.
+        '''
+        key = _serialize_key(key)
+        now = time.time()
+        with self._lock:
+            with self._connect() as conn:
+                self._expire(conn, now)
+                row = conn.execute('SELECT fetched_at, num_found FROM '
+                                   'snapshots WHERE key = ?',
+                                   (key,)).fetchone()
+                if row is None or row[1] != num_found:
+                    # the index changed: the other pages are stale
+                    conn.execute('DELETE FROM snapshot_pages WHERE '
+                                 'key = ?', (key,))
+                    conn.execute('INSERT OR REPLACE INTO snapshots VALUES '
+                                 '(?, ?, ?, ?)', (key, num_found, now, now))
+                    snapshot = now
+                else:
+                    conn.execute('UPDATE snapshots SET last_access = ? '
+                                 'WHERE key = ?', (now, key))
+                    snapshot = row[0]
+                conn.execute('INSERT OR REPLACE INTO snapshot_pages VALUES '
+                             '(?, ?, ?)', (key, start, json.dumps(docs)))
+                self._evict(conn, key)
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM snapshot_pages')
+                conn.execute('DELETE FROM snapshots')
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM '
+                                'snapshot_pages').fetchone()[0]
+
+    def _expire(self, conn, now):
+        expired = [(row[0],) for row in
+                   conn.execute('SELECT key FROM snapshots WHERE '
+                                'fetched_at < ?', (now - self.ttl,))]
+        conn.executemany('DELETE FROM snapshot_pages WHERE key = ?',
+                         expired)
+        conn.executemany('DELETE FROM snapshots WHERE key = ?', expired)
+
+    def _evict(self, conn, keep):
+        total = conn.execute('SELECT COUNT(*) FROM '
+                             'snapshot_pages').fetchone()[0]
+        for (key,) in conn.execute('SELECT key FROM snapshots ORDER BY '
+                                   'last_access').fetchall():
+            if total <= self.max_entries:
+                break
+            if key == keep:
+                continue
+            total -= conn.execute('DELETE FROM snapshot_pages WHERE '
+                                  'key = ?', (key,)).rowcount
+            conn.execute('DELETE FROM snapshots WHERE key = ?', (key,))
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+
+def _serialize_key(key):
+    return json.dumps(key, separators=(',', ':'))
@@ -0,0 +1,188 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import calendar
+import email.utils
+import threading
+import time
+from collections import OrderedDict
+
+import d1_common.types.exceptions
+import d1_common.types.generated.dataoneTypes as dataoneTypes
+
+
+class SysmetaCache(object):
+    ''' LRU cache of system metadata keyed by node base URL and pid.
+
+        Entries hold the serialized XML so every caller gets its own pyxb
+        object.  An entry older than ttl seconds is revalidated with a
+        describe call: if the node reports the same dateSysMetadataModified
+        the entry is kept, otherwise the full document is fetched again.
+        404 responses are remembered for negative_ttl seconds.  Copies
+        from different nodes are kept apart so that a member node's copy
+        is never returned for a coordinating node lookup.
+    '''
+
+    def __init__(self, max_entries=1000, ttl=300, negative_ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def get_sysmeta(self, client, pid):
+        ''' Return the system metadata for pid from client, going to the
+            node only when the cached copy is missing or stale.  Raises the
+            node's DataONEException, including cached 404s.
+        '''
+        now = time.time()
+        key = (getattr(client, 'base_url', None), pid)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = self._entries.pop(key)
+                if entry['xml'] is not None:
+                    if now - entry['fetched_at'] <= self.ttl:
+                        self.hits += 1
+                        return _from_xml(entry['xml'])
+                elif now - entry['fetched_at'] <= self.negative_ttl:
+                    self.negative_hits += 1
+                    raise entry['missing']
+        if entry is not None and entry['xml'] is not None and \
+                self._is_unchanged(client, pid, entry['modified']):
+            with self._lock:
+                entry['fetched_at'] = now
+                self.revalidations += 1
+            return _from_xml(entry['xml'])
+
+        with self._lock:
+            self.misses += 1
+        try:
+            sysmeta = client.getSystemMetadata(pid)
+        except d1_common.types.exceptions.DataONEException as e:
+            if e.errorCode == 404:
+                with self._lock:
+                    entry = self._get_entry(key)
+                    entry['xml'] = None
+                    entry['missing'] = e
+                    entry['fetched_at'] = time.time()
+            raise
+        if sysmeta:
+            self.put(key[0], pid, sysmeta)
+        return sysmeta
+
+    def put(self, base_url, pid, sysmeta):
+        xml = sysmeta.toxml()
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        with self._lock:
+            entry = self._get_entry((base_url, pid))
+            entry['xml'] = xml
+            entry['modified'] = _to_timestamp(sysmeta.dateSysMetadataModified)
+            entry['fetched_at'] = time.time()
+            entry['missing'] = None
+
+    def invalidate(self, pid):
+        ''' Drop the entries of pid from every node. '''
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == pid]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'negative_hits': self.negative_hits,
+                'revalidations': self.revalidations,
+                'evictions': self.evictions}
+
+    def _get_entry(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            entry = {'xml': None, 'modified': None, 'fetched_at': None,
+                     'missing': None}
+        self._entries[key] = entry
+        while len(self._entries) > max(self.max_entries, 1):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def _is_unchanged(self, client, pid, modified):
+        ''' Ask the node (cheaply) if the sysmeta changed since modified. '''
+        if modified is None:
+            return False
+        try:
+            headers = client.describe(pid)
+        except Exception:
+            return False
+        last_modified = None
+        if headers is not None:
+            for (key, value) in dict(headers).iteritems():
+                if key.lower() == 'last-modified':
+                    last_modified = value
+        if not last_modified:
+            return False
+        parsed = email.utils.parsedate_tz(last_modified)
+        if parsed is None:
+            return False
+        # HTTP dates only have second resolution
+        return email.utils.mktime_tz(parsed) <= int(modified)
+
+
+class ObsolescenceIndex(object):
+    ''' Maps each pid of an obsolescence chain to the newest pid seen for
+        that chain.
+    '''
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._heads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_head(self, pid):
+        with self._lock:
+            head = self._heads.get(pid)
+            if head is not None:
+                self._heads[pid] = self._heads.pop(pid)
+            return head
+
+    def set_head(self, pids, head):
+        with self._lock:
+            for pid in pids:
+                self._heads.pop(pid, None)
+                self._heads[pid] = head
+            while len(self._heads) > max(self.max_entries, 1):
+                self._heads.popitem(last=False)
+
+    def invalidate(self, pid):
+        with self._lock:
+            self._heads.pop(pid, None)
+
+    def clear(self):
+        with self._lock:
+            self._heads.clear()
+
+
+def _from_xml(xml):
+    return dataoneTypes.CreateFromDocument(xml)
+
+def _to_timestamp(dt):
+    if dt is None:
+        return None
+    if dt.tzinfo is not None:
+        return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+    # DataONE dates without a time zone are in UTC
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
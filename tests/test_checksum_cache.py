@@ -0,0 +1,84 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import checksum_cache
+from checksum_cache import ChecksumCache
+import hashing
+
+
+class ChecksumCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data.csv')
+        self.write('abc')
+        self.cache = ChecksumCache(os.path.join(self.dir, 'cache.db'))
+        self.hashed = []
+        self.get_file_checksums = hashing.get_file_checksums
+        def get_file_checksums(path, algorithms):
+            self.hashed.append(sorted(algorithms))
+            return self.get_file_checksums(path, algorithms)
+        hashing.get_file_checksums = get_file_checksums
+        # files written by the tests are younger than the racy interval
+        self.racy_interval = checksum_cache.RACY_INTERVAL
+        checksum_cache.RACY_INTERVAL = -60
+
+    def tearDown(self):
+        hashing.get_file_checksums = self.get_file_checksums
+        checksum_cache.RACY_INTERVAL = self.racy_interval
+        shutil.rmtree(self.dir)
+
+    def write(self, data, mtime=None):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_hashes_once(self):
+        expected = (3, {'MD5': hashlib.md5('abc').hexdigest()})
+        self.assertEqual(self.cache.get_checksums(self.path, 'MD5'), expected)
+        self.assertEqual(self.cache.get_checksums(self.path, 'MD5'), expected)
+        self.assertEqual(self.hashed, [['MD5']])
+
+    def test_hashes_missing_algorithms_only(self):
+        self.cache.get_checksums(self.path, ['MD5'])
+        (_, checksums) = self.cache.get_checksums(self.path,
+                                                  ['MD5', 'SHA-1'])
+        self.assertEqual(checksums['SHA-1'], hashlib.sha1('abc').hexdigest())
+        self.assertEqual(self.hashed, [['MD5'], ['SHA-1']])
+
+    def test_changed_file_is_hashed_again(self):
+        mtime = os.stat(self.path).st_mtime
+        self.cache.get_checksums(self.path, 'MD5')
+        # same size and mtime: only the ctime tells them apart
+        time.sleep(0.01)
+        self.write('abd', mtime)
+        (_, checksums) = self.cache.get_checksums(self.path, 'MD5')
+        self.assertEqual(checksums['MD5'], hashlib.md5('abd').hexdigest())
+        self.assertEqual(len(self.hashed), 2)
+
+    def test_recent_files_are_not_cached(self):
+        checksum_cache.RACY_INTERVAL = self.racy_interval
+        self.cache.get_checksums(self.path, 'MD5')
+        self.cache.get_checksums(self.path, 'MD5')
+        self.assertEqual(len(self.hashed), 2)
+
+    def test_invalidate(self):
+        self.cache.get_checksums(self.path, 'MD5')
+        self.cache.invalidate(self.path)
+        self.cache.get_checksums(self.path, 'MD5')
+        self.assertEqual(len(self.hashed), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import hashlib
+import StringIO
+import unittest
+
+from downloads import ChecksumError, VerifyingReader
+
+DATA = 'line one\nline two\nline three'
+
+
+class VerifyingReaderTest(unittest.TestCase):
+    def reader(self, data=DATA, size=len(DATA),
+               checksum=hashlib.md5(DATA).hexdigest().upper()):
+        return VerifyingReader(StringIO.StringIO(data), 'p1', size, 'MD5',
+                               checksum)
+
+    def read_all(self, reader, size):
+        chunks = []
+        while True:
+            data = reader.read(size)
+            if not data:
+                return ''.join(chunks)
+            chunks.append(data)
+
+    def test_matching_checksum(self):
+        self.assertEqual(self.reader().read(), DATA)
+        for size in (1, 5, 1000):
+            self.assertEqual(self.read_all(self.reader(), size), DATA)
+        self.assertEqual(list(self.reader()),
+                         ['line one\n', 'line two\n', 'line three'])
+
+    def test_corrupt_data(self):
+        corrupt = DATA.replace('two', 'tw0')
+        try:
+            self.read_all(self.reader(corrupt), 4)
+        except ChecksumError as e:
+            self.assertEqual((e.pid, e.algorithm, e.actual),
+                             ('p1', 'MD5', hashlib.md5(corrupt).hexdigest()))
+        else:
+            self.fail('ChecksumError not raised')
+
+    def test_short_read_is_not_a_checksum_error(self):
+        reader = self.reader(DATA[:10])
+        try:
+            reader.read()
+        except ChecksumError:
+            self.fail('a truncated download raised ChecksumError')
+        except Exception as e:
+            self.assertIn('after 10 of %d bytes' % len(DATA), str(e))
+        else:
+            self.fail('truncated download not detected')
+
+    def test_resumed_download(self):
+        hasher = hashlib.md5(DATA[:10])
+        reader = VerifyingReader(StringIO.StringIO(DATA[10:]), 'p1',
+                                 len(DATA), 'MD5',
+                                 hashlib.md5(DATA).hexdigest(), hasher, 10)
+        self.assertEqual(reader.read(), DATA[10:])
+
+    def test_verifies_once(self):
+        reader = self.reader()
+        self.read_all(reader, 100)
+        self.assertEqual(reader.read(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
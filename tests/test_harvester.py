@@ -0,0 +1,177 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from harvester import Harvester, Inventory
+from workers import WorkerPool
+
+BASE_URL = 'https://mn.example.org/mn'
+START = datetime.datetime(2012, 1, 1)
+NOW = datetime.datetime(2012, 6, 1)
+
+
+class Value(object):
+    def __init__(self, value, algorithm=None):
+        self._value = value
+        self.algorithm = algorithm
+
+    def value(self):
+        return self._value
+
+
+class ObjectInfo(object):
+    def __init__(self, i, modified):
+        self.identifier = Value('p%05d' % i)
+        self.formatId = 'text/csv'
+        self.checksum = Value('%032X' % i, 'MD5')
+        self.size = i
+        self.dateSysMetadataModified = modified
+
+
+class ObjectList(object):
+    def __init__(self, infos, start, count):
+        self.total = len(infos)
+        self.objectInfo = infos[start:start + count]
+        self.count = len(self.objectInfo)
+
+
+class FakeNode(object):
+    ''' A node listing objects by modification date, at most max_count
+        per page.  on_list is called before each listing.
+    '''
+
+    base_url = BASE_URL
+
+    def __init__(self, num_objects, max_count=300):
+        self.objects = dict((i, START + datetime.timedelta(hours=i))
+                            for i in xrange(num_objects))
+        self.max_count = max_count
+        self.calls = []
+        self.on_list = None
+
+    def modify(self, i, date=NOW + datetime.timedelta(days=1)):
+        self.objects[i] = date
+
+    def listObjects(self, fromDate=None, toDate=None, formatId=None,
+                    start=0, count=1000):
+        self.calls.append((start, count))
+        if self.on_list is not None:
+            self.on_list(self)
+        infos = [ObjectInfo(i, date) for (date, i) in
+                 sorted((date, i) for (i, date) in self.objects.iteritems()
+                        if (fromDate is None or date >= fromDate) and
+                        (toDate is None or date <= toDate))]
+        return ObjectList(infos, start, min(count, self.max_count))
+
+
+class HarvesterTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.inventory = Inventory(os.path.join(self.dir, 'inventory.db'))
+        self.pool = WorkerPool(4)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        shutil.rmtree(self.dir)
+
+    def harvest(self, node, pool=None, **kwargs):
+        return Harvester(node, self.inventory, pool, page_size=1000,
+                         **kwargs).run(NOW)
+
+    def stored(self):
+        return set(r['pid'] for r in self.inventory.iter_records(BASE_URL))
+
+    def test_full_harvest(self):
+        for (i, pool) in enumerate((None, self.pool)):
+            self.inventory = Inventory(os.path.join(self.dir, '%d.db' % i))
+            node = FakeNode(1000)
+            self.assertEqual(self.harvest(node, pool), 1000)
+            self.assertEqual(self.inventory.count(BASE_URL), 1000)
+        record = self.inventory.get(BASE_URL, 'p00007')
+        self.assertEqual(record, {'pid': 'p00007', 'format_id': 'text/csv',
+                                  'algorithm': 'MD5',
+                                  'checksum': '%032x' % 7, 'size': 7,
+                                  'modified': '2012-01-01T07:00:00'})
+        self.assertEqual(self.inventory.get_checkpoint(BASE_URL), NOW)
+        self.assertIsNone(self.inventory.get_window(BASE_URL))
+
+    def test_pages_follow_the_node_page_size(self):
+        node = FakeNode(1000)
+        self.harvest(node)
+        self.assertEqual(sorted(node.calls),
+                         [(0, 0), (0, 1000), (300, 300), (600, 300),
+                          (900, 300)])
+
+    def test_incremental_harvest(self):
+        node = FakeNode(1000)
+        self.harvest(node)
+        node.modify(5, NOW + datetime.timedelta(hours=1))
+        callback_records = []
+        count = Harvester(node, self.inventory, overlap=0,
+                          callback=callback_records.extend).run(
+            NOW + datetime.timedelta(days=1))
+        self.assertEqual(count, 1)
+        self.assertEqual([r['pid'] for r in callback_records], ['p00005'])
+        self.assertEqual(self.inventory.get(BASE_URL, 'p00005')['modified'],
+                         '2012-06-01T01:00:00')
+
+    def test_objects_leaving_the_window_are_listed_again(self):
+        for (i, pool) in enumerate((None, self.pool)):
+            self.inventory = Inventory(os.path.join(self.dir, '%d.db' % i))
+            node = FakeNode(2500)
+            def on_list(node):
+                if len(node.calls) == 3:
+                    # shifts every page after the first
+                    for i in xrange(50):
+                        node.modify(i)
+            node.on_list = on_list
+            self.assertEqual(self.harvest(node, pool), 2500)
+            self.assertEqual(self.stored(),
+                             set('p%05d' % i for i in xrange(2500)))
+            self.assertEqual(self.inventory.get_checkpoint(BASE_URL), NOW)
+
+    def test_passes_are_bounded(self):
+        node = FakeNode(1000)
+        def on_list(node):
+            if node.calls[-1][1] == 0:
+                node.modify(max(i for (i, date) in node.objects.iteritems()
+                                if date <= NOW))
+        node.on_list = on_list
+        self.assertRaises(Exception, self.harvest, node, max_passes=2)
+        self.assertEqual(len([c for c in node.calls if c[1] == 0]), 2)
+        self.assertIsNone(self.inventory.get_checkpoint(BASE_URL))
+        window = self.inventory.get_window(BASE_URL)
+        self.assertEqual((window['done'], window['total']), ([], 998))
+        # a later run lists the kept window again
+        node.on_list = None
+        self.assertEqual(self.harvest(node), 998)
+        self.assertEqual(self.inventory.get_checkpoint(BASE_URL), NOW)
+
+    def test_interrupted_harvest_is_resumed(self):
+        node = FakeNode(1000)
+        def on_list(node):
+            if len(node.calls) == 3:
+                raise Exception('connection reset')
+        node.on_list = on_list
+        self.assertRaises(Exception, self.harvest, node)
+        self.assertEqual(self.inventory.get_window(BASE_URL)['done'],
+                         [0, 300])
+        node.on_list = None
+        del node.calls[:]
+        self.assertEqual(self.harvest(node), 400)
+        self.assertEqual(sorted(node.calls), [(0, 0), (600, 300),
+                                              (900, 300)])
+        self.assertEqual(self.inventory.count(BASE_URL), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import hashlib
+import os
+import tempfile
+import unittest
+
+import hashing
+
+
+class FileChecksumsTest(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def expected(self, data):
+        return {'MD5': hashlib.md5(data).hexdigest(),
+                'SHA-1': hashlib.sha1(data).hexdigest(),
+                'SHA-256': hashlib.sha256(data).hexdigest()}
+
+    def test_all_algorithms_in_one_pass(self):
+        data = os.urandom(100000)
+        self.write(data)
+        for use_mmap in (True, False):
+            # a buffer that doesn't divide the size leaves a short chunk
+            self.assertEqual(hashing.get_file_checksums(
+                    self.path, hashing.DATAONE_ALGORITHMS, 4096, use_mmap),
+                             (len(data), self.expected(data)))
+
+    def test_empty_file(self):
+        self.assertEqual(hashing.get_file_checksums(self.path, 'MD5'),
+                         (0, {'MD5': hashlib.md5('').hexdigest()}))
+
+    def test_single_algorithm(self):
+        self.write('abc')
+        self.assertEqual(hashing.get_file_checksum(self.path, 'SHA-1'),
+                         hashlib.sha1('abc').hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from object_store import ObjectStore, is_valid_checksum
+
+
+class ObjectStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ObjectStore(self.root, max_size=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def add(self, data, pid=None):
+        path = self.store.create_temp_file()
+        with open(path, 'wb') as f:
+            f.write(data)
+        checksum = hashlib.md5(data).hexdigest()
+        return (checksum, self.store.add_file(path, 'md5', checksum, pid))
+
+    def test_add_and_get(self):
+        (checksum, path) = self.add('abc', 'p1')
+        self.assertEqual(open(path, 'rb').read(), 'abc')
+        self.assertEqual(self.store.get_path('MD5', checksum.upper()), path)
+        self.assertEqual(self.store.lookup_pid('p1'), ('MD5', checksum))
+        self.assertEqual(self.store.get_size(), 3)
+        self.assertTrue(path.startswith(self.root))
+
+    def test_missing_file_is_forgotten(self):
+        (checksum, path) = self.add('abc')
+        os.remove(path)
+        self.assertIsNone(self.store.get_path('MD5', checksum))
+        self.assertEqual(self.store.get_size(), 0)
+
+    def test_evicts_least_recently_used(self):
+        (first, _) = self.add('12345', 'p1')
+        (second, _) = self.add('67890', 'p2')
+        self.store.get_path('MD5', first)
+        (third, _) = self.add('abcde', 'p3')
+        self.assertIsNotNone(self.store.get_path('MD5', first))
+        self.assertIsNone(self.store.get_path('MD5', second))
+        self.assertIsNone(self.store.lookup_pid('p2'))
+        self.assertIsNotNone(self.store.get_path('MD5', third))
+        self.assertEqual(self.store.get_size(), 10)
+
+    def test_clear(self):
+        (checksum, path) = self.add('abc', 'p1')
+        self.store.clear()
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(self.store.lookup_pid('p1'))
+        self.assertEqual(self.store.get_size(), 0)
+
+    def test_rejects_invalid_checksums(self):
+        self.assertTrue(is_valid_checksum('SHA-1', 'A' * 40))
+        for (algorithm, checksum) in (('MD5', '../../' + 'a' * 26),
+                                      ('MD5', 'a' * 31),
+                                      ('MD5', 'g' * 32),
+                                      ('CRC32', 'a' * 8)):
+            self.assertFalse(is_valid_checksum(algorithm, checksum))
+            self.assertRaises(Exception, self.store.get_path, algorithm,
+                              checksum)
+            self.assertRaises(Exception, self.store.add_pid, 'p1',
+                              algorithm, checksum)
+        path = self.store.create_temp_file()
+        self.assertRaises(Exception, self.store.add_file, path, 'MD5',
+                          '../' * 10 + 'ab')
+        self.assertTrue(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import hashlib
+import StringIO
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+import resource_map
+from resource_map import ResourceMapWriter, ORE_NS, RDF_NS, DCTERMS_NS
+
+try:
+    import foresite
+    import rdflib.compare
+except ImportError:
+    foresite = None
+
+RESMAP_URL = 'https://mn.example.org/mn/v1/object/pkg'
+META_URL = 'https://mn.example.org/mn/v1/resolve/meta'
+
+
+class ResourceMapWriterTest(unittest.TestCase):
+    def write(self, scidata_list):
+        out = StringIO.StringIO()
+        writer = ResourceMapWriter(out, 'SHA-1')
+        writer.write('pkg', RESMAP_URL, ('meta', META_URL), scidata_list)
+        return (writer, out.getvalue())
+
+    def get_descriptions(self, data):
+        root = ElementTree.fromstring(data)
+        return dict((desc.get('{%s}about' % RDF_NS), desc)
+                    for desc in root.findall('{%s}Description' % RDF_NS))
+
+    def test_size_and_checksum(self):
+        (writer, data) = self.write([('d1', META_URL + '/d1')])
+        self.assertEqual(writer.size, len(data))
+        self.assertEqual(writer.checksum, hashlib.sha1(data).hexdigest())
+
+    def test_aggregates_every_member(self):
+        urls = ['https://mn.example.org/d%d' % i for i in xrange(3)]
+        (_, data) = self.write([('d%d' % i, url)
+                                for (i, url) in enumerate(urls)])
+        descriptions = self.get_descriptions(data)
+        aggregated = [e.get('{%s}resource' % RDF_NS) for e in
+                      descriptions['pkg'].findall('{%s}aggregates' % ORE_NS)]
+        self.assertEqual(aggregated, [META_URL] + urls)
+        for url in urls:
+            self.assertIn(url, descriptions)
+
+    def test_escapes_pids_and_urls(self):
+        url = 'https://mn.example.org/a?b=1&c="2"'
+        (_, data) = self.write([(u'a<b>&\xe9', url)])
+        desc = self.get_descriptions(data)[url]
+        self.assertEqual(desc.find('{%s}identifier' % DCTERMS_NS).text,
+                         u'a<b>&\xe9')
+
+    @unittest.skipIf(foresite is None, 'foresite and rdflib are not installed')
+    def test_parity_with_foresite(self):
+        for num_scidata in (1, 5):
+            self.assertTrue(resource_map.run_resmap_parity_check(num_scidata))
+
+
+if __name__ == '__main__':
+    unittest.main()
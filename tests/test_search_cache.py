@@ -0,0 +1,109 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from search import SearchResults
+from search_cache import SearchCache
+
+
+class SearchCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = SearchCache(os.path.join(self.dir, 'search.db'),
+                                 max_entries=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_pages_share_a_snapshot(self):
+        snapshot = self.cache.put(['q'], 0, 10, [{'id': 'a'}])
+        self.assertEqual(self.cache.put(['q'], 5, 10, [{'id': 'b'}]),
+                         snapshot)
+        self.assertEqual(self.cache.get(['q'], 5),
+                         (snapshot, 10, [{'id': 'b'}]))
+        self.assertIsNone(self.cache.get(['q'], 10))
+        self.assertIsNone(self.cache.get(['r'], 0))
+
+    def test_new_num_found_starts_a_snapshot(self):
+        snapshot = self.cache.put(['q'], 0, 10, [{'id': 'a'}])
+        time.sleep(0.01)
+        new_snapshot = self.cache.put(['q'], 5, 11, [{'id': 'b'}])
+        self.assertNotEqual(new_snapshot, snapshot)
+        self.assertIsNone(self.cache.get(['q'], 0))
+        self.assertEqual(self.cache.get(['q'], 5)[:2], (new_snapshot, 11))
+
+    def test_snapshots_expire_together(self):
+        self.cache.ttl = 0.05
+        self.cache.put(['q'], 0, 10, [])
+        time.sleep(0.1)
+        self.cache.put(['q'], 5, 10, [])
+        self.assertIsNone(self.cache.get(['q'], 0))
+        self.assertIsNotNone(self.cache.get(['q'], 5))
+
+    def test_evicts_least_recently_used_queries(self):
+        for start in (0, 1, 2):
+            self.cache.put(['q'], start, 3, [])
+        self.cache.put(['r'], 0, 1, [])
+        self.cache.get(['q'], 0)
+        self.cache.put(['s'], 0, 1, [])
+        self.assertIsNone(self.cache.get(['r'], 0))
+        self.assertIsNotNone(self.cache.get(['q'], 2))
+        self.assertEqual(len(self.cache), 4)
+
+
+class CachedSearchResultsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = SearchCache(os.path.join(self.dir, 'search.db'))
+        self.num_found = 5
+        self.requested = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def search(self):
+        results = SearchResults('https://cn.example.org/solr', 'q',
+                                page_size=2, cache=self.cache)
+        results._request_page = self.request_page
+        return results
+
+    def request_page(self, start):
+        self.requested.append(start)
+        return (self.num_found,
+                [{'id': 'p%d' % i} for i in
+                 xrange(start, min(start + 2, self.num_found))])
+
+    def test_cached_pages_are_not_requested(self):
+        self.assertEqual(len(list(self.search().ids())), 5)
+        self.assertEqual(list(self.search().ids()),
+                         ['p0', 'p1', 'p2', 'p3', 'p4'])
+        self.assertEqual(self.requested, [0, 2, 4])
+
+    def test_pages_of_other_snapshots_are_requested(self):
+        ids = self.search().ids()
+        self.assertEqual(ids.next(), 'p0')
+        # a page of a later state of the index, cached by another search
+        time.sleep(0.01)
+        self.cache.put(['https://cn.example.org/solr', 'q', ['id'], 2, None],
+                       2, 7, [{'id': 'other'}])
+        self.assertEqual(list(ids), ['p1', 'p2', 'p3', 'p4'])
+        self.assertEqual(self.requested, [0, 2, 4])
+
+    def test_changed_num_found_raises(self):
+        ids = self.search().ids()
+        ids.next()
+        self.num_found = 6
+        self.assertRaises(Exception, list, ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
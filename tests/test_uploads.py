@@ -0,0 +1,87 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import email
+import os
+import StringIO
+import tempfile
+import unittest
+
+from uploads import MultipartBody
+
+
+class MultipartBodyTest(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.write(fd, 'skipped|' + 'x' * 1000 + '\r\n--not a boundary')
+        os.close(fd)
+        self.file = open(self.path, 'rb')
+        self.file.seek(len('skipped|'))
+
+    def tearDown(self):
+        self.file.close()
+        os.remove(self.path)
+
+    def get_body(self, buffer_size=64):
+        return MultipartBody([('pid', u'p\xe9')],
+                             [('object', 'content.bin', self.file),
+                              ('sysmeta', 'systemmetadata.xml', '<sm/>')],
+                             boundary='b0undary', buffer_size=buffer_size)
+
+    def serialize(self, body):
+        chunks = []
+        for chunk in body:
+            if isinstance(chunk, memoryview):
+                self.assertTrue(len(chunk) <= body.buffer_size)
+                # file chunks share a buffer, so they are copied as they come
+                chunk = chunk.tobytes()
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def test_framing(self):
+        body = self.get_body()
+        data = self.serialize(body)
+        self.assertEqual(len(body), len(data))
+        self.assertTrue(data.endswith('\r\n--b0undary--\r\n'))
+        message = email.message_from_string('Content-Type: %s\r\n\r\n%s' %
+                                            (body.get_content_type(), data))
+        parts = message.get_payload()
+        self.assertEqual([p.get_param('name', header='Content-Disposition')
+                          for p in parts], ['pid', 'object', 'sysmeta'])
+        self.assertEqual([p.get_filename() for p in parts],
+                         [None, 'content.bin', 'systemmetadata.xml'])
+        self.assertEqual([p.get_payload() for p in parts],
+                         [u'p\xe9'.encode('utf-8'),
+                          'x' * 1000 + '\r\n--not a boundary', '<sm/>'])
+
+    def test_buffer_sizes(self):
+        expected = self.serialize(self.get_body())
+        for buffer_size in (1, 7, 1024 * 1024):
+            self.file.seek(len('skipped|'))
+            self.assertEqual(self.serialize(self.get_body(buffer_size)),
+                             expected)
+
+    def test_file_like_objects(self):
+        f = StringIO.StringIO('skipped|data')
+        f.seek(len('skipped|'))
+        body = MultipartBody([], [('object', 'content.bin', f)],
+                             boundary='b0undary')
+        self.assertEqual(self.serialize(body),
+                         '--b0undary\r\nContent-Disposition: form-data; '
+                         'name="object"; filename="content.bin"\r\n'
+                         'Content-Type: application/octet-stream\r\n\r\n'
+                         'data\r\n--b0undary--\r\n')
+
+    def test_truncated_file(self):
+        body = self.get_body()
+        with open(self.path, 'r+b') as f:
+            f.truncate(100)
+        self.assertRaises(Exception, self.serialize, body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import collections
+import sys
+import threading
+import time
+
+from workers import wait_until
+
+
+class TransferError(Exception):
+    ''' Raised when some transfers of a batch failed.  failures maps each
+        failed name to its exception; results holds the ones that
+        succeeded.
+    '''
+
+    def __init__(self, failures, results):
+        self.failures = failures
+        self.results = results
+        lines = ['%d of %d transfers failed:' %
+                 (len(failures), len(failures) + len(results))]
+        for (name, e) in sorted(failures.iteritems()):
+            lines.append('  %s: %s' % (name, str(e).split('\n')[0]))
+        Exception.__init__(self, '\n'.join(lines))
+
+
+class TransferScheduler(object):
+    ''' Runs transfers in a WorkerPool with at most per_node_limit of them
+        in flight for any one node.
+
+        Transfers wait in per-node queues rather than in the pool so a busy
+        node does not hold up workers that could serve another one.  If
+        given, progress(name, status, info, completed, total) is called
+        after each transfer with status 'done' (info is the result) or
+        'failed' (info is the exception).
+    '''
+
+    def __init__(self, pool, per_node_limit=4, progress=None):
+        self.pool = pool
+        self.per_node_limit = max(per_node_limit or 1, 1)
+        self.progress = progress
+        self.results = {}
+        self.failures = {}
+        self.durations = {}
+        self._queues = collections.defaultdict(collections.deque)
+        self._active = collections.defaultdict(int)
+        self._total = 0
+        self._completed = 0
+        self._condition = threading.Condition()
+
+    def submit(self, node, name, fn, *args, **kwargs):
+        ''' Queue a transfer; transfers start when wait is called. '''
+        with self._condition:
+            self._total += 1
+            self._queues[node].append((name, fn, args, kwargs))
+
+    def wait(self):
+        ''' Run every submitted transfer and return the results by name.
+            Raises TransferError if any of them failed; transfers that
+            succeeded are still reported there.
+        '''
+        with self._condition:
+            nodes = self._queues.keys()
+        for node in nodes:
+            self._dispatch(node)
+        with self._condition:
+            wait_until(lambda: self._completed >= self._total,
+                       self._condition.wait)
+        if self.failures:
+            raise TransferError(dict(self.failures), dict(self.results))
+        return dict(self.results)
+
+    def _dispatch(self, node):
+        while True:
+            with self._condition:
+                if self._active[node] >= self.per_node_limit or \
+                        not self._queues[node]:
+                    return
+                self._active[node] += 1
+                item = self._queues[node].popleft()
+            self.pool.submit(self._run, node, *item)
+
+    def _run(self, node, name, fn, args, kwargs):
+        start = time.time()
+        try:
+            result = fn(*args, **kwargs)
+            (status, info) = ('done', result)
+        except Exception:
+            (status, info) = ('failed', sys.exc_info()[1])
+        with self._condition:
+            if status == 'done':
+                self.results[name] = info
+            else:
+                self.failures[name] = info
+            self.durations[name] = time.time() - start
+            self._active[node] -= 1
+            self._completed += 1
+            completed = self._completed
+            total = self._total
+        if self.progress is not None:
+            try:
+                self.progress(name, status, info, completed, total)
+            except Exception:
+                pass
+        self._dispatch(node)
+        with self._condition:
+            self._condition.notify_all()
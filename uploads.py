@@ -0,0 +1,164 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import httplib
+import os
+import urlparse
+import uuid
+
+import d1_common.types.exceptions
+import d1_common.types.generated.dataoneTypes as dataoneTypes
+
+from downloads import COPY_BUFFER_SIZE
+
+
+class MultipartBody(object):
+    ''' A multipart/mixed request body whose file parts are read in
+        fixed size buffers as the body is sent, so its size in memory
+        does not depend on the size of the files.
+
+        fields is a list of (name, value) and files a list of
+        (name, filename, file object or string).  File objects are read
+        from their current position to their end.
+    '''
+
+    def __init__(self, fields, files, boundary=None,
+                 buffer_size=COPY_BUFFER_SIZE):
+        if boundary is None:
+            boundary = uuid.uuid4().hex
+        self.boundary = boundary
+        self.buffer_size = buffer_size
+        self._parts = []
+        for (name, value) in fields:
+            self._parts.append(
+                ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+                 % (boundary, name), _encode(value)))
+        for (name, filename, value) in files:
+            if isinstance(value, basestring):
+                value = _encode(value)
+            self._parts.append(
+                ('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                 'filename="%s"\r\nContent-Type: application/octet-stream'
+                 '\r\n\r\n' % (boundary, name, filename), value))
+        self._sizes = [_get_size(value) for (_, value) in self._parts]
+
+    def get_content_type(self):
+        return 'multipart/mixed; boundary=%s' % self.boundary
+
+    def __len__(self):
+        size = len(self._get_trailer())
+        for ((header, _), value_size) in zip(self._parts, self._sizes):
+            size += len(header) + value_size + 2
+        return size
+
+    def __iter__(self):
+        ''' Yield the body in chunks of at most buffer_size bytes.  File
+            chunks share one buffer and are only valid until the next one
+            is asked for.
+        '''
+        buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        for ((header, value), size) in zip(self._parts, self._sizes):
+            yield header
+            if isinstance(value, str):
+                yield value
+            else:
+                remaining = size
+                while remaining > 0:
+                    n = _read_into(value, buf, view, min(self.buffer_size,
+                                                         remaining))
+                    if not n:
+                        raise Exception('File ended %d bytes before its '
+                                        'size when it was sent' % remaining)
+                    remaining -= n
+                    yield view[:n]
+            yield '\r\n'
+        yield self._get_trailer()
+
+    def _get_trailer(self):
+        return '--%s--\r\n' % self.boundary
+
+
+def send_multipart(method, url, body, cert_file=None, key_file=None,
+                   timeout=None):
+    ''' Send body to url and return the response text.  A DataONE
+        error is raised as its DataONEException.
+    '''
+    parts = urlparse.urlsplit(url)
+    if parts.scheme == 'https':
+        conn = httplib.HTTPSConnection(parts.hostname, parts.port,
+                                       key_file, cert_file, timeout=timeout)
+    else:
+        conn = httplib.HTTPConnection(parts.hostname, parts.port,
+                                      timeout=timeout)
+    try:
+        conn.putrequest(method, parts.path)
+        conn.putheader('Content-Type', body.get_content_type())
+        conn.putheader('Content-Length', str(len(body)))
+        conn.endheaders()
+        for chunk in body:
+            conn.send(chunk)
+        response = conn.getresponse()
+        text = response.read()
+    finally:
+        conn.close()
+    if response.status != httplib.OK:
+        try:
+            e = d1_common.types.exceptions.deserialize(text)
+        except Exception:
+            raise Exception('Unable to %s %s: %d %s' %
+                            (method, url, response.status, response.reason))
+        raise e
+    return text
+
+def create_object(url, pid, f, sysmeta, cert_file=None, key_file=None,
+                  timeout=None):
+    ''' MNStorage.create: POST f and sysmeta as pid to the object url of
+        a node.
+    '''
+    body = MultipartBody([('pid', pid)],
+                         [('object', 'content.bin', f),
+                          ('sysmeta', 'systemmetadata.xml', sysmeta.toxml())])
+    return dataoneTypes.CreateFromDocument(
+        send_multipart('POST', url, body, cert_file, key_file, timeout))
+
+def update_object(url, new_pid, f, sysmeta, cert_file=None, key_file=None,
+                  timeout=None):
+    ''' MNStorage.update: PUT f and sysmeta as new_pid to the url of the
+        object it obsoletes.
+    '''
+    body = MultipartBody([('newPid', new_pid)],
+                         [('object', 'content.bin', f),
+                          ('sysmeta', 'systemmetadata.xml', sysmeta.toxml())])
+    return dataoneTypes.CreateFromDocument(
+        send_multipart('PUT', url, body, cert_file, key_file, timeout))
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _get_size(value):
+    if isinstance(value, str):
+        return len(value)
+    start = value.tell()
+    if isinstance(value, file):
+        end = os.fstat(value.fileno()).st_size
+    else:
+        # a SpooledTemporaryFile would be rolled over to disk by fileno
+        value.seek(0, os.SEEK_END)
+        end = value.tell()
+        value.seek(start)
+    return max(end - start, 0)
+
+def _read_into(f, buf, view, size):
+    if hasattr(f, 'readinto') and size == len(buf):
+        return f.readinto(buf)
+    data = f.read(size)
+    view[:len(data)] = data
+    return len(data)
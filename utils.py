@@ -35,13 +35,16 @@
 '''
 
 # Stdlib.
+import contextlib
 import datetime
+import hashlib
 import os
 import shutil
 import string
 import sys
 import tempfile
 import urllib
+import weakref
 
 # DataONE
 try:
@@ -63,9 +66,25 @@ except ImportError as e:
     raise
 
 # Package-specific
+from checksum_cache import ChecksumCache
+from client_pool import ClientPool
 from config import configuration
+from downloads import ChecksumError, PartialDownload, RangeNotSupported, \
+    SegmentedDownload, VerifyingReader, open_range
+import hashing
+from harvester import Harvester, Inventory
+from journal import SaveJournal
+from local_index import LocalIndex, is_science_metadata_format
+from node_registry import NodeRegistry
+from object_store import ObjectStore, is_valid_checksum
+from replicas import ReplicaSelector
+from search import SearchResults, build_query
+from search_cache import SearchCache
+from sysmeta_cache import ObsolescenceIndex, SysmetaCache
+import uploads
 import access_control as access_control_module
 import replication_policy as replication_policy_module
+from workers import WorkerPool
 
 REST_Version = 'v1'
 REST_URL_Get = 'object'
@@ -83,38 +102,320 @@ def get_default_cn_url():
         return configuration.cn_url
     return None
 
-def create_d1_mn_client(mn_url=None, cert_file=None, key_file=None):
+def _get_mn_client_args(mn_url=None, cert_file=None, key_file=None):
     if mn_url is None and configuration.check("mn_url"):
         mn_url = configuration.mn_url
     if mn_url is None:
         raise Exception("Must specify member node URL")
+    return (mn_url,) + _get_credential_args(cert_file, key_file)
+
+def _get_credential_args(cert_file=None, key_file=None):
     if cert_file is None:
         cert_file = configuration.cert_file
         if key_file is None and configuration.check("key_file"):
             key_file = configuration.key_file
     if key_file is None:
         key_file = cert_file
+    return (cert_file, key_file)
+
+def create_d1_mn_client(mn_url=None, cert_file=None, key_file=None):
+    (mn_url, cert_file, key_file) = \
+        _get_mn_client_args(mn_url, cert_file, key_file)
     my_d1_mn_client = \
         d1_client.mnclient.MemberNodeClient(mn_url, cert_path=cert_file,
                                             key_path=key_file)
+    client_args[my_d1_mn_client] = \
+        (mn_client_pool, (mn_url, cert_file, key_file))
     return my_d1_mn_client
 
-def get_d1_mn_client(*args, **kwargs):
-    return create_d1_mn_client(*args, **kwargs)
-    # if my_d1_client is None:
-    #     return create_d1_client()
-    # return my_d1_client
+def get_d1_mn_client(mn_url=None, cert_file=None, key_file=None):
+    return mn_client_pool.get(*_get_mn_client_args(mn_url, cert_file,
+                                                   key_file))
 
-def create_d1_cn_client(cn_url=None):
+def _get_cn_client_args(cn_url=None):
     if cn_url is None and configuration.check("cn_url"):
         cn_url = configuration.cn_url
     if cn_url is None:
         raise Exception("Must specify coordinating node URL")
+    return (cn_url,)
+
+def create_d1_cn_client(cn_url=None):
+    (cn_url,) = _get_cn_client_args(cn_url)
     my_d1_cn_client = d1_client.cnclient.CoordinatingNodeClient(cn_url)
+    client_args[my_d1_cn_client] = (cn_client_pool, (cn_url,))
     return my_d1_cn_client
 
-def get_d1_cn_client(*args, **kwargs):
-    return create_d1_cn_client(*args, **kwargs)
+def get_d1_cn_client(cn_url=None):
+    return cn_client_pool.get(*_get_cn_client_args(cn_url))
+
+# Clients are reused across calls (one per thread and node) so that
+# repeated gets and creates do not pay for a new TLS handshake each time.
+mn_client_pool = ClientPool(create_d1_mn_client, configuration.client_pool_size)
+cn_client_pool = ClientPool(create_d1_cn_client, configuration.client_pool_size)
+# the pool and arguments each client was created with
+client_args = weakref.WeakKeyDictionary()
+
+def can_share_clients(*clients):
+    '''  Check if get_thread_client can give other threads their own copy
+         of each of clients.  Clients it can't duplicate must not be used
+         by two threads at once, so callers run their work on them one
+         call at a time.
+    '''
+    return all(client is None or client in client_args for client in clients)
+
+def get_thread_client(client):
+    '''  Return a client for the same node and credentials as client that
+         the calling thread may use.
+    '''
+    if client is None or client not in client_args:
+        return client
+    (pool, args) = client_args[client]
+    return pool.get(*args)
+
+def get_client_credentials(client):
+    '''  Return the (cert_file, key_file) client was created with, or
+         Nones for anonymous access.
+    '''
+    if client not in client_args or client_args[client][0] is not \
+            mn_client_pool:
+        return (None, None)
+    (_, cert_file, key_file) = client_args[client][1]
+    return _get_existing_credentials(cert_file, key_file)
+
+def _get_existing_credentials(cert_file, key_file):
+    if cert_file is None or not os.path.exists(expand_path(cert_file)):
+        return (None, None)
+    return (expand_path(cert_file), expand_path(key_file))
+
+transfer_pool = None
+
+def get_transfer_pool():
+    '''  Return the pool used for concurrent uploads and downloads.
+    '''
+    global transfer_pool
+    if transfer_pool is None:
+        transfer_pool = WorkerPool(configuration.transfer_workers)
+    return transfer_pool
+
+#== Local caches ==============================================================
+
+def get_cache_dir(*subdirs):
+    '''  Return (and create) a directory under the package's cache
+         directory.
+    '''
+    if configuration.check("cache_dir"):
+        cache_dir = expand_path(configuration.cache_dir)
+    else:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.vistrails',
+                                 'dataone')
+    path = os.path.join(cache_dir, *subdirs)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def _get_cache_key(url):
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return hashlib.sha1(url).hexdigest()[:16]
+
+node_registries = {}
+
+def get_node_registry(cn_client):
+    '''  Return the node registry for the CN that cn_client talks to.
+    '''
+    cn_url = cn_client.base_url
+    if cn_url not in node_registries:
+        path = os.path.join(get_cache_dir('nodes'),
+                            '%s.json' % _get_cache_key(cn_url))
+        node_registries[cn_url] = \
+            NodeRegistry(configuration.node_list_ttl, path)
+    return node_registries[cn_url]
+
+# System metadata is looked up many times for the same pids while building
+# and saving packages; see get_sysmeta_by_pid.
+sysmeta_cache = SysmetaCache(configuration.sysmeta_cache_size,
+                             configuration.sysmeta_cache_ttl,
+                             configuration.sysmeta_negative_ttl)
+obsolescence_index = ObsolescenceIndex(configuration.sysmeta_cache_size)
+# Recent latency and throughput of the nodes objects were downloaded from;
+# see _get_object_response.
+replica_selector = ReplicaSelector(timeout=configuration.replica_timeout)
+
+object_store = None
+
+def get_object_store():
+    '''  Return the local store for downloaded objects or None if it is
+         disabled (object_store_size is 0).
+    '''
+    global object_store
+    if object_store is None and configuration.object_store_size:
+        object_store = ObjectStore(get_cache_dir('objects'),
+                                   configuration.object_store_size)
+    return object_store
+
+checksum_cache = None
+
+def get_checksum_cache():
+    '''  Return the persistent checksum cache or None if it is disabled.
+    '''
+    global checksum_cache
+    if checksum_cache is None and configuration.use_checksum_cache:
+        checksum_cache = ChecksumCache(os.path.join(get_cache_dir(),
+                                                    'checksums.db'))
+    return checksum_cache
+
+segment_pool = None
+
+def get_segment_pool():
+    '''  Return the pool that fetches the segments of large downloads.
+         It is separate from the transfer pool, whose workers may be
+         waiting on these segments.
+    '''
+    global segment_pool
+    if segment_pool is None:
+        segment_pool = WorkerPool(configuration.segment_workers)
+    return segment_pool
+
+hash_pool = None
+
+def get_hash_pool():
+    '''  Return the pool used to checksum package members in parallel.
+    '''
+    global hash_pool
+    if hash_pool is None:
+        hash_pool = WorkerPool(configuration.hash_workers,
+                               configuration.hash_pool == "process")
+    return hash_pool
+
+def get_save_journal(base_url, pid):
+    '''  Return the journal of saving package pid to the node at
+         base_url or None if journaling is disabled.
+    '''
+    if not configuration.use_save_journal:
+        return None
+    path = os.path.join(get_cache_dir('journals'),
+                        '%s.jsonl' % _get_cache_key('%s %s' % (base_url, pid)))
+    return SaveJournal(path)
+
+#== Search ====================================================================
+
+search_cache = None
+
+def get_search_cache():
+    '''  Return the persistent cache of search result pages or None if it
+         is disabled.
+    '''
+    global search_cache
+    if search_cache is None and configuration.use_search_cache:
+        search_cache = SearchCache(os.path.join(get_cache_dir(),
+                                                'searches.db'),
+                                   configuration.search_cache_size,
+                                   configuration.search_cache_ttl)
+    return search_cache
+
+local_index = None
+
+def get_local_index():
+    '''  Return the local index used to search offline.
+    '''
+    global local_index
+    if local_index is None:
+        local_index = LocalIndex(os.path.join(get_cache_dir(), 'index.db'))
+    return local_index
+
+def search(values, cn_url=None, fields=('id',), page_size=None,
+           max_results=None, local=None, cert_file=None, key_file=None):
+    '''  Search the coordinating node, or with local the local index, for
+         the records matching values, a dict of search fields (see
+         search.build_query).  Returns the results, which read their
+         records as they are iterated.  The coordinating node is queried
+         with the certificate a member node client would use, so the
+         results include the private objects it may read.
+    '''
+    if local is None:
+        local = configuration.local_search
+    if local:
+        if isinstance(values, basestring):
+            raise Exception('The local index can only be searched by field')
+        return get_local_index().search(values, fields, max_results)
+    (cn_url,) = _get_cn_client_args(cn_url)
+    if page_size is None:
+        page_size = configuration.search_page_size
+    query = values if isinstance(values, basestring) else build_query(values)
+    (cert_file, key_file) = _get_existing_credentials(
+        *_get_credential_args(cert_file, key_file))
+    return SearchResults('%s/%s/query/solr/' % (cn_url, REST_Version),
+                         query, fields, page_size, max_results,
+                         get_transfer_pool(), configuration.search_concurrency,
+                         cert_file, key_file, cache=get_search_cache())
+
+def index_search(values, cn_url=None, max_results=None, cert_file=None,
+                 key_file=None):
+    '''  Copy the records matching values from the coordinating node to
+         the local index.  Returns the number of records copied.
+    '''
+    results = search(values, cn_url, ['*'], max_results=max_results,
+                     local=False, cert_file=cert_file, key_file=key_file)
+    count = 0
+    batch = []
+    for doc in results.iter_all():
+        batch.append(doc)
+        if len(batch) >= results.page_size:
+            get_local_index().add_all(batch)
+            (count, batch) = (count + len(batch), [])
+    get_local_index().add_all(batch)
+    return count + len(batch)
+
+def index_object(pid, mn_client=None, cn_client=None):
+    '''  Add pid to the local index from its system metadata and, for
+         science metadata, the document itself.
+    '''
+    sysmeta = get_sysmeta_by_pid(pid, True, cn_client, mn_client)
+    if sysmeta is None:
+        raise Exception('Unable to get system metadata for "%s"' % pid)
+    get_local_index().add_sysmeta(sysmeta)
+    if is_science_metadata_format(sysmeta.formatId):
+        f = open_object_by_pid(pid, True, mn_client, cn_client)
+        if f is None:
+            raise Exception('Unable to get "%s"' % pid)
+        try:
+            get_local_index().add_science_metadata(pid, f)
+        finally:
+            f.close()
+
+#== Harvesting ================================================================
+
+inventory = None
+
+def get_inventory():
+    '''  Return the local store of the objects listed by nodes.
+    '''
+    global inventory
+    if inventory is None:
+        inventory = Inventory(os.path.join(get_cache_dir(), 'inventory.db'))
+    return inventory
+
+def harvest(client=None, format_id=None, index=False):
+    '''  Copy the list of objects on the node of client (by default the
+         member node) that changed since the last harvest to the
+         inventory, and with index to the local index.  Returns the
+         number of records copied.
+    '''
+    if client is None:
+        client = get_d1_mn_client()
+    callback = None
+    if index:
+        callback = lambda records: get_local_index().update_all(
+            [{'id': r['pid'], 'formatId': r['format_id'],
+              'checksum': r['checksum'], 'checksumAlgorithm': r['algorithm'],
+              'size': r['size'], 'dateModified': r['modified']}
+             for r in records])
+    harvester = Harvester(client, get_inventory(), get_transfer_pool(),
+                          configuration.harvest_page_size,
+                          configuration.harvest_concurrency,
+                          configuration.harvest_overlap, format_id,
+                          get_thread_client, callback)
+    return harvester.run()
 
 #== Session alternatives ======================================================
 
@@ -130,8 +431,6 @@ def create_system_metadata(pid, size, checksum, algorithm=None, format_id=None,
     sysmeta.dateUploaded = datetime.datetime.utcnow()
     sysmeta.dateSysMetadataModified = datetime.datetime.utcnow()
 
-    print "utils CONFIGURATION:", id(configuration), configuration
-
     if algorithm is not None:
         sysmeta.checksum.algorithm = algorithm
     else:
@@ -223,23 +522,25 @@ def expand_path(filename):
     return None
 
 def get_file_size(path):
-    with open(expand_path(path), 'r') as f:
-        f.seek(0, os.SEEK_END)
-        size = f.tell()
-    return size
+    return os.path.getsize(expand_path(path))
 
 
-def get_file_checksum(path, algorithm=None, block_size=1024 * 1024):
+def get_file_checksum(path, algorithm=None, block_size=hashing.BUFFER_SIZE):
     if algorithm is None:
         algorithm = configuration.checksum_alg
-    h = d1_common.util.get_checksum_calculator_by_dataone_designator(algorithm)
-    with open(expand_path(path), 'r') as f:
-        while True:
-            data = f.read(block_size)
-            if not data:
-                break
-            h.update(data)
-    return h.hexdigest()
+    if get_checksum_cache() is not None:
+        return get_file_checksums(path, [algorithm])[1][algorithm]
+    return hashing.get_file_checksum(expand_path(path), algorithm, block_size)
+
+
+def get_file_checksums(path, algorithms):
+    ''' Return (size, {algorithm: checksum}) for path, reusing checksums
+        computed earlier if the file has not changed since.
+    '''
+    checksum_cache = get_checksum_cache()
+    if checksum_cache is not None:
+        return checksum_cache.get_checksums(expand_path(path), algorithms)
+    return hashing.get_file_checksums(expand_path(path), algorithms)
 
 def create_sysmeta_from_path(pid, path, algorithm=None, **kwargs):
     ''' Create a system meta data object.
@@ -250,11 +551,106 @@ def create_sysmeta_from_path(pid, path, algorithm=None, **kwargs):
         raise Exception('Missing filename')
 
     path = expand_path(path)
-    checksum = get_file_checksum(path, algorithm)
-    size = get_file_size(path)
+    if algorithm is None:
+        algorithm = configuration.checksum_alg
+    (size, checksums) = get_file_checksums(path, [algorithm])
+    checksum = checksums[algorithm]
     return create_system_metadata(pid, size, checksum, algorithm,
                                   **kwargs)
 
+def has_same_content(path, sysmeta, curr_sysmeta):
+    ''' Check whether the local file path, described by sysmeta, has the
+        same bytes as the object described by curr_sysmeta.  The file is
+        hashed in the remote algorithm if sysmeta uses another one.
+    '''
+    if curr_sysmeta is None or curr_sysmeta.checksum is None:
+        return False
+    (algorithm, checksum) = _get_checksum_key(curr_sysmeta)
+    if sysmeta is not None and \
+            str(sysmeta.checksum.algorithm) == algorithm:
+        (size, local_checksum) = (sysmeta.size, str(sysmeta.checksum.value()))
+    else:
+        (size, checksums) = get_file_checksums(path, [algorithm])
+        local_checksum = checksums[algorithm]
+    return int(size) == int(curr_sysmeta.size) and \
+        local_checksum.lower() == checksum.lower()
+
+# system metadata fields a submitter may change without sending new bytes
+SYSMETA_USER_FIELDS = ('accessPolicy', 'rightsHolder', 'formatId')
+
+def update_sysmeta_only(mn_client, pid, sysmeta, curr_sysmeta):
+    ''' Apply the SYSMETA_USER_FIELDS of sysmeta to the system metadata
+        of an object whose bytes have not changed; everything else, such
+        as the obsolescence chain, replicas and nodes, is kept from
+        curr_sysmeta.  Returns False, changing nothing, if the client
+        cannot update system metadata.
+    '''
+    update_method = getattr(mn_client, 'updateSystemMetadata', None)
+    if update_method is None:
+        return False
+    new_sysmeta = dataoneTypes.CreateFromDocument(curr_sysmeta.toxml())
+    for name in SYSMETA_USER_FIELDS:
+        value = getattr(sysmeta, name, None)
+        if value is not None:
+            setattr(new_sysmeta, name, value)
+    new_sysmeta.serialVersion = curr_sysmeta.serialVersion + 1
+    update_method(pid, new_sysmeta)
+    sysmeta_cache.invalidate(pid)
+    return True
+
+def generate_identifier(mn_client, scheme='UUID'):
+    ''' Ask the member node for a new, unused identifier. '''
+    return _get_pid_value(mn_client.generateIdentifier(scheme))
+
+def record_obsoletes(old_pid, new_pid):
+    ''' Update the local caches after new_pid was saved as the next
+        version of old_pid.
+    '''
+    sysmeta_cache.invalidate(old_pid)
+    sysmeta_cache.invalidate(new_pid)
+    obsolescence_index.set_head([old_pid, new_pid], new_pid)
+
+def create_object(mn_client, pid, obj, sysmeta):
+    ''' MNStorage.create of obj, a path or a file object opened in binary
+        mode.  With stream_uploads (off by default: its requests have
+        not been checked against a member node yet), the request body is
+        sent in fixed size buffers instead of being built in memory by
+        the client.
+    '''
+    with _open_upload(obj) as f:
+        if _can_stream_upload(mn_client):
+            (cert_file, key_file) = get_client_credentials(mn_client)
+            url = '%s/%s/%s' % (mn_client.base_url, REST_Version,
+                                REST_URL_Get)
+            return uploads.create_object(url, pid, f, sysmeta, cert_file,
+                                         key_file)
+        return mn_client.create(pid, f, sysmeta)
+
+def update_object(mn_client, pid, obj, new_pid, sysmeta):
+    ''' MNStorage.update of pid with obj, saved as new_pid; see
+        create_object.
+    '''
+    with _open_upload(obj) as f:
+        if _can_stream_upload(mn_client):
+            (cert_file, key_file) = get_client_credentials(mn_client)
+            return uploads.update_object(
+                create_object_url(mn_client.base_url, pid), new_pid, f,
+                sysmeta, cert_file, key_file)
+        return mn_client.update(pid, f, new_pid, sysmeta)
+
+def _can_stream_upload(mn_client):
+    # only clients created here, whose credentials are known
+    return configuration.stream_uploads and mn_client in client_args and \
+        client_args[mn_client][0] is mn_client_pool
+
+@contextlib.contextmanager
+def _open_upload(obj):
+    if isinstance(obj, basestring):
+        with open(expand_path(obj), 'rb') as f:
+            yield f
+    else:
+        yield obj
+
 #== FROM cli_client.py ========================================================
 
 def create_get_url_for_pid(baseurl, pid):
@@ -274,10 +670,24 @@ def create_url_for_pid(baseurl, action, pid):
         raise Exception('You must specify the pid')
     if not action:
         raise Exception('You must specify the action')
-    encoded_pid = urllib.quote_plus(pid)
+    encoded_pid = urllib.quote_plus(_encode_pid(pid))
     return '%s/%s/%s/%s' % (endpoint, REST_Version, action, encoded_pid)
 
 
+def _encode_pid(pid):
+    # urllib.quote raises KeyError for non-ASCII unicode
+    if isinstance(pid, unicode):
+        return pid.encode('utf-8')
+    return pid
+
+
+def create_object_url(baseurl, pid):
+    '''  Create the URL to get the bytes of pid from a node.
+    '''
+    return '%s/%s/%s/%s' % (baseurl, REST_Version, REST_URL_Get,
+                            urllib.quote(_encode_pid(pid), safe=''))
+
+
 def create_resolve_url_for_pid(baseurl, pid):
     '''  Create a URL for the specified pid.
     '''
@@ -287,7 +697,7 @@ def create_resolve_url_for_pid(baseurl, pid):
         raise Exception('You must specify the base URL')
     if not pid:
         raise Exception('You must specify the pid')
-    encoded_pid = urllib.quote_plus(pid)
+    encoded_pid = urllib.quote_plus(_encode_pid(pid))
     return '%s/%s/resolve/%s' % (endpoint, REST_Version, encoded_pid)
 
 
@@ -296,46 +706,352 @@ def get_object_by_pid(pid, filename=None, resolve=True, mn_client=None,
     ''' Create a mnclient and look for the object.  If the object is not found,
         simply return a None, don't throw an exception.  If found, return the
         filename.
+
+        Downloads go through the local object store so an object whose
+        checksum is already stored is not downloaded again.  The caller
+        always gets its own copy, in a temporary file if filename is None.
+
+        The bytes are checked against the sysmeta checksum while they are
+        written.  If they do not match, the object is downloaded from
+        another replica, up to checksum_retries times, before ChecksumError
+        is raised.
     '''
     if pid is None:
         raise Exception('Missing pid')
     # Create member node client and try to get the object.
     if mn_client is None:
         mn_client = get_d1_mn_client()
-    try:
-        response = mn_client.get(pid)
-        if response is not None:
-            fname = _get_fname(filename)
-            write_file_output(response, fname)
+    sysmeta = _get_stored_object_sysmeta(pid, mn_client, cn_client)
+    fname = _get_stored_object(pid, filename, sysmeta)
+    if fname is not None:
+        return fname
+    excluded = []
+    if sysmeta is not None and \
+            int(sysmeta.size) >= configuration.segmented_download_threshold:
+        try:
+            fname = _get_object_segmented(pid, filename, resolve, mn_client,
+                                          cn_client, sysmeta)
+        except ChecksumError as e:
+            # fall back to whole downloads, which can tell bad nodes apart
+            fname = None
+            base_url = getattr(e, 'base_url', None)
+            if base_url is not None:
+                if not resolve:
+                    raise
+                replica_selector.record_failure(base_url)
+                excluded.append(base_url)
+        if fname is not None:
             return fname
-    except d1_common.types.exceptions.DataONEException as e:
-        if e.errorCode != 404:
-            raise Exception(
-              'Unable to get resolve: {0}\n{1}'.format(pid, e.friendly_format()))
+    while True:
+        try:
+            return _download_object(pid, filename, resolve, mn_client,
+                                    cn_client, sysmeta, excluded)
+        except ChecksumError as e:
+            base_url = getattr(e, 'base_url', None)
+            if base_url is None or not resolve or \
+                    len(excluded) >= configuration.checksum_retries:
+                raise
+            replica_selector.record_failure(base_url)
+            excluded.append(base_url)
+
+
+def _download_object(pid, filename, resolve, mn_client, cn_client, sysmeta,
+                     excluded=()):
+    ''' Download pid from a node whose base url is not in excluded.  A
+        ChecksumError raised here has the base_url of the node that sent
+        the wrong bytes.
+    '''
+    if sysmeta is not None and configuration.resume_downloads:
+        return _get_object_resumable(pid, filename, resolve, mn_client,
+                                     cn_client, sysmeta, excluded)
+    found = _get_object_response(pid, resolve, mn_client, cn_client,
+                                 excluded)
+    if found is None:
+        # Nope, didn't find anything
+        return None
+    (response, mn_client) = found
+    if sysmeta is None:
+        sysmeta = _get_stored_object_sysmeta(pid, mn_client, cn_client)
+    if sysmeta is not None:
+        response = _verify_response(response, pid, sysmeta)
+    try:
+        return _save_object(response, pid, filename, sysmeta)
+    except ChecksumError as e:
+        e.base_url = mn_client.base_url
+        raise
+
+
+def _verify_response(response, pid, sysmeta):
+    (algorithm, checksum) = _get_checksum_key(sysmeta)
+    return VerifyingReader(response, pid, int(sysmeta.size), algorithm,
+                           checksum)
+
+
+def open_object_by_pid(pid, resolve=True, mn_client=None, cn_client=None):
+    ''' Like get_object_by_pid, but return a file-like object to read the
+        object from (the stored copy or the response stream itself) instead
+        of writing it to a file first.
+    '''
+    if pid is None:
+        raise Exception('Missing pid')
+    if mn_client is None:
+        mn_client = get_d1_mn_client()
+    sysmeta = _get_stored_object_sysmeta(pid, mn_client, cn_client)
+    path = _get_stored_path(pid, sysmeta)
+    if path is not None:
+        return open(path, 'rb')
+    found = _get_object_response(pid, resolve, mn_client, cn_client)
+    if found is None:
+        return None
+    if sysmeta is not None:
+        # reading past the end raises ChecksumError if the bytes are wrong
+        return _verify_response(found[0], pid, sysmeta)
+    return found[0]
+
+
+def _get_object_response(pid, resolve, mn_client, cn_client=None,
+                         excluded=()):
+    ''' Get pid from mn_client or, if resolve is set, from the nodes the
+        CN resolves it to, fastest first.  A node that fails or does not
+        answer within replica_timeout is skipped, as are the nodes whose
+        base url is in excluded.  Returns (response, client) or None.
+    '''
+    if mn_client.base_url not in excluded:
+        try:
+            response = mn_client.get(pid)
+            if response is not None:
+                return (response, mn_client)
+        except d1_common.types.exceptions.DataONEException as e:
+            if e.errorCode != 404:
+                raise Exception(
+                  'Unable to get resolve: {0}\n{1}'.format(pid, e.friendly_format()))
+    if resolve:
+        # the first one is mn_client's, which was tried above
+        base_urls = [base_url for base_url in
+                     _get_replica_base_urls(pid, True, mn_client,
+                                            cn_client)[1:]
+                     if base_url not in excluded]
+        (cert_file, key_file) = get_client_credentials(mn_client)
+        for baseUrl in replica_selector.rank(
+                base_urls, probe=configuration.probe_replicas):
+            response = replica_selector.open(baseUrl,
+                                             create_object_url(baseUrl, pid),
+                                             cert_file, key_file)
+            if response is not None:
+                return (response, get_d1_mn_client(mn_url=baseUrl))
+    return None
+
+
+def _get_object_segmented(pid, filename, resolve, mn_client, cn_client,
+                          sysmeta):
+    ''' Download a large object in parallel segments from all of its
+        replicas.  Returns None if none of them supports Range requests.
+    '''
+    base_urls = replica_selector.rank(
+        _get_replica_base_urls(pid, resolve, mn_client, cn_client),
+        int(sysmeta.size), configuration.probe_replicas)
+    (cert_file, key_file) = get_client_credentials(mn_client)
+    urls = dict((create_object_url(base_url, pid), base_url)
+                for base_url in base_urls)
+    # a stalled segment fails after download_timeout seconds without
+    # data and is fetched from the next replica
+    download = SegmentedDownload([create_object_url(base_url, pid)
+                                  for base_url in base_urls],
+                                 int(sysmeta.size), get_segment_pool(),
+                                 configuration.segment_size,
+                                 cert_file, key_file,
+                                 configuration.download_timeout)
+    try:
+        return _save_with(download.run, pid, filename, sysmeta)
+    except RangeNotSupported:
+        return None
+    except ChecksumError as e:
+        # only a node that sent every segment can be blamed
+        sources = set(urls[url] for url in download.sources)
+        e.base_url = sources.pop() if len(sources) == 1 else None
+        raise
+
+
+def _get_object_resumable(pid, filename, resolve, mn_client, cn_client,
+                          sysmeta, excluded=()):
+    ''' Download pid through a partial file in the staging directory.
+        A download interrupted earlier is continued with a Range request
+        if a node supports them.
+    '''
+    (algorithm, checksum) = _get_checksum_key(sysmeta)
+    partial = PartialDownload(get_cache_dir('partial'), pid,
+                              int(sysmeta.size), algorithm, checksum)
+    with partial.lock:
+        offset = partial.get_offset()
+        while True:
+            found = None
+            if offset > 0:
+                found = _get_object_range(pid, offset, resolve, mn_client,
+                                          cn_client, excluded)
+            if found is None:
+                offset = 0
+                found = _get_object_response(pid, resolve, mn_client,
+                                             cn_client, excluded)
+                if found is None:
+                    return None
+                found = (found[0], found[1].base_url)
+            (response, base_url) = found
+            try:
+                partial.write(response, offset)
+                break
+            except ChecksumError as e:
+                if offset == 0:
+                    e.base_url = base_url
+                    raise
+                # the bytes kept from before may be the wrong ones, so
+                # only a whole download can tell which node is bad
+                offset = 0
+            finally:
+                response.close()
+        return _save_with(partial.finish, pid, filename, sysmeta, True)
+
+
+def _get_object_range(pid, offset, resolve, mn_client, cn_client=None,
+                      excluded=()):
+    ''' Get pid from byte offset on from the first node that supports
+        Range requests.  Returns (response, base_url) or None.
+    '''
+    (cert_file, key_file) = get_client_credentials(mn_client)
+    for base_url in replica_selector.rank(
+            _get_replica_base_urls(pid, resolve, mn_client, cn_client)):
+        if base_url in excluded:
+            continue
+        try:
+            return (open_range(create_object_url(base_url, pid), offset,
+                               None, cert_file, key_file,
+                               configuration.replica_timeout), base_url)
+        except Exception:
+            continue
+    return None
+
+
+def _get_replica_base_urls(pid, resolve, mn_client, cn_client=None):
+    ''' Return the base urls of the nodes that may hold pid: mn_client's
+        and, if resolve is set, those the CN resolves it to.
+    '''
+    base_urls = [mn_client.base_url]
     if resolve:
         if cn_client is None:
             cn_client = get_d1_cn_client()
-        object_location_list = None
         try:
             object_location_list = cn_client.resolve(pid)
-            if ((object_location_list is not None)
-                and (len(object_location_list.objectLocation) > 0)):
-                baseUrl = object_location_list.objectLocation[0].baseURL
-                # If there is an object, go get it.
-                mn_client = get_d1_mn_client(mn_url=baseUrl)
-                response = mn_client.get(pid)
-                if response is not None:
-                    fname = _get_fname(filename)
-                    write_file_output(response, os.path.expanduser(fname))
-                    return fname
         except d1_common.types.exceptions.DataONEException as e:
             if e.errorCode != 404:
                 raise Exception(
                   'Unable to get resolve: {0}\n{1}'.format(pid, e.friendly_format()))
-    # Nope, didn't find anything
+            object_location_list = None
+        if object_location_list is not None:
+            for location in object_location_list.objectLocation:
+                if location.baseURL not in base_urls:
+                    base_urls.append(location.baseURL)
+    return base_urls
+
+
+def check_file_checksum(path, pid, sysmeta):
+    ''' Raise ChecksumError if the file at path does not match the
+        checksum in sysmeta.
+    '''
+    (algorithm, expected) = _get_checksum_key(sysmeta)
+    actual = hashing.get_file_checksum(path, algorithm)
+    if actual.lower() != expected.lower():
+        raise ChecksumError(pid, algorithm, expected, actual)
+
+
+def _get_stored_object_sysmeta(pid, mn_client, cn_client=None):
+    ''' Get the (usually cached) sysmeta for exactly this pid, or None if
+        no node can provide it right now.
+    '''
+    for client in (mn_client, cn_client):
+        if client is None:
+            continue
+        try:
+            sysmeta = get_sysmeta_by_pid(pid, False, client,
+                                         follow_obsoletes=False)
+        except Exception:
+            continue
+        if sysmeta:
+            return sysmeta
     return None
 
 
+def _get_checksum_key(sysmeta):
+    return (str(sysmeta.checksum.algorithm), str(sysmeta.checksum.value()))
+
+
+def _get_stored_object(pid, filename, sysmeta):
+    ''' Return the stored copy of pid (copied to filename if given) or
+        None if it has not been downloaded before.
+    '''
+    path = _get_stored_path(pid, sysmeta)
+    if path is None:
+        return None
+    return _copy_stored_object(path, filename)
+
+
+def _get_stored_path(pid, sysmeta):
+    object_store = get_object_store()
+    if object_store is None:
+        return None
+    if sysmeta is not None:
+        key = _get_checksum_key(sysmeta)
+    else:
+        # pids are immutable, so the last download is still valid
+        key = object_store.lookup_pid(pid)
+    if key is None or not is_valid_checksum(*key):
+        return None
+    path = object_store.get_path(*key)
+    if path is not None:
+        object_store.add_pid(pid, *key)
+    return path
+
+
+def _save_object(response, pid, filename, sysmeta):
+    ''' Write the response of a get to filename, keeping a copy in the
+        object store when the checksum is known.
+    '''
+    return _save_with(lambda path: write_file_output(response, path),
+                      pid, filename, sysmeta,
+                      isinstance(response, VerifyingReader))
+
+
+def _save_with(write, pid, filename, sysmeta, verified=False):
+    ''' Like _save_object, but write(path) downloads the object.  Unless
+        verified is set because write already checked the bytes, they are
+        checked against sysmeta before they are stored.
+    '''
+    object_store = get_object_store()
+    if object_store is None or sysmeta is None or \
+            not is_valid_checksum(*_get_checksum_key(sysmeta)):
+        fname = _get_fname(filename)
+        write(expand_path(fname))
+        if sysmeta is not None and not verified:
+            check_file_checksum(expand_path(fname), pid, sysmeta)
+        return fname
+    tmp_path = object_store.create_temp_file()
+    try:
+        write(tmp_path)
+        if not verified:
+            check_file_checksum(tmp_path, pid, sysmeta)
+        path = object_store.add_file(tmp_path, *_get_checksum_key(sysmeta),
+                                     pid=pid)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return _copy_stored_object(path, filename)
+
+
+def _copy_stored_object(path, filename):
+    # the stored file may be evicted, so callers never get it directly
+    fname = _get_fname(filename)
+    shutil.copyfile(path, expand_path(fname))
+    return fname
+
+
 def _get_fname(filename):
     ''' If fname is none, create a name.
     '''
@@ -353,17 +1069,27 @@ def get_baseUrl(nodeId, cn_client=None):
     if cn_client is None:
         cn_client = get_d1_cn_client()
     try:
-        nodes = cn_client.listNodes()
-        for node in list(nodes.node):
-            if node.identifier.value() == nodeId:
-                return node.baseURL
+        return get_node_registry(cn_client).get_base_url(nodeId, cn_client)
+    except (d1_common.types.exceptions.ServiceFailure) as e:
+        raise Exception("Unable to get node list.")
+
+
+def get_nodeId(baseUrl, cn_client=None):
+    '''  Get the node id of the node with the given base url.
+    '''
+    if cn_client is None:
+        cn_client = get_d1_cn_client()
+    try:
+        return get_node_registry(cn_client).get_node_id(baseUrl, cn_client)
     except (d1_common.types.exceptions.ServiceFailure) as e:
         raise Exception("Unable to get node list.")
-    return None
 
 
-def get_sysmeta_by_pid(pid, search_mn=False, cn_client=None, mn_client=None):
-    '''  Get the system metadata object for this particular pid.
+def get_sysmeta_by_pid(pid, search_mn=False, cn_client=None, mn_client=None,
+                       follow_obsoletes=True):
+    '''  Get the system metadata object for this particular pid.  If the
+         object has been obsoleted, the newest version is returned unless
+         follow_obsoletes is False.
     '''
     if not pid:
         raise Exception('Missing pid')
@@ -372,20 +1098,7 @@ def get_sysmeta_by_pid(pid, search_mn=False, cn_client=None, mn_client=None):
     try:
         if cn_client is None:
             cn_client = get_d1_cn_client()
-        obsolete = True;
-        while obsolete:
-            obsolete = False;
-            sysmeta = cn_client.getSystemMetadata(pid)
-            if not sysmeta:
-                return None
-            if sysmeta.obsoletedBy:
-                # msg = ('Object "%s" has been obsoleted by "%s".  '
-                #     + 'Would you rather use that?') % (pid, sysmeta.obsoletedBy)
-                # if not cli_util.confirm(msg):
-                #   break;
-                pid = sysmeta.obsoletedBy
-                obsolete = True
-        return sysmeta
+        return _get_sysmeta_from_node(cn_client, pid, follow_obsoletes)
     except d1_common.types.exceptions.DataONEException as e:
         if e.errorCode != 404:
             raise Exception(
@@ -395,20 +1108,7 @@ def get_sysmeta_by_pid(pid, search_mn=False, cn_client=None, mn_client=None):
         try:
             if mn_client is None:
                 mn_client = get_d1_mn_client()
-            obsolete = True;
-            while obsolete:
-                obsolete = False;
-                sysmeta = mn_client.getSystemMetadata(pid)
-                if not sysmeta:
-                    return None
-                if sysmeta.obsoletedBy:
-                    # msg = ('Object "%s" has been obsoleted by "%s".  '
-                    #     + 'Would you rather use that?') % (pid, sysmeta.obsoletedBy)
-                    # if not cli_util.confirm(msg):
-                    #   break;
-                    pid = sysmeta.obsoletedBy
-                    obsolete = True
-            return sysmeta
+            return _get_sysmeta_from_node(mn_client, pid, follow_obsoletes)
         except d1_common.types.exceptions.DataONEException as e:
             if e.errorCode != 404:
                 raise Exception(
@@ -417,6 +1117,46 @@ def get_sysmeta_by_pid(pid, search_mn=False, cn_client=None, mn_client=None):
     return sysmeta
 
 
+def _get_sysmeta_from_node(client, pid, follow_obsoletes=True):
+    '''  Get the system metadata for pid from one node, following the
+         obsolescence chain.  Chains seen before start at their known head
+         so resolving an old version costs (at most) one request.
+    '''
+    pid = _get_pid_value(pid)
+    if not follow_obsoletes:
+        return sysmeta_cache.get_sysmeta(client, pid)
+    chain = [pid]
+    head = obsolescence_index.get_head(pid)
+    if head is not None and head != pid:
+        try:
+            sysmeta = sysmeta_cache.get_sysmeta(client, head)
+            chain.append(head)
+        except d1_common.types.exceptions.DataONEException as e:
+            if e.errorCode != 404:
+                raise
+            # the node doesn't know the head (yet); walk from pid instead
+            sysmeta = sysmeta_cache.get_sysmeta(client, pid)
+    else:
+        sysmeta = sysmeta_cache.get_sysmeta(client, pid)
+    while sysmeta and sysmeta.obsoletedBy:
+        # msg = ('Object "%s" has been obsoleted by "%s".  '
+        #     + 'Would you rather use that?') % (pid, sysmeta.obsoletedBy)
+        # if not cli_util.confirm(msg):
+        #   break;
+        chain.append(_get_pid_value(sysmeta.obsoletedBy))
+        sysmeta = sysmeta_cache.get_sysmeta(client, chain[-1])
+    if not sysmeta:
+        return None
+    obsolescence_index.set_head(chain, chain[-1])
+    return sysmeta
+
+
+def _get_pid_value(pid):
+    if hasattr(pid, 'value'):
+        return pid.value()
+    return pid
+
+
 def run_test():
     configuration.mn_url = "https://mn-demo-9.test.dataone.org/knb/d1/mn"
     configuration.cn_url = "https://cn-stage-2.test.dataone.org/cn"
@@ -428,9 +1168,7 @@ def run_test():
                                        submitter="dakoop", owner="dakoop",
                                        orig_mn=configuration.mn_url, 
                                        auth_mn=configuration.mn_url)
-    f = open(fname, 'r')
-    retval = mn_client.create(pid, f, sysmeta)
-    f.close()
+    retval = create_object(mn_client, pid, fname, sysmeta)
 
 if __name__ == '__main__':
     run_test()
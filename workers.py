@@ -0,0 +1,149 @@
+###############################################################################
+## VisTrails wrapper for DataONE
+## By David Koop, dkoop@poly.edu
+##
+## Copyright (C) 2012-2013, NYU-Poly.
+###############################################################################
+
+import collections
+import multiprocessing
+import Queue
+import sys
+import threading
+
+
+class Task(object):
+    ''' Handle for work submitted to a WorkerPool. '''
+
+    def __init__(self, async_result=None):
+        self._async_result = async_result
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        if self._async_result is not None:
+            return self._async_result.ready()
+        return self._done.is_set()
+
+    def get(self, timeout=None):
+        ''' Wait for the task and return its result, re-raising any
+            exception it raised.
+        '''
+        if self._async_result is not None:
+            return self._async_result.get(timeout)
+        if timeout is None:
+            wait_until(self._done.is_set, self._done.wait)
+        elif not self._done.wait(timeout):
+            raise multiprocessing.TimeoutError()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def _run(self, fn, args, kwargs):
+        try:
+            self._result = fn(*args, **kwargs)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+
+class WorkerPool(object):
+    ''' Pool of worker threads, or processes if use_processes is set, that
+        run submitted functions and hand back Task objects.
+
+        Threads are enough for hashing and network transfers since both
+        release the GIL; processes need picklable, module-level functions.
+    '''
+
+    def __init__(self, num_workers=None, use_processes=False):
+        if not num_workers:
+            num_workers = multiprocessing.cpu_count()
+        self.num_workers = num_workers
+        self.use_processes = use_processes
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._process_pool = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        if self.use_processes:
+            with self._lock:
+                if self._process_pool is None:
+                    self._process_pool = \
+                        multiprocessing.Pool(self.num_workers)
+            return Task(self._process_pool.apply_async(fn, args, kwargs))
+        task = Task()
+        self._queue.put((task, fn, args, kwargs))
+        with self._lock:
+            if len(self._threads) < self.num_workers and \
+                    self._queue.qsize() > 0:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return task
+
+    def map(self, fn, iterable):
+        ''' Run fn over iterable in the pool and return the results in
+            order.
+        '''
+        return [task.get() for task in [self.submit(fn, item)
+                                         for item in iterable]]
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+            process_pool = self._process_pool
+            self._process_pool = None
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+        if process_pool is not None:
+            process_pool.close()
+            if wait:
+                process_pool.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            (task, fn, args, kwargs) = item
+            task._run(fn, args, kwargs)
+
+
+def wait_until(is_done, wait):
+    ''' Call wait (an Event.wait, Condition.wait or Thread.join) until
+        is_done returns True.  Waits without a timeout can't be
+        interrupted by Ctrl-C in Python 2, so each call waits a second.
+    '''
+    while not is_done():
+        wait(1.0)
+
+def iter_ordered(pool, fn, items, max_pending):
+    ''' Yield (item, fn(item)) for each of items, in order, running up to
+        max_pending calls at once in pool.  Without a pool, or with
+        max_pending below 2, fn runs as the results are iterated.
+    '''
+    if pool is None or max_pending < 2:
+        for item in items:
+            yield (item, fn(item))
+        return
+    # a bounded number of calls in flight, so results are consumed as
+    # they arrive instead of being held all at once
+    pending = collections.deque()
+    items = iter(items)
+    for item in items:
+        pending.append((item, pool.submit(fn, item)))
+        if len(pending) >= max_pending:
+            break
+    while pending:
+        (item, task) = pending.popleft()
+        for next_item in items:
+            pending.append((next_item, pool.submit(fn, next_item)))
+            break
+        yield (item, task.get())